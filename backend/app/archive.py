@@ -0,0 +1,199 @@
+import gzip
+import os
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock, Thread
+import orjson
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models.archive import GlobalArchive
+from models.message import Message
+from helper import encode_message, DEFAULT_PAGE_SIZE
+
+"""
+globalni chat (chat_id IS NULL) podijeljen po mjesecima:
+- zadnjih GLOBAL_RETENTION_DAYS dana je u tabeli messages (zivi dio, sa njim rade cache i poll)
+- svaki mjesec koji je cijeli stariji od toga se izvozi u ARCHIVE_DIR/global-YYYY-MM.jsonl.gz
+  (jedna poruka po liniji, isti JSON kao u API-ju) i brise iz baze
+- global_archives pamti koji mjeseci su arhivirani i raspon id-ova u svakom
+
+redoslijed je fajl pa baza: ako proces padne izmedju, iduce arhiviranje spaja postojeci fajl
+sa redovima koji su ostali u bazi (po id-u), pa se nista ne gubi ni ne duplira
+
+citanje arhive ide preko GET /messages/archive/{month}, dekomprimovani mjeseci
+se drze u malom LRU cacheu (MAX_CACHED_ARCHIVES)
+"""
+
+GLOBAL_RETENTION_DAYS = int(os.environ.get("GLOBAL_RETENTION_DAYS", "90"))  # 0 = bez
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "./archive")
+ARCHIVE_INTERVAL = 6 * 3600  # s
+MAX_CACHED_ARCHIVES = 4
+
+_archive_cache = OrderedDict()  # month -> (mtime_ns, id-ovi, JSON bajtovi)
+_archive_cache_lock = Lock()
+
+
+def _month_key(start: datetime):
+    return start.strftime("%Y-%m")
+
+
+def _next_month(start: datetime):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def _archive_path(month: str):
+    return os.path.join(ARCHIVE_DIR, f"global-{month}.jsonl.gz")
+
+
+# [(id, JSON bajtovi)] sortirano po id-u
+def _read_archive_file(path: str):
+    with gzip.open(path, "rb") as f:
+        lines = f.read().splitlines()
+    return [(orjson.loads(line)["id"], line) for line in lines]
+
+
+def _write_archive_file(path: str, lines):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # pid u imenu: dva workera mogu arhivirati isti mjesec u isto vrijeme
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+        f.write(b"\n".join(lines))
+        f.write(b"\n")
+    os.replace(tmp_path, path)
+
+
+# globalne poruke iz [start, end) prebacuje u arhivu, vraca broj poruka
+def archive_month(db: Session, start: datetime):
+    end = _next_month(start)
+    in_month = (
+        Message.chat_id.is_(None),
+        Message.created_at >= start,
+        Message.created_at < end,
+    )
+    rows = db.scalars(select(Message).where(*in_month).order_by(Message.id)).all()
+    if not rows:
+        return 0
+
+    month = _month_key(start)
+    path = _archive_path(month)
+    messages = {m.id: encode_message(m) for m in rows}
+    if os.path.exists(path):
+        # prethodno arhiviranje nije stiglo obrisati redove, ili su dodani naknadno
+        for msg_id, line in _read_archive_file(path):
+            messages.setdefault(msg_id, line)
+    ids = sorted(messages)
+    _write_archive_file(path, [messages[i] for i in ids])
+
+    record = {
+        "month": month,
+        "file_name": os.path.basename(path),
+        "first_id": ids[0],
+        "last_id": ids[-1],
+        "message_count": len(ids),
+        "archived_at": datetime.now(timezone.utc),
+    }
+    stmt = insert(GlobalArchive).values(**record)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[GlobalArchive.month],
+            set_={k: stmt.excluded[k] for k in record if k != "month"},
+        )
+    )
+    db.execute(
+        delete(Message)
+        .where(*in_month, Message.id <= rows[-1].id)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+    with _archive_cache_lock:
+        _archive_cache.pop(month, None)
+    return len(rows)
+
+
+# arhivira sve mjesece koji su cijeli stariji od GLOBAL_RETENTION_DAYS
+def archive_global_history(db: Session):
+    if GLOBAL_RETENTION_DAYS <= 0:
+        return {}
+    # created_at je u bazi UTC bez zone
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+        days=GLOBAL_RETENTION_DAYS
+    )
+    cutoff_month = cutoff.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    archived = {}
+    while True:
+        oldest = db.scalar(
+            select(func.min(Message.created_at)).where(
+                Message.chat_id.is_(None), Message.created_at < cutoff_month
+            )
+        )
+        if oldest is None:
+            break
+        start = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        count = archive_month(db, start)
+        if not count:
+            break  # created_at u formatu koji se ne poredi kao datum, ne vrtimo se u krug
+        archived[_month_key(start)] = count
+
+    if archived:
+        print(f"Arhivirana globalna historija: {archived}")
+    return archived
+
+
+def archive_periodically():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        db = SessionLocal()
+        try:
+            archive_global_history(db)
+        except Exception as e:
+            print("Greska pri arhiviranju globalnog chata:", e)
+        finally:
+            db.close()
+
+
+# id-ovi i JSON bajtovi arhiviranog mjeseca, None ako arhiva ne postoji
+# blokira (citanje + gzip), poziva se iz threadpoola
+def load_archive(month: str):
+    path = _archive_path(month)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _archive_cache_lock:
+        cached = _archive_cache.get(month)
+        if cached is not None and cached[0] == mtime:
+            _archive_cache.move_to_end(month)
+            return cached[1], cached[2]
+
+    entries = _read_archive_file(path)
+    ids = [msg_id for msg_id, _ in entries]
+    lines = [line for _, line in entries]
+    with _archive_cache_lock:
+        _archive_cache[month] = (mtime, ids, lines)
+        _archive_cache.move_to_end(month)
+        if len(_archive_cache) > MAX_CACHED_ARCHIVES:
+            _archive_cache.popitem(last=False)
+    return ids, lines
+
+
+# stranica arhive kao keyset_page: (JSON bajtovi sortirani uzlazno, next_cursor)
+def archive_page(ids, lines, before_id=None, after_id=None, limit=DEFAULT_PAGE_SIZE):
+    if after_id is not None:
+        start = bisect_right(ids, after_id)
+        end = min(start + limit, len(ids))
+        next_cursor = f"after_id={ids[end - 1]}" if end < len(ids) else None
+        return lines[start:end], next_cursor
+    end = bisect_left(ids, before_id) if before_id is not None else len(ids)
+    start = max(0, end - limit)
+    next_cursor = f"before_id={ids[start]}" if start > 0 else None
+    return lines[start:end], next_cursor
+
+
+# pokrecemo nit u pozadini
+Thread(target=archive_periodically, daemon=True).start()
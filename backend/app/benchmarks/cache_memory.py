@@ -0,0 +1,103 @@
+import argparse
+import gc
+import tracemalloc
+from datetime import datetime, timezone
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from helper import CachedMessage, serialize_message
+from cache.cache_global import MessageRing
+from cache.cache_private import ChatCache
+
+"""
+mjeri koliko memorije zauzima jedna poruka u cacheu (bajtova po poruci)
+pokretanje iz backend/app:
+    python -m benchmarks.cache_memory --count 1000 --content-size 50
+
+- global: MessageRing (globalni chat)
+- private: ChatCache (jedan privatni chat)
+- dict: stari format (dict iz serialize_message sa ISO stringom), za poredjenje
+content je ukljucen u sve formate (u cacheu je dio JSON bajtova, u dict-u poseban string)
+"""
+
+# Message ima relacije prema User i Chat, mapperi ih traze po imenu
+_RELATED_MODELS = (User, Chat)
+
+
+def _make_messages(count: int, content_size: int):
+    now = datetime.now(timezone.utc)
+    return [
+        Message(
+            id=i + 1,
+            content=f"{i:0{content_size}d}"[:content_size],
+            username=f"user{i % 100}",
+            user_id=i % 100 + 1,
+            type=MessageType.USER_MESSAGE,
+            created_at=now,
+        )
+        for i in range(count)
+    ]
+
+
+# (bajtova alocirano dok build() puni strukturu, broj poruka u njoj)
+# objekat ostaje ziv do kraja mjerenja
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    count = len(kept)
+    del kept
+    return after - before, count
+
+
+def _fill_ring(msgs):
+    ring = MessageRing(len(msgs))
+    for m in msgs:
+        ring.append(CachedMessage(m))
+    return ring
+
+
+# vraca deque poruka, ChatCache oko njega je jedan objekat po chatu
+def _fill_chat(msgs):
+    cache = ChatCache()
+    for m in msgs:
+        cache.add(CachedMessage(m))
+    return cache.messages
+
+
+def _fill_dicts(msgs):
+    result = []
+    for m in msgs:
+        data = serialize_message(m)
+        # kopija stringa, kao da je procitan iz baze
+        data["content"] = "".join(m.content)
+        result.append(data)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--content-size", type=int, default=50)
+    args = parser.parse_args()
+
+    msgs = _make_messages(args.count, args.content_size)
+    for name, build in (
+        ("global", _fill_ring),
+        ("private", _fill_chat),
+        ("dict", _fill_dicts),
+    ):
+        # cache sa manjim kapacitetom od --count cuva samo najnovije poruke
+        total, count = _measure(lambda: build(msgs))
+        per_message = total / count
+        print(
+            f"{name:8} {per_message:8.1f} B/poruka "
+            f"(bez contenta {per_message - args.content_size:8.1f} B)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+import httpx
+import orjson
+import websockets
+
+"""
+load test: globalni polleri + parovi na privatnom websocketu + slanje poruka zadanom brzinom
+pokretanje iz backend/app:
+    python -m benchmarks.load_test --pollers 100 --pairs 20 --send-rate 20 --duration 30
+bez --url pokrece lokalni uvicorn sa praznom bazom u privremenom folderu,
+sa --url gadja vec pokrenut server (npr. --url http://127.0.0.1:8000)
+
+- poller: /messages/unread svakih 2-5s i /users/active svakih 5-10s, kao frontend,
+  salje If-None-Match kao browser (304 se racuna kao uspjesan odgovor)
+- par: dva usera sa chatom, oba na /chats/ws
+- slanje: --send-rate poruka u sekundi ukupno, --global-share ide na POST /messages,
+  ostatak preko websocketa nasumicnog para
+- globalne poruke salju posebni useri (--global-senders) koji ne pollaju: slanje pomjera
+  posiljaocu kursor do njegove poruke, pa poller koji i salje preskace tudje poruke
+  poslane izmedju njegovog polla i slanja, i ocekivani broj isporuka ne bi bio tacan
+
+izvjestaj je JSON (stdout ili --output): latencija po ruti (p50/p95/p99 u ms),
+throughput, kasnjenje isporuke (od slanja do prijema kod primaoca) i broj gresaka
+"""
+
+POLL_INTERVAL = (2, 5)  # /messages/unread, kao frontend
+ACTIVE_INTERVAL = (5, 10)  # /users/active, kao frontend
+DRAIN_TIME = 3  # koliko nakon slanja cekamo da poruke stignu do primalaca
+SERVER_START_TIMEOUT = 30
+
+
+def _percentile(sorted_values, p: float):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[i]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _summary(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": _ms(sum(values) / len(values)) if values else None,
+        "p50_ms": _ms(_percentile(values, 50)),
+        "p95_ms": _ms(_percentile(values, 95)),
+        "p99_ms": _ms(_percentile(values, 99)),
+        "max_ms": _ms(values[-1]) if values else None,
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # ruta -> sekunde
+        self.statuses = defaultdict(lambda: defaultdict(int))  # ruta -> status -> broj
+        self.errors = defaultdict(int)  # vrsta greske -> broj
+        self.lags = defaultdict(list)  # "global"/"private" -> sekunde
+        self.sent = defaultdict(int)
+        self.delivered = defaultdict(int)
+        self.pending = {}  # token -> (kanal, vrijeme slanja)
+        self._tokens = itertools.count(1)
+
+    def new_token(self, channel: str):
+        token = f"lt{next(self._tokens)}"
+        self.pending[token] = (channel, time.perf_counter())
+        self.sent[channel] += 1
+        return token
+
+    # globalnu poruku prima svaki poller, pa se kasnjenje broji po isporuci
+    def received(self, content: str, final: bool):
+        entry = self.pending.get(content)
+        if entry is None:
+            return
+        channel, sent_at = entry
+        self.lags[channel].append(time.perf_counter() - sent_at)
+        self.delivered[channel] += 1
+        if final:
+            del self.pending[content]
+
+    def error(self, kind: str):
+        self.errors[kind] += 1
+
+
+async def _request(client, stats: Stats, route: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        stats.error(f"{route}: {type(e).__name__}")
+        return None
+    stats.latencies[route].append(time.perf_counter() - started)
+    stats.statuses[route][str(response.status_code)] += 1
+    if response.status_code not in (200, 304):
+        stats.error(f"{route}: HTTP {response.status_code}")
+        return None
+    return response
+
+
+async def _join(client, stats: Stats, prefix: str):
+    username = f"{prefix}_{random.getrandbits(40):x}"
+    response = await _request(
+        client, stats, "POST /join", "POST", "/join", json={"username": username}
+    )
+    return None if response is None else response.json()
+
+
+async def _poll_loop(client, stats: Stats, route: str, url: str, interval, on_body):
+    etag = None
+    while True:
+        await asyncio.sleep(random.uniform(*interval))
+        headers = {"If-None-Match": etag} if etag else {}
+        response = await _request(client, stats, route, "GET", url, headers=headers)
+        if response is None:
+            continue
+        etag = response.headers.get("ETag", etag)
+        if response.status_code == 200:
+            on_body(response.json())
+
+
+def _poller_tasks(client, stats: Stats, user: dict):
+    def on_messages(messages):
+        for m in messages:
+            stats.received(m.get("content"), final=False)
+
+    return [
+        _poll_loop(
+            client,
+            stats,
+            "GET /messages/unread",
+            f"/messages/unread?user_id={user['id']}",
+            POLL_INTERVAL,
+            on_messages,
+        ),
+        _poll_loop(
+            client,
+            stats,
+            "GET /users/active",
+            f"/users/active?current_user_id={user['id']}",
+            ACTIVE_INTERVAL,
+            lambda users: None,
+        ),
+    ]
+
+
+class PrivatePair:
+    def __init__(self, chat_id: int, user_ids):
+        self.chat_id = chat_id
+        self.user_ids = user_ids
+        self.sockets = {}
+
+    async def connect(self, ws_url: str, stats: Stats):
+        for user_id in self.user_ids:
+            ws = await websockets.connect(ws_url + "/chats/ws")
+            await ws.send(
+                orjson.dumps({"type": "connect", "user_id": user_id}).decode()
+            )
+            self.sockets[user_id] = ws
+        return [self._listen(ws, stats) for ws in self.sockets.values()]
+
+    async def _listen(self, ws, stats: Stats):
+        try:
+            async for frame in ws:
+                msg = orjson.loads(frame)
+                if msg.get("type") == "new_message":
+                    stats.received(msg["data"].get("content"), final=True)
+        except websockets.ConnectionClosedError:
+            stats.error("WS /chats/ws: closed")
+
+    async def send(self, stats: Stats):
+        sender_id = random.choice(self.user_ids)
+        frame = {
+            "type": "new_message",
+            "data": {
+                "chat_id": self.chat_id,
+                "sender_id": sender_id,
+                "content": stats.new_token("private"),
+            },
+        }
+        try:
+            await self.sockets[sender_id].send(orjson.dumps(frame).decode())
+        except websockets.ConnectionClosed:
+            stats.error("WS /chats/ws: send on closed socket")
+
+    async def close(self):
+        for ws in self.sockets.values():
+            await ws.close()
+
+
+async def _make_pair(client, stats: Stats):
+    a = await _join(client, stats, "pair")
+    b = await _join(client, stats, "pair")
+    if a is None or b is None:
+        return None
+    response = await _request(
+        client,
+        stats,
+        "POST /chats",
+        "POST",
+        "/chats",
+        json={"user1_id": a["id"], "user2_id": b["id"]},
+    )
+    return (
+        None
+        if response is None
+        else PrivatePair(response.json()["id"], [a["id"], b["id"]])
+    )
+
+
+async def _send_global(client, stats: Stats, sender: dict):
+    await _request(
+        client,
+        stats,
+        "POST /messages",
+        "POST",
+        "/messages",
+        json={
+            "content": stats.new_token("global"),
+            "username": sender["username"],
+            "user_id": sender["id"],
+        },
+    )
+
+
+# salje poruke ravnomjerno, bez cekanja na odgovor (otvoreni model opterecenja)
+async def _send_loop(client, stats: Stats, args, senders, pairs, in_flight: set):
+    if args.send_rate <= 0:
+        return
+    period = 1 / args.send_rate
+    next_at = time.perf_counter()
+    while True:
+        next_at += period
+        if pairs and (not senders or random.random() >= args.global_share):
+            task = asyncio.create_task(random.choice(pairs).send(stats))
+        elif senders:
+            task = asyncio.create_task(
+                _send_global(client, stats, random.choice(senders))
+            )
+        else:
+            return
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        await asyncio.sleep(max(0, next_at - time.perf_counter()))
+
+
+async def run(args, base_url: str):
+    stats = Stats()
+    ws_url = "ws" + base_url[len("http") :]
+    limits = httpx.Limits(max_connections=args.max_connections)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=args.timeout, limits=limits
+    ) as client:
+        pollers = [
+            u
+            for u in await asyncio.gather(
+                *[_join(client, stats, "poll") for _ in range(args.pollers)]
+            )
+            if u
+        ]
+        pairs = [
+            p
+            for p in await asyncio.gather(
+                *[_make_pair(client, stats) for _ in range(args.pairs)]
+            )
+            if p
+        ]
+        senders = [
+            u
+            for u in await asyncio.gather(
+                *[_join(client, stats, "send") for _ in range(args.global_senders)]
+            )
+            if u
+        ]
+        listeners = []
+        for pair in pairs:
+            listeners += await pair.connect(ws_url, stats)
+
+        tasks = [asyncio.create_task(coro) for coro in listeners]
+        for user in pollers:
+            tasks += [
+                asyncio.create_task(coro) for coro in _poller_tasks(client, stats, user)
+            ]
+        in_flight = set()
+        sender = asyncio.create_task(
+            _send_loop(client, stats, args, senders, pairs, in_flight)
+        )
+
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        sender.cancel()
+        if in_flight:
+            await asyncio.wait(in_flight)
+        # polleri nastavljaju dok poruke ne stignu
+        await asyncio.sleep(max(DRAIN_TIME, POLL_INTERVAL[1]))
+        elapsed = time.perf_counter() - started
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*[pair.close() for pair in pairs], return_exceptions=True)
+
+    total_requests = sum(len(v) for v in stats.latencies.values())
+    return {
+        "config": {
+            "pollers": args.pollers,
+            "pairs": args.pairs,
+            "global_senders": args.global_senders,
+            "send_rate": args.send_rate,
+            "global_share": args.global_share,
+            "duration_s": args.duration,
+        },
+        "elapsed_s": round(elapsed, 2),
+        "requests": total_requests,
+        "throughput_rps": round(total_requests / elapsed, 2),
+        "routes": {
+            route: {**_summary(values), "statuses": dict(stats.statuses[route])}
+            for route, values in sorted(stats.latencies.items())
+        },
+        "delivery": {
+            channel: {
+                "sent": stats.sent[channel],
+                "expected_deliveries": stats.sent[channel] * receivers,
+                "deliveries": stats.delivered[channel],
+                **_summary(stats.lags[channel]),
+            }
+            for channel, receivers in (("global", len(pollers)), ("private", 1))
+        },
+        "errors": dict(stats.errors),
+        "error_count": sum(stats.errors.values()),
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# uvicorn u privremenom folderu, pa baza (./chat.db) krece prazna
+def _start_server(workers: int):
+    port = _free_port()
+    workdir = tempfile.mkdtemp(prefix="chat-load-")
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": app_dir}
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=open(os.path.join(workdir, "server.log"), "wb"),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server se ugasio, log: {workdir}/server.log")
+        try:
+            httpx.get(base_url + "/generate-username", timeout=1)
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server se nije pokrenuo na vrijeme")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url", default=None, help="bez ovoga se pokrece lokalni uvicorn"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="uvicorn workeri lokalnog servera"
+    )
+    parser.add_argument("--pollers", type=int, default=50)
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument("--global-senders", type=int, default=5)
+    parser.add_argument(
+        "--send-rate", type=float, default=10, help="poruka u sekundi ukupno"
+    )
+    parser.add_argument("--global-share", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=30, help="sekundi")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--output", default=None, help="fajl za JSON izvjestaj")
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = _start_server(args.workers)
+    try:
+        report = asyncio.run(run(args, base_url.rstrip("/")))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    data = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    else:
+        print(data.decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from threading import Lock
+from models.chat import chat_pair_key
+
+"""
+imenik chatova u memoriji: chat_id -> (user1_id, user2_id) i par usera -> chat_id
+ucesnici chata se nikad ne mijenjaju, pa unos nikad ne zastarijeva
+puni se na zahtjev (kad chat prvi put procitamo iz baze ili ga kreiramo),
+a najdavnije koristeni chatovi se izbacuju (LRU) kad ih ima vise od MAX_CACHED_CHAT_INFO
+"""
+
+MAX_CACHED_CHAT_INFO = 10000
+
+_participants = OrderedDict()  # chat_id -> (user1_id, user2_id)
+_by_pair = {}  # pair_key -> chat_id
+_chats_lock = Lock()
+
+
+def remember_chat(chat_id: int, user1_id: int, user2_id: int):
+    with _chats_lock:
+        if chat_id in _participants:
+            _participants.move_to_end(chat_id)
+            return
+        _participants[chat_id] = (user1_id, user2_id)
+        _by_pair[chat_pair_key(user1_id, user2_id)] = chat_id
+        if len(_participants) > MAX_CACHED_CHAT_INFO:
+            _, (old_user1_id, old_user2_id) = _participants.popitem(last=False)
+            _by_pair.pop(chat_pair_key(old_user1_id, old_user2_id), None)
+
+
+# (user1_id, user2_id) ili None ako chat nije u cacheu
+def get_participants(chat_id: int):
+    with _chats_lock:
+        participants = _participants.get(chat_id)
+        if participants is not None:
+            _participants.move_to_end(chat_id)
+        return participants
+
+
+# id chata izmedju dva usera ili None ako nije u cacheu
+def get_chat_id(user_a_id: int, user_b_id: int):
+    with _chats_lock:
+        chat_id = _by_pair.get(chat_pair_key(user_a_id, user_b_id))
+        if chat_id is not None:
+            _participants.move_to_end(chat_id)
+        return chat_id
@@ -1,12 +1,15 @@
-from collections import (
-    deque,
-)  # djeluje kao rolling buffer, automatski se rjesava najstarijih poruka kada dosegne limit
+from array import array
+from collections import deque
 from threading import Lock, Thread
 from models.message import Message
-from datetime import datetime, timezone, timedelta
+import asyncio
 import heapq
+import os
+import tempfile
 import time
-from helper import serialize_message
+from helper import CachedMessage, set_etag_prefix
+from metrics import TimedLock
+from cache.cache_shared import SharedMessageRing, SharedCursorStore
 
 """
 The Lock is used to prevent concurrent access to shared data, and with is a construct that handles entering and exiting contexts, like acquiring and releasing the lock. "with" ensures that recources are cleaned up properly when the block ends, even if an exception occurs.
@@ -14,61 +17,391 @@ The Lock is used to prevent concurrent access to shared data, and with is a cons
 If one thread is inside a "with lock: block", other threads trying to acquire the same lock will wait until it's released. This prevents race conditions, e.g., two threads appending to message_cache at the same time, which could corrupt the deque.
 """
 
-MAX_CACHE_SIZE = 1000  # max broj poruka koje cuvamo u memoriji
-message_cache = deque(
-    maxlen=MAX_CACHE_SIZE
-)  # najstarije automatski se automatski brisu
-message_cache_lock = Lock()
+MAX_CACHE_SIZE = 1700  # max broj poruka koje cuvamo u memoriji (~270 B po poruci)
+LATE_BUFFER_SIZE = 100  # koliko "zakasnjelih" upisa pamtimo (vidi MessageRing.append)
 
-# svaku novu poruku odmah dodajemo u cache
+"""
+gdje zivi globalni cache (poruke i kursori citanja):
+- "memory": u procesu, dovoljno za jedan uvicorn worker
+- "mmap": u fajlu GLOBAL_CACHE_PATH koji mapiraju svi workeri (vidi cache_shared.py),
+  pa poll u bilo kojem workeru vidi sve poruke i isti kursor usera
+"""
+GLOBAL_CACHE = os.environ.get("GLOBAL_CACHE", "memory")  # "memory" ili "mmap"
+GLOBAL_CACHE_PATH = os.environ.get(
+    "GLOBAL_CACHE_PATH",
+    os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "chat-global-cache",
+    ),
+)
+GLOBAL_CACHE_DATA_SIZE = MAX_CACHE_SIZE * 1024  # bajtova za JSON poruka u mmap fajlu
+SHARED_SEQ_CHECK_INTERVAL = 0.05  # s, koliko brzo long-poll vidi upis iz drugog workera
+
+
+"""
+rolling buffer fiksne velicine, poruke su uvijek sortirane po id-u
+kada se napuni, nova poruka prepisuje najstariju (kao deque sa maxlen)
+posto su id-ovi monotoni, prvu neprocitanu poruku nalazimo binarnom pretragom u O(logn),
+a poll kopira samo rep buffera, pa cijena ne zavisi od MAX_CACHE_SIZE
+
+svaki upis dobija i redni broj (seq) u trenutku dodavanja u cache
+poruka cija je transakcija commitovana kasnije od poruke s vecim id-om (npr. sistemska poruka iz druge niti)
+upada iza repa - takve poruke pamtimo u _late, pa ih korisnik dobija po seq-u, bez poredjenja timestampova
+kad se _late napuni, seq izbacenog unosa pamtimo u late_dropped_seq: kursor stariji od njega
+ne moze se osloniti na _late, pa se zakasnjele poruke traze po seq-u kroz cijeli buffer
+isto tako evicted_seq: kursor stariji od najnovije izbacene poruke cache ne pokriva (poll ide u bazu)
+"""
+
+
+class MessageRing:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._ids = array("q", [0]) * capacity  # id-ovi kao int64, bez int objekata
+        self._seqs = array("q", [0]) * capacity  # seq upisa svake poruke
+        self._items = [None] * capacity
+        self._start = 0  # fizicki indeks najstarije poruke
+        self._size = 0
+        self.seq = 0  # redni broj zadnjeg upisa
+        self.last_append_at = time.monotonic()  # za preporuku intervala pollanja
+        self._late = deque()  # (seq, poruka), najvise LATE_BUFFER_SIZE
+        self.late_dropped_seq = 0  # seq zadnjeg unosa izbacenog iz _late
+        self.evicted_seq = 0  # najveci seq poruke izbacene iz buffera
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._items[(self._start + i) % self.capacity]
+
+    def _pos(self, i: int):
+        return (self._start + i) % self.capacity
+
+    def first_id(self):
+        return self._ids[self._start] if self._size else None
+
+    def last_id(self):
+        return self._ids[self._pos(self._size - 1)] if self._size else None
+
+    def clear(self):
+        self._items = [None] * self.capacity
+        self._start = self._size = 0
+        self._late.clear()
+        self.evicted_seq = self.seq
+
+    def append(self, msg: CachedMessage):
+        self.seq += 1
+        self.last_append_at = time.monotonic()
+        if self._size == self.capacity:
+            # izbacujemo najstariju
+            self.evicted_seq = max(self.evicted_seq, self._seqs[self._start])
+            self._items[self._start] = None
+            self._start = (self._start + 1) % self.capacity
+            self._size -= 1
+
+        i = self._size
+        self._size += 1
+        # poruka je skoro uvijek najnovija, inace je pomjeramo unazad do njenog mjesta
+        while i > 0 and self._ids[self._pos(i - 1)] > msg.id:
+            prev = self._pos(i - 1)
+            self._ids[self._pos(i)] = self._ids[prev]
+            self._seqs[self._pos(i)] = self._seqs[prev]
+            self._items[self._pos(i)] = self._items[prev]
+            i -= 1
+        self._ids[self._pos(i)] = msg.id
+        self._seqs[self._pos(i)] = self.seq
+        self._items[self._pos(i)] = msg
+
+        if i < self._size - 1:
+            if len(self._late) == LATE_BUFFER_SIZE:
+                self.late_dropped_seq = self._late.popleft()[0]
+            self._late.append((self.seq, msg))
+        return self.seq
+
+    # logicki indeks prve poruke sa id > msg_id
+    def bisect_after(self, msg_id: int):
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ids[self._pos(mid)] <= msg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def messages_after(self, msg_id: int):
+        return [
+            self._items[self._pos(i)]
+            for i in range(self.bisect_after(msg_id), self._size)
+        ]
+
+    # zakasnjele poruke koje korisnik sa kursorom (msg_id, seq) nije vidio
+    def late_after(self, msg_id: int, seq: int):
+        if seq < self.late_dropped_seq:
+            # _late vise nema sve upise nakon seq
+            return [
+                self._items[self._pos(i)]
+                for i in range(self.bisect_after(msg_id))
+                if self._seqs[self._pos(i)] > seq
+            ]
+        late = []
+        for s, m in reversed(self._late):
+            if s <= seq:
+                break
+            if m.id <= msg_id:
+                late.append(m)
+        late.reverse()
+        return late
+
+    # sve sto korisnik sa kursorom (msg_id, seq) nije vidio,
+    # ili None ako su neke od tih poruka vec izbacene iz buffera
+    def unseen(self, msg_id: int, seq: int):
+        if not self._size or msg_id < self.first_id() or seq < self.evicted_seq:
+            return None
+        return self.late_after(msg_id, seq) + self.messages_after(msg_id)
+
+
+if GLOBAL_CACHE == "mmap":
+    message_cache = SharedMessageRing(
+        GLOBAL_CACHE_PATH, MAX_CACHE_SIZE, GLOBAL_CACHE_DATA_SIZE, LATE_BUFFER_SIZE
+    )
+    message_cache_lock = TimedLock("global_message_cache", message_cache.lock)
+    set_etag_prefix(message_cache.etag_prefix)
+else:
+    message_cache = MessageRing(MAX_CACHE_SIZE)
+    message_cache_lock = TimedLock("global_message_cache")
+
+
+# svaku novu poruku odmah dodajemo u cache, vraca redni broj upisa
 def add_message_to_cache(msg: Message):
-    serialized_msg = serialize_message(msg)
+    cached = CachedMessage(msg)
+    with message_cache_lock:
+        seq = message_cache.append(cached)
+    notify_new_message()
+    return seq
+
+
+# puni prazan cache pri startu (poruke sortirane po id), bez budjenja long-poll waitera
+# dijeljeni cache je mozda vec napunio drugi worker
+def restore_messages(cached: list):
+    with message_cache_lock:
+        if message_cache:
+            return
+        for m in cached:
+            message_cache.append(m)
+
+
+# dijeljeni cache prezivi restart servera, a baza je u medjuvremenu mogla biti zamijenjena
+def drop_stale_cache(max_message_id: int):
+    with message_cache_lock:
+        if message_cache and message_cache.last_id() > max_message_id:
+            message_cache.clear()
+            cursor_store.clear()
+
+
+def cached_messages():
     with message_cache_lock:
-        message_cache.append(serialized_msg)
+        return list(message_cache)
+
+
+# serializirane poruke iz cachea nakon msg_id (bez fallbacka na bazu)
+# prazna lista ako dijeljeni cache vise nema sve te poruke
+def messages_after(msg_id: int):
+    with message_cache_lock:
+        cached = message_cache.messages_after(msg_id) or []
+        return [m.to_dict() for m in cached]
+
+
+def latest_seq():
+    # bez locka, citanje jednog int atributa je atomicno
+    return message_cache.seq
+
+
+def last_message_at():
+    return message_cache.last_append_at
+
+
+"""
+long-poll: request koji nema novih poruka ceka na zajednicki future umjesto da odmah vrati prazan odgovor
+svi koji cekaju dijele jedan future po event loopu, pa ih add_message_to_cache budi sve odjednom (jedan prolaz)
+cekanje je asyncio await, tako da idle waiter ne zauzima nit iz threadpoola
+"""
+_new_message_waiters = {}  # event loop -> future
+_new_message_waiters_lock = Lock()
+
+
+def _new_message_future():
+    loop = asyncio.get_running_loop()
+    with _new_message_waiters_lock:
+        fut = _new_message_waiters.get(loop)
+        if fut is None or fut.done():
+            fut = loop.create_future()
+            _new_message_waiters[loop] = fut
+        return fut
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+# moze se pozvati iz bilo koje niti (sync rute se izvrsavaju u threadpoolu)
+def notify_new_message():
+    global _new_message_waiters
+    with _new_message_waiters_lock:
+        waiters = _new_message_waiters
+        _new_message_waiters = {}
+    for loop, fut in waiters.items():
+        try:
+            loop.call_soon_threadsafe(_wake, fut)
+        except RuntimeError:
+            pass  # loop je vec zatvoren
+
+
+# vraca True ako je u cache dodana poruka nakon upisa after_seq, False ako je istekao timeout
+async def wait_for_new_message(after_seq: int, timeout: float):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        # future uzimamo prije provjere, da ne propustimo poruku dodanu izmedju provjere i cekanja
+        fut = _new_message_future()
+        if latest_seq() > after_seq:
+            return True
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), remaining)
+        except asyncio.TimeoutError:
+            return False
 
 
-# userima dobavljamo samo poruke koje nisu stigli procitati
-# moramo pamtiti dokle je svaki user dosao u citanju poruke
-last_seen_msg = (
-    {}
-)  # mapa user_id -> (index zadnje procitane poruke, zadnji timestamp aktivnosti usera)
-last_seen_msg_lock = Lock()
 """
-periodnicno cistiti neaktivne usere
-min-heap vrijednosti (expiry_time, user_id) radi efikasnosti 
-umjesto da idemo O(n) kroz usere, min-heap nam omogucava sve akcije u O(logn) vremenu
-skalabilno, nije potrebno pristupati bazi
+kursori citanja: dokle je koji user stigao u globalnom chatu, user_id -> (id zadnje procitane poruke, seq)
+- tvrda granica MAX_CURSORS: kad se napuni, izbacujemo kursor kojem najprije istice TTL
+- kursor istice CURSOR_TTL sekundi nakon zadnjeg polla (nit u pozadini + usput pri upisu)
+- min-heap (expires_at, user_id) umjesto prolaska kroz sve usere; svaki poll dodaje novi unos,
+  a stari unosi istog usera se ne traze u heapu nego preskacu kad dodju na vrh (lazy deletion)
+- kad heap naraste na HEAP_COMPACT_RATIO puta broj kursora, pravimo ga ponovo samo od vazecih unosa
+memorija ostaje ogranicena bez obzira koliko anonimnih usera prodje kroz chat
 """
 
+MAX_CURSORS = 100000
+CURSOR_TTL = 300  # s
+CURSOR_CLEANUP_INTERVAL = 15  # s
+HEAP_COMPACT_RATIO = 2
+
+
+class CursorStore:
+    def __init__(self, max_size: int = MAX_CURSORS, ttl: float = CURSOR_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cursors = {}  # user_id -> (last_id, last_seq, expires_at)
+        self._heap = []  # (expires_at, user_id), moze sadrzavati zastarjele unose
+        self._lock = Lock()
+        self.expired = 0  # izbaceni jer im je istekao TTL
+        self.evicted = 0  # izbaceni zbog MAX_CURSORS
+
+    def __len__(self):
+        return len(self._cursors)
+
+    # (last_id, last_seq) ili None ako user nema kursor
+    def get(self, user_id: int):
+        with self._lock:
+            cursor = self._cursors.get(user_id)
+        if cursor is None:
+            return None
+        return cursor[0], cursor[1]
+
+    def set(self, user_id: int, last_id: int, last_seq: int):
+        with self._lock:
+            self._put(user_id, last_id, last_seq)
+
+    # mora se pozvati pod self._lock
+    def _put(self, user_id: int, last_id: int, last_seq: int):
+        now = time.monotonic()
+        expires_at = now + self.ttl
+        self._cursors[user_id] = (last_id, last_seq, expires_at)
+        heapq.heappush(self._heap, (expires_at, user_id))
+        self._expire(now)
+        while len(self._cursors) > self.max_size:
+            self._pop_earliest()
+            self.evicted += 1
+        if len(self._heap) > HEAP_COMPACT_RATIO * len(self._cursors) + 64:
+            self._heap = [(c[2], uid) for uid, c in self._cursors.items()]
+            heapq.heapify(self._heap)
+
+    # unos iz heapa vazi samo ako je i dalje zadnji rok tog usera
+    def _is_current(self, expires_at: float, user_id: int):
+        cursor = self._cursors.get(user_id)
+        return cursor is not None and cursor[2] == expires_at
 
-# ovaj metod "ciscenja" nam osigurava da last_seen_msg ostane relativno mala struktura
-expiry_heap = []  # (expiry_time, user_id)
-expiry_lock = Lock()  # dijeljena struktura, pa nam treba lock
+    def _pop_earliest(self):
+        while self._heap:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._is_current(expires_at, user_id):
+                del self._cursors[user_id]
+                return
 
+    def _expire(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._is_current(expires_at, user_id):
+                del self._cursors[user_id]
+                self.expired += 1
 
-# stavljamo expirty na 5 minuta (300s)
-# poziva se na svaku aktivnost usera
-def update_expiry_heap(user_id, last_active):
-    expiry = last_active + timedelta(seconds=300)
-    with expiry_lock:
-        heapq.heappush(expiry_heap, (expiry, user_id))
+    def expire(self):
+        with self._lock:
+            self._expire(time.monotonic())
 
+    def clear(self):
+        with self._lock:
+            self._cursors.clear()
+            self._heap = []
 
-# skeniramo sve usere svakih 15s
-# tehnicki user postaje neaktivan ukoliko ne se poll ne pozove unutar 10s,
-# ali sigurnosti radi ostavljamo razmak jos 5s
-def cleanup_inactive_users():
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._cursors),
+                "heap_size": len(self._heap),
+                "max_size": self.max_size,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+if GLOBAL_CACHE == "mmap":
+    cursor_store = SharedCursorStore(
+        GLOBAL_CACHE_PATH + ".cursors",
+        MAX_CURSORS,
+        CURSOR_TTL,
+        CURSOR_CLEANUP_INTERVAL,
+    )
+else:
+    cursor_store = CursorStore()
+
+
+def cleanup_expired_cursors():
     while True:
-        time.sleep(15)
-        now = datetime.now(timezone.utc)
-        with expiry_lock:
-            while expiry_heap:
-                next_expiry, user_id = expiry_heap[0]
-                if next_expiry > now:
-                    break  # korisnik jos uvijek aktivan
-                heapq.heappop(expiry_heap)
-                last_seen_msg.pop(user_id, None)
-
-
-# pokrecemo nit u pozadini
-Thread(target=cleanup_inactive_users, daemon=True).start()
+        time.sleep(CURSOR_CLEANUP_INTERVAL)
+        cursor_store.expire()
+
+
+# upis iz drugog workera ne budi nase long-poll waitere, pa pratimo zajednicki seq
+def watch_shared_seq():
+    seen = latest_seq()
+    while True:
+        time.sleep(SHARED_SEQ_CHECK_INTERVAL)
+        seq = latest_seq()
+        if seq != seen:
+            seen = seq
+            notify_new_message()
+
+
+# pokrecemo niti u pozadini
+Thread(target=cleanup_expired_cursors, daemon=True).start()
+if GLOBAL_CACHE == "mmap":
+    Thread(target=watch_shared_seq, daemon=True).start()
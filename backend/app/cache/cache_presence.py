@@ -0,0 +1,147 @@
+from threading import Lock, Thread
+from datetime import datetime, timezone
+from sqlalchemy import update, bindparam
+from database import SessionLocal
+from models.user import User
+from helper import content_version
+from ws_broker import WS_BROKER
+import time
+
+"""
+prisutnost usera u memoriji umjesto SELECT + UPDATE + COMMIT na svaki poll /users/active
+- heartbeat samo upisuje vrijeme u mapu
+- spisak aktivnih se racuna najvise jednom u ACTIVE_LIST_TTL i isti spisak dobijaju svi koji pitaju u tom prozoru
+- User.last_active se upisuje u bazu periodicno, jednom transakcijom za sve usere koji su se javili
+- sa vise workera (WS_BROKER=unix) svaki worker heartbeate skupljene od zadnjeg slanja salje ostalima
+  preko brokera (crud/global_chat.py), pa svaki worker ima isti spisak aktivnih
+"""
+
+ACTIVE_WINDOW = 11  # s, polling radi svakih 5s-10s
+ACTIVE_LIST_TTL = 1  # s
+FLUSH_INTERVAL = 10  # s
+FORGET_AFTER = 300  # s, usere koji se dugo nisu javili brisemo iz mape
+
+_presence = {}  # user_id -> (username, monotonic vrijeme zadnjeg heartbeata)
+_dirty = {}  # user_id -> last_active (UTC), jos nije upisano u bazu
+_presence_lock = Lock()
+PRESENCE_FAN_OUT = WS_BROKER != "inprocess"
+_outgoing = (
+    {}
+)  # user_id -> username, heartbeati koje jos nismo poslali ostalim workerima
+
+_active_list = []
+_active_list_at = None
+_active_version = content_version([])  # hash spiska, mijenja se kad se spisak promijeni
+_active_changed_at = time.monotonic()
+
+
+def heartbeat(user_id: int, username: str):
+    with _presence_lock:
+        _presence[user_id] = (username, time.monotonic())
+        _dirty[user_id] = datetime.now(timezone.utc)
+        if PRESENCE_FAN_OUT:
+            _outgoing[user_id] = username
+
+
+# heartbeat za usera kojeg vec znamo, vraca False ako username nije poznat
+def touch(user_id: int):
+    with _presence_lock:
+        entry = _presence.get(user_id)
+        if entry is None:
+            return False
+        _presence[user_id] = (entry[0], time.monotonic())
+        _dirty[user_id] = datetime.now(timezone.utc)
+        if PRESENCE_FAN_OUT:
+            _outgoing[user_id] = entry[0]
+        return True
+
+
+# [(user_id, username)] javljeni od zadnjeg poziva, za slanje ostalim workerima
+def take_outgoing():
+    global _outgoing
+    with _presence_lock:
+        outgoing = _outgoing
+        _outgoing = {}
+    return list(outgoing.items())
+
+
+# heartbeati koje su primili drugi workeri; u bazu ih upisuje worker koji ih je primio
+def apply_remote(users):
+    now = time.monotonic()
+    with _presence_lock:
+        for user_id, username in users:
+            _presence[user_id] = (username, now)
+
+
+def list_active():
+    global _active_list, _active_list_at, _active_version, _active_changed_at
+    now = time.monotonic()
+    with _presence_lock:
+        if _active_list_at is not None and now - _active_list_at < ACTIVE_LIST_TTL:
+            return _active_list
+
+        active = []
+        for user_id, (username, seen_at) in list(_presence.items()):
+            age = now - seen_at
+            if age <= ACTIVE_WINDOW:
+                active.append((seen_at, user_id, username))
+            elif age > FORGET_AFTER:
+                del _presence[user_id]
+        active.sort(reverse=True)  # najskorije aktivni prvi
+
+        active_list = [{"id": uid, "username": name} for _, uid, name in active]
+        if active_list != _active_list:
+            _active_version = content_version(active_list)
+            _active_changed_at = now
+        _active_list = active_list
+        _active_list_at = now
+        return _active_list
+
+
+# (verzija spiska aktivnih, monotonic vrijeme zadnje promjene)
+def active_version():
+    list_active()  # osvjezava spisak ako je stariji od ACTIVE_LIST_TTL
+    with _presence_lock:
+        return _active_version, _active_changed_at
+
+
+# upisuje sve nakupljene heartbeate u bazu jednim UPDATE-om (executemany)
+def flush_to_db():
+    global _dirty
+    with _presence_lock:
+        pending = _dirty
+        _dirty = {}
+    if not pending:
+        return
+
+    db = SessionLocal()
+    try:
+        # core UPDATE, obrisani useri se tiho preskacu
+        stmt = (
+            update(User.__table__)
+            .where(User.__table__.c.id == bindparam("uid"))
+            .values(last_active=bindparam("ts"))
+        )
+        db.execute(stmt, [{"uid": uid, "ts": ts} for uid, ts in pending.items()])
+        db.commit()
+    except Exception:
+        # vracamo neupisane, pokusat cemo ponovo u iducem krugu
+        with _presence_lock:
+            for uid, ts in pending.items():
+                _dirty.setdefault(uid, ts)
+        raise
+    finally:
+        db.close()
+
+
+def flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush_to_db()
+        except Exception as e:
+            print("Greska pri upisu prisutnosti:", e)
+
+
+# pokrecemo nit u pozadini
+Thread(target=flush_periodically, daemon=True).start()
@@ -1,44 +1,186 @@
-from collections import deque
+from collections import OrderedDict, deque
 from threading import Lock
 from typing import List
 from models.message import Message
 from schemas.message import MessageOut
-from helper import serialize_message, deserialize_message
-
-MAX_PRIVATE_CHAT_CACHE = 1000
-
-message_cache = {}  # deque
-message_cache_lock = Lock()
+from helper import CachedMessage, deserialize_message
+from metrics import TimedLock
+
+MAX_PRIVATE_CHAT_CACHE = 1700  # max broj poruka po chatu (~260 B po poruci)
+CHAT_WARM_SIZE = 1000  # koliko zadnjih poruka ucitavamo iz baze kad chat postaje warm
+MAX_CACHED_CHATS = (
+    1000  # max broj chatova u cacheu, najdavnije koristeni se izbacuju (LRU)
+)
+
+
+"""
+write-through cache: svaka nova poruka se upisuje i u bazu i u cache
+sa vise workera, worker koji upise poruku je salje ostalima preko brokera (crud/private_chats.py),
+pa svaki worker ima iste poruke u svom cacheu
+chat postaje "warm" kada ga prvi put ucitamo iz baze (zadnjih CHAT_WARM_SIZE poruka),
+tek tada cache moze odgovarati na citanja historije, a nove poruke ga pune do MAX_PRIVATE_CHAT_CACHE
+poruke upisane prije nego je chat ucitan ostaju u cacheu i spajaju se sa onim iz baze,
+pa ne gubimo poruku commitovanu izmedju citanja iz baze i punjenja cachea
+"""
+
+
+class ChatCache:
+    def __init__(self):
+        self.messages = deque(maxlen=MAX_PRIVATE_CHAT_CACHE)  # sortirano po id
+        self.warm = False  # ucitana historija iz baze
+        self.complete = False  # cache sadrzi cijelu historiju chata
+
+    def add(self, cached: CachedMessage):
+        if len(self.messages) == self.messages.maxlen:
+            # najstarija ce biti izbacena, starije poruke ostaju samo u bazi
+            self.complete = False
+        if self.messages and cached.id <= self.messages[-1].id:
+            # rijetko, poruka commitovana nakon poruke sa vecim id-om (ili vec primljena)
+            for m in reversed(self.messages):
+                if m.id == cached.id:
+                    return
+                if m.id < cached.id:
+                    break
+            merged = sorted([*self.messages, cached], key=lambda m: m.id)
+            self.messages.clear()
+            self.messages.extend(merged)
+        else:
+            self.messages.append(cached)
+
+    def first_id(self):
+        return self.messages[0].id if self.messages else None
+
+    def covers_after(self, after_id: int):
+        if not self.warm:
+            return False
+        return self.complete or (bool(self.messages) and after_id >= self.first_id())
+
+
+message_cache = OrderedDict()  # chat_id -> ChatCache
+message_cache_lock = TimedLock("private_message_cache")
 
 # (user_id, chat_id) -> last_seen_message_id
 last_seen_msg = {}
 last_seen_msg_lock = Lock()
 
 
+# mora se pozvati pod message_cache_lock
 def _ensure_chat(chat_id: int):
-    exists = chat_id in message_cache
-    if not exists:
-        message_cache[chat_id] = deque(maxlen=MAX_PRIVATE_CHAT_CACHE)
+    chat = message_cache.get(chat_id)
+    if chat is None:
+        chat = message_cache[chat_id] = ChatCache()
+        if len(message_cache) > MAX_CACHED_CHATS:
+            message_cache.popitem(last=False)  # izbacujemo cijeli chat
+    else:
+        message_cache.move_to_end(chat_id)
+    return chat
 
 
 def add_message_to_cache(msg: Message):
     if msg.chat_id is None:
         return
-    serialized = serialize_message(msg)
+    add_cached_message(msg.chat_id, CachedMessage(msg))
+
+
+# poruka koju je upisao drugi worker (stize preko brokera, vec enkodirana)
+def add_cached_message(chat_id: int, cached: CachedMessage):
     with message_cache_lock:
-        _ensure_chat(msg.chat_id)
-        message_cache[msg.chat_id].append(serialized)
+        _ensure_chat(chat_id).add(cached)
 
 
-def get_new_messages(chat_id: int, after_id: int):
+# veza sa ostalim workerima je bila prekinuta: ne znamo koje upise smo propustili,
+# pa svaki chat ponovo postaje warm iz baze
+def drop_all_chats():
+    with message_cache_lock:
+        message_cache.clear()
+
+
+# puni cache porukama iz baze (najnovijih CHAT_WARM_SIZE, sortirano po id)
+# complete=True ako u bazi nema starijih poruka
+def warm_chat(chat_id: int, msgs: List[Message], complete: bool):
+    restore_chat(chat_id, [CachedMessage(m) for m in msgs], complete)
+
+
+# kao warm_chat, ali sa porukama koje su vec CachedMessage (npr. iz snapshota)
+def restore_chat(chat_id: int, cached: List[CachedMessage], complete: bool):
+    with message_cache_lock:
+        chat = _ensure_chat(chat_id)
+        if chat.warm:
+            return
+        written = list(chat.messages)
+        chat.messages.clear()
+        chat.warm = True
+        chat.complete = complete
+        for m in cached:
+            chat.add(m)
+        for m in written:
+            chat.add(m)
+
+
+# (chat_id, complete, poruke) za sve warm chatove, od najdavnije do najskorije koristenog
+def warm_chats():
     with message_cache_lock:
-        if chat_id not in message_cache:
-            return []
-        results: List[MessageOut] = []
-        for m in message_cache[chat_id]:
-            if m["id"] > after_id:
-                results.append(deserialize_message(m))
-        return results
+        return [
+            (chat_id, chat.complete, list(chat.messages))
+            for chat_id, chat in message_cache.items()
+            if chat.warm
+        ]
+
+
+def is_chat_warm(chat_id: int):
+    with message_cache_lock:
+        chat = message_cache.get(chat_id)
+        return chat is not None and chat.warm
+
+
+# poruke (CachedMessage) nakon after_id, ili None ako cache ne pokriva taj raspon
+def get_messages_after(chat_id: int, after_id: int):
+    with message_cache_lock:
+        chat = message_cache.get(chat_id)
+        if chat is None or not chat.covers_after(after_id):
+            return None
+        message_cache.move_to_end(chat_id)
+        # nove poruke su na kraju, idemo unazad do prve procitane
+        result = []
+        for m in reversed(chat.messages):
+            if m.id <= after_id:
+                break
+            result.append(m)
+        result.reverse()
+        return result
+
+
+# stranica od `limit` poruka prije before_id (None = najnovije), kao (poruke, ima_jos)
+# vraca None ako cache nema dovoljno poruka pa treba pitati bazu
+def get_messages_before(chat_id: int, before_id, limit: int):
+    with message_cache_lock:
+        chat = message_cache.get(chat_id)
+        if chat is None or not chat.warm:
+            return None
+        message_cache.move_to_end(chat_id)
+        page = []
+        for m in reversed(chat.messages):
+            if before_id is not None and m.id >= before_id:
+                continue
+            page.append(m)
+            if len(page) > limit:
+                break
+        if len(page) <= limit and not chat.complete:
+            return None
+        has_more = len(page) > limit
+        page = page[:limit]
+        page.reverse()
+        return page, has_more
+
+
+def get_new_messages(chat_id: int, after_id: int):
+    cached = get_messages_after(chat_id, after_id)
+    if cached is None:
+        return []
+    results: List[MessageOut] = []
+    for m in cached:
+        results.append(deserialize_message(m.to_dict()))
+    return results
 
 
 def set_last_seen(user_id: int, chat_id: int, last_msg_id: int):
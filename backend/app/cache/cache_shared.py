@@ -0,0 +1,502 @@
+import fcntl
+import mmap
+import os
+import time
+from threading import Lock
+from helper import CachedMessage
+
+"""
+globalni cache u mmap fajlu (GLOBAL_CACHE=mmap), isti za sve uvicorn workere na masini
+svaki worker mapira isti fajl (najbolje u /dev/shm, pa ostaje u RAM-u), pa poll u bilo kojem
+workeru vidi sve poruke, bez obzira koji worker je primio POST, i bez upita u bazu
+
+- SharedMessageRing: isti interfejs kao MessageRing (cache_global.py)
+  * slotovi fiksne velicine (id, seq, pozicija, duzina), sortirani po id-u
+  * JSON bajtovi poruka se pisu redom u kruzni bafer podataka (DATA_SIZE), nova poruka
+    prepisuje najstarije podatke, a njihovi slotovi se izbacuju
+  * zakasnjela poruka (id manji od zadnjeg) se pomjera unazad do svog mjesta kao u MessageRing,
+    a (seq, id) pamtimo u late indexu; slot ciji su podaci vec prepisani citanje prepoznaje
+    po poziciji, pa takav poll ide u bazu
+  * seq (redni broj upisa) je u zaglavlju, zajednicki za sve workere
+- SharedCursorStore: isti interfejs kao CursorStore, kursori u hash tabeli (linearno probanje)
+  * istekle kursore brise nit za ciscenje, po SWEEP_BATCH mjesta pod lockom
+  * brisanje pomjera kursore iz istog niza unazad (backward shift), pa nema obrisanih mjesta
+    koja produzavaju probanje i tabelu nikad ne treba kompaktirati
+  * kad je tabela puna, upis pregleda EVICT_SAMPLE zivih kursora od rotirajuceg indeksa
+    i izbacuje istekle, ili onaj kojem najprije istice TTL, pa upis ne prolazi cijelu tabelu
+
+pristup stitimo sa FileLock: Lock za niti unutar procesa + flock za ostale procese
+sve je u int64 kolonama (memoryview.cast("q")), pa se citanje i pisanje svodi na indexiranje
+"""
+
+MAGIC = 0x43484154524E4733  # "CHATRNG3"
+CURSORS_MAGIC = 0x4348415443555233  # "CHATCUR3"
+EMPTY = 0  # zato user_id mora biti > 0
+SWEEP_BATCH = 4096  # mjesta tabele po jednom uzimanju locka pri ciscenju
+EVICT_SAMPLE = 32  # zivih kursora koje pregleda upis u punu tabelu
+
+# zaglavlje ringa (indexi u int64 nizu)
+(
+    H_MAGIC,
+    H_CAPACITY,
+    H_DATA_SIZE,
+    H_LATE_CAPACITY,
+    H_START,
+    H_SIZE,
+    H_SEQ,
+    H_WRITE_POS,
+    H_LATE_START,
+    H_LATE_SIZE,
+    H_LAST_APPEND_NS,
+    H_EVICTED_SEQ,
+    H_LATE_DROPPED_SEQ,
+    H_ETAG_PREFIX,
+) = range(14)
+RING_HEADER_FIELDS = 16
+
+# zaglavlje tabele kursora
+(
+    C_MAGIC,
+    C_TABLE_SIZE,
+    C_MAX_SIZE,
+    C_SIZE,
+    C_EXPIRED,
+    C_EVICTED,
+    C_LAST_CLEANUP_NS,
+    C_EVICT_POS,
+) = range(8)
+CURSOR_HEADER_FIELDS = 16
+
+
+class FileLock:
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._lock = Lock()  # flock na istom fd-u ne iskljucuje niti istog procesa
+
+    def acquire(self):
+        self._lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+# otvara (i po potrebi inicijalizira) fajl, vraca (fd, mmap)
+# fajl se pravi ispocetka ako ne postoji ili je napravljen sa drugim parametrima
+# init: polja zaglavlja koja se upisuju samo kad se fajl pravi (ne provjeravaju se)
+def _open_shared(path: str, size: int, params: dict, init: dict = None):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        valid = os.fstat(fd).st_size == size
+        if valid:
+            with mmap.mmap(fd, size) as mm:
+                header = memoryview(mm)[: 8 * len(params)].cast("q")
+                valid = all(header[i] == v for i, v in params.items())
+                header.release()
+        if not valid:
+            os.ftruncate(fd, 0)  # nule u cijelom fajlu
+            os.ftruncate(fd, size)
+            fields = {**params, **(init or {})}
+            with mmap.mmap(fd, size) as mm:
+                header = memoryview(mm)[: 8 * (max(fields) + 1)].cast("q")
+                for i, v in fields.items():
+                    header[i] = v
+                header.release()
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    return fd, mmap.mmap(fd, size)
+
+
+def _column(mm, offset: int, count: int):
+    return memoryview(mm)[offset : offset + 8 * count].cast("q")
+
+
+class SharedMessageRing:
+    def __init__(self, path: str, capacity: int, data_size: int, late_capacity: int):
+        self.capacity = capacity
+        self.data_size = data_size
+        self.late_capacity = late_capacity
+        offset = 8 * RING_HEADER_FIELDS
+        columns = []
+        for count in (capacity,) * 4 + (late_capacity,) * 2:
+            columns.append((offset, count))
+            offset += 8 * count
+        self._data_offset = offset
+        self._fd, self._mm = _open_shared(
+            path,
+            offset + data_size,
+            {
+                H_MAGIC: MAGIC,
+                H_CAPACITY: capacity,
+                H_DATA_SIZE: data_size,
+                H_LATE_CAPACITY: late_capacity,
+            },
+            {H_ETAG_PREFIX: int.from_bytes(os.urandom(4), "big")},
+        )
+        self.lock = FileLock(self._fd)
+        self._header = _column(self._mm, 0, RING_HEADER_FIELDS)
+        (
+            self._ids,
+            self._seqs,
+            self._data_pos,
+            self._lengths,
+            self._late_seq,
+            self._late_ids,
+        ) = [_column(self._mm, o, c) for o, c in columns]
+
+    # bez locka, citanje jednog int64 iz zaglavlja
+    @property
+    def seq(self):
+        return self._header[H_SEQ]
+
+    # prefiks ETag-a zajednicki za sve workere (helper.set_etag_prefix)
+    @property
+    def etag_prefix(self):
+        return format(self._header[H_ETAG_PREFIX], "08x")
+
+    @property
+    def last_append_at(self):
+        return self._header[H_LAST_APPEND_NS] / 1e9
+
+    @property
+    def evicted_seq(self):
+        return self._header[H_EVICTED_SEQ]
+
+    @property
+    def late_dropped_seq(self):
+        return self._header[H_LATE_DROPPED_SEQ]
+
+    def __len__(self):
+        return self._header[H_SIZE]
+
+    def __bool__(self):
+        return len(self) > 0
+
+    # poruke sortirane po id-u, bez slotova ciji su podaci prepisani
+    def __iter__(self):
+        for i in range(self._header[H_SIZE]):
+            msg = self._slot(i)
+            if msg is not None:
+                yield msg
+
+    def _pos(self, i: int):
+        return (self._header[H_START] + i) % self.capacity
+
+    def _late_index(self, i: int):
+        return (self._header[H_LATE_START] + i) % self.late_capacity
+
+    # poruka iz logickog slota i, ili None ako su njeni podaci vec prepisani
+    def _slot(self, i: int):
+        p = self._pos(i)
+        pos = self._data_pos[p]
+        if pos < self._header[H_WRITE_POS] - self.data_size:
+            return None
+        offset = self._data_offset + pos % self.data_size
+        wire = self._mm[offset : offset + self._lengths[p]]
+        return CachedMessage.from_wire(self._ids[p], wire)
+
+    # poruke iz logickih slotova, ili None ako neka vise nije u baferu
+    def _slots(self, indexes):
+        result = []
+        for i in indexes:
+            msg = self._slot(i)
+            if msg is None:
+                return None
+            result.append(msg)
+        return result
+
+    def first_id(self):
+        return self._ids[self._pos(0)] if self._header[H_SIZE] else None
+
+    def last_id(self):
+        size = self._header[H_SIZE]
+        return self._ids[self._pos(size - 1)] if size else None
+
+    def clear(self):
+        h = self._header
+        h[H_START] = h[H_SIZE] = h[H_LATE_START] = h[H_LATE_SIZE] = 0
+        h[H_EVICTED_SEQ] = h[H_SEQ]
+
+    def _evict_first(self):
+        h = self._header
+        h[H_EVICTED_SEQ] = max(h[H_EVICTED_SEQ], self._seqs[h[H_START]])
+        h[H_START] = (h[H_START] + 1) % self.capacity
+        h[H_SIZE] -= 1
+
+    def append(self, msg: CachedMessage):
+        h = self._header
+        h[H_SEQ] += 1
+        h[H_LAST_APPEND_NS] = time.monotonic_ns()
+        wire = msg.wire
+        length = len(wire)
+        if length > self.data_size:
+            # ne staje u bafer, praznimo cache pa poll ide u bazu dok se ne napuni ponovo
+            self.clear()
+            return h[H_SEQ]
+
+        # poruka se ne lomi preko kraja bafera, ostatak do kraja se preskace
+        pos = h[H_WRITE_POS]
+        offset = pos % self.data_size
+        if offset + length > self.data_size:
+            pos += self.data_size - offset
+            offset = 0
+        # izbacujemo najstarije slotove ciji ce podaci biti prepisani
+        # (slot iza zakasnjele poruke moze ostati, _slot ga tada ne cita)
+        threshold = pos + length - self.data_size
+        while h[H_SIZE] and self._data_pos[h[H_START]] < threshold:
+            self._evict_first()
+        start = self._data_offset + offset
+        self._mm[start : start + length] = wire
+        h[H_WRITE_POS] = pos + length
+
+        if h[H_SIZE] == self.capacity:
+            self._evict_first()
+        i = h[H_SIZE]
+        h[H_SIZE] += 1
+        # poruka je skoro uvijek najnovija, inace je pomjeramo unazad do njenog mjesta
+        while i > 0 and self._ids[self._pos(i - 1)] > msg.id:
+            prev, cur = self._pos(i - 1), self._pos(i)
+            self._ids[cur] = self._ids[prev]
+            self._seqs[cur] = self._seqs[prev]
+            self._data_pos[cur] = self._data_pos[prev]
+            self._lengths[cur] = self._lengths[prev]
+            i -= 1
+        p = self._pos(i)
+        self._ids[p] = msg.id
+        self._seqs[p] = h[H_SEQ]
+        self._data_pos[p] = pos
+        self._lengths[p] = length
+
+        if i < h[H_SIZE] - 1:
+            if h[H_LATE_SIZE] == self.late_capacity:
+                h[H_LATE_DROPPED_SEQ] = self._late_seq[h[H_LATE_START]]
+                h[H_LATE_START] = (h[H_LATE_START] + 1) % self.late_capacity
+                h[H_LATE_SIZE] -= 1
+            j = self._late_index(h[H_LATE_SIZE])
+            h[H_LATE_SIZE] += 1
+            self._late_seq[j] = h[H_SEQ]
+            self._late_ids[j] = msg.id
+        return h[H_SEQ]
+
+    # logicki indeks prve poruke sa id > msg_id
+    def bisect_after(self, msg_id: int):
+        lo, hi = 0, self._header[H_SIZE]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ids[self._pos(mid)] <= msg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # None ako neka od poruka vise nije u baferu
+    def messages_after(self, msg_id: int):
+        return self._slots(range(self.bisect_after(msg_id), self._header[H_SIZE]))
+
+    # zakasnjele poruke koje korisnik sa kursorom (msg_id, seq) nije vidio
+    def late_after(self, msg_id: int, seq: int):
+        h = self._header
+        if seq < h[H_LATE_DROPPED_SEQ]:
+            # late index vise nema sve upise nakon seq
+            end = self.bisect_after(msg_id)
+            return self._slots(
+                [i for i in range(end) if self._seqs[self._pos(i)] > seq]
+            )
+        indexes = []
+        for j in reversed(range(h[H_LATE_SIZE])):
+            k = self._late_index(j)
+            if self._late_seq[k] <= seq:
+                break
+            late_id = self._late_ids[k]
+            if late_id > msg_id:
+                continue
+            i = self.bisect_after(late_id) - 1
+            if i < 0 or self._ids[self._pos(i)] != late_id:
+                return None  # vec izbacena iz slotova
+            indexes.append(i)
+        indexes.reverse()
+        return self._slots(indexes)
+
+    # sve sto korisnik sa kursorom (msg_id, seq) nije vidio,
+    # ili None ako su neke od tih poruka vec izbacene iz bafera
+    def unseen(self, msg_id: int, seq: int):
+        h = self._header
+        if not h[H_SIZE] or msg_id < self.first_id() or seq < h[H_EVICTED_SEQ]:
+            return None
+        late = self.late_after(msg_id, seq)
+        tail = self.messages_after(msg_id)
+        if late is None or tail is None:
+            return None
+        return late + tail
+
+
+class SharedCursorStore:
+    def __init__(self, path: str, max_size: int, ttl: float, cleanup_interval: float):
+        self.max_size = max_size
+        self.ttl_ns = int(ttl * 1e9)
+        self.cleanup_interval_ns = int(cleanup_interval * 1e9)
+        # bar dvostruko vise mjesta od kursora, stepen dvojke
+        self.table_size = 1 << (2 * max_size - 1).bit_length()
+        offset = 8 * CURSOR_HEADER_FIELDS
+        self._fd, self._mm = _open_shared(
+            path,
+            offset + 32 * self.table_size,
+            {
+                C_MAGIC: CURSORS_MAGIC,
+                C_TABLE_SIZE: self.table_size,
+                C_MAX_SIZE: max_size,
+            },
+        )
+        self._lock = FileLock(self._fd)
+        self._header = _column(self._mm, 0, CURSOR_HEADER_FIELDS)
+        self._users, self._last_ids, self._last_seqs, self._expires = [
+            _column(self._mm, offset + 8 * self.table_size * k, self.table_size)
+            for k in range(4)
+        ]
+
+    def __len__(self):
+        return self._header[C_SIZE]
+
+    def _home(self, user_id: int):
+        return (user_id * 0x9E3779B1) & (self.table_size - 1)
+
+    # (indeks usera ili -1, prazno mjesto na kraju probanja)
+    def _find(self, user_id: int):
+        mask = self.table_size - 1
+        i = self._home(user_id)
+        while True:
+            uid = self._users[i]
+            if uid == user_id:
+                return i, -1
+            if uid == EMPTY:
+                return -1, i
+            i = (i + 1) & mask
+
+    # brisanje bez oznake obrisanog mjesta: kursore iz istog niza iza rupe pomjeramo u nju
+    # ako im je pocetno mjesto na ili prije rupe, pa probanje ne prolazi preko praznog mjesta
+    # cijena je duzina niza, a tabela je bar dvostruko veca od kursora pa su nizovi kratki
+    def _delete(self, i: int):
+        mask = self.table_size - 1
+        columns = (self._users, self._last_ids, self._last_seqs, self._expires)
+        self._header[C_SIZE] -= 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            uid = self._users[j]
+            if uid == EMPTY:
+                break
+            if (j - self._home(uid)) & mask >= (j - i) & mask:
+                for column in columns:
+                    column[i] = column[j]
+                i = j
+        self._users[i] = EMPTY
+
+    # (last_id, last_seq) ili None ako user nema kursor
+    def get(self, user_id: int):
+        if user_id <= 0:
+            return None  # EMPTY mjesto bi se procitalo kao kursor
+        with self._lock:
+            i, _ = self._find(user_id)
+            if i < 0:
+                return None
+            return self._last_ids[i], self._last_seqs[i]
+
+    def set(self, user_id: int, last_id: int, last_seq: int):
+        if user_id <= 0:
+            raise ValueError(f"user_id mora biti > 0, dobijeno {user_id}")
+        with self._lock:
+            now = time.monotonic_ns()
+            i, free = self._find(user_id)
+            if i < 0:
+                i = self._insert(user_id, free, now)
+            self._last_ids[i] = last_id
+            self._last_seqs[i] = last_seq
+            self._expires[i] = now + self.ttl_ns
+
+    # mora se pozvati pod self._lock, vraca indeks novog kursora
+    def _insert(self, user_id: int, free: int, now: int):
+        h = self._header
+        if h[C_SIZE] >= self.max_size:
+            self._evict_sampled(now)
+            _, free = self._find(user_id)  # brisanje je pomjerilo kursore
+        h[C_SIZE] += 1
+        self._users[free] = user_id
+        return free
+
+    # brise kursor usera (ako ga jos ima), mora se pozvati pod self._lock
+    def _delete_user(self, user_id: int):
+        i, _ = self._find(user_id)
+        if i >= 0:
+            self._delete(i)
+
+    # tabela puna aktivnih kursora: od EVICT_SAMPLE zivih kursora izbacujemo istekle,
+    # a ako nijedan nije istekao, onaj kojem najprije istice TTL
+    def _evict_sampled(self, now: int):
+        h = self._header
+        mask = self.table_size - 1
+        i = h[C_EVICT_POS]
+        sample = []
+        while len(sample) < EVICT_SAMPLE and len(sample) < h[C_SIZE]:
+            if self._users[i] != EMPTY:
+                sample.append((self._expires[i], self._users[i]))
+            i = (i + 1) & mask
+        h[C_EVICT_POS] = i
+        # brisemo po user_id, jer brisanje pomjera ostale kursore iz uzorka
+        expired = [uid for expires_at, uid in sample if expires_at <= now]
+        for uid in expired:
+            self._delete_user(uid)
+        h[C_EXPIRED] += len(expired)
+        if not expired:
+            self._delete_user(min(sample)[1])
+            h[C_EVICTED] += 1
+
+    # brise istekle kursore na mjestima [lo, hi)
+    def _expire_range(self, lo: int, hi: int, now: int):
+        users = self._users[lo:hi].tolist()
+        expires = self._expires[lo:hi].tolist()
+        expired = [
+            uid for k, uid in enumerate(users) if uid != EMPTY and expires[k] <= now
+        ]
+        for uid in expired:
+            self._delete_user(uid)
+        self._header[C_EXPIRED] += len(expired)
+
+    # zove je nit za ciscenje u svakom workeru, tabelu prolazi samo jedan od njih
+    # lock se uzima po SWEEP_BATCH mjesta, pa get/set ne cekaju cijeli prolaz
+    # (kursor koji brisanje pomjeri u vec prodjeni dio stize sljedeci prolaz)
+    def expire(self):
+        with self._lock:
+            now = time.monotonic_ns()
+            if now - self._header[C_LAST_CLEANUP_NS] < self.cleanup_interval_ns:
+                return
+            self._header[C_LAST_CLEANUP_NS] = now
+        for lo in range(0, self.table_size, SWEEP_BATCH):
+            with self._lock:
+                self._expire_range(lo, lo + SWEEP_BATCH, time.monotonic_ns())
+
+    def clear(self):
+        with self._lock:
+            offset = 8 * CURSOR_HEADER_FIELDS
+            self._mm[offset : offset + 8 * self.table_size] = bytes(8 * self.table_size)
+            self._header[C_SIZE] = 0
+
+    def stats(self):
+        with self._lock:
+            h = self._header
+            return {
+                "size": h[C_SIZE],
+                "table_size": self.table_size,
+                "max_size": self.max_size,
+                "expired": h[C_EXPIRED],
+                "evicted": h[C_EVICTED],
+            }
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from threading import Lock
+
+"""
+identitet usera u memoriji: user_id <-> username
+slanje poruke i heartbeat ne moraju pitati bazu ko je user, osim prvi put
+puni se na zahtjev i pri kreiranju usera, najdavnije koristeni se izbacuju (LRU)
+useri se nikad ne brisu niti mijenjaju username (nema takve rute ni upisa), pa unos ne treba
+brisati; ako se to ikad doda, ta ruta mora izbaciti usera i iz ovog cachea
+promasaji se ne pamte, pa novi user odmah postaje vidljiv
+"""
+
+MAX_CACHED_USERS = 10000
+
+_usernames = OrderedDict()  # user_id -> username
+_user_ids = {}  # username -> user_id
+_users_lock = Lock()
+
+
+def remember_user(user_id: int, username: str):
+    with _users_lock:
+        old_username = _usernames.get(user_id)
+        if old_username is not None and old_username != username:
+            _user_ids.pop(old_username, None)
+        _usernames[user_id] = username
+        _usernames.move_to_end(user_id)
+        _user_ids[username] = user_id
+        if len(_usernames) > MAX_CACHED_USERS:
+            _, old_username = _usernames.popitem(last=False)
+            _user_ids.pop(old_username, None)
+
+
+# username ili None ako user nije u cacheu
+def get_username(user_id: int):
+    with _users_lock:
+        username = _usernames.get(user_id)
+        if username is not None:
+            _usernames.move_to_end(user_id)
+        return username
+
+
+# user_id ili None ako user nije u cacheu
+def get_user_id(username: str):
+    with _users_lock:
+        user_id = _user_ids.get(username)
+        if user_id is not None:
+            _usernames.move_to_end(user_id)
+        return user_id
@@ -0,0 +1,154 @@
+import os
+import struct
+import time
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from models.chat import Chat
+from models.message import Message
+from helper import CachedMessage
+from cache import cache_global, cache_private
+from cache.cache_chats import remember_chat
+
+"""
+punjenje cacheova pri startu, da restartovan server odmah odgovara iz memorije
+- iz baze: zadnjih MAX_CACHE_SIZE globalnih poruka i WARM_PRIVATE_CHATS chatova sa najnovijim porukama
+- iz snapshota (ako je CACHE_SNAPSHOT_PATH postavljen): fajl koji se pise pri gasenju i cita jednim read-om
+
+snapshot vazi samo ako se najveci id poruke u bazi nije promijenio od gasenja,
+inace (npr. pad servera, drugi proces pisao u bazu) se ignorise i cache se puni iz baze
+
+format (little endian):
+  MAGIC, "<qI" (max id poruke u bazi, broj blokova)
+  blok: "<qBI" (chat_id, complete, broj poruka), 0 je globalni chat
+  poruka: "<qI" (id, duzina) + JSON bajtovi
+"""
+
+CACHE_SNAPSHOT_PATH = os.environ.get(
+    "CACHE_SNAPSHOT_PATH", ""
+)  # prazno = bez snapshota
+WARM_PRIVATE_CHATS = 100
+
+MAGIC = b"CHATSNAP1\n"
+_HEADER = struct.Struct("<qI")
+_BLOCK = struct.Struct("<qBI")
+_MESSAGE = struct.Struct("<qI")
+GLOBAL_BLOCK = 0
+
+
+def _max_message_id(db: Session):
+    return db.scalar(select(func.max(Message.id))) or 0
+
+
+def warm_from_db(db: Session):
+    if not cache_global.message_cache:
+        recent = db.scalars(
+            select(Message)
+            .where(Message.chat_id.is_(None))
+            .order_by(Message.id.desc())
+            .limit(cache_global.MAX_CACHE_SIZE)
+        ).all()
+        cache_global.restore_messages([CachedMessage(m) for m in reversed(recent)])
+
+    # najaktivniji chatovi = chatovi sa najnovijim porukama, najtopliji se ucitava zadnji (LRU)
+    hot = db.execute(
+        select(Message.chat_id, func.max(Message.id).label("last_id"))
+        .where(Message.chat_id.is_not(None))
+        .group_by(Message.chat_id)
+        .order_by(func.max(Message.id).desc())
+        .limit(WARM_PRIVATE_CHATS)
+    ).all()
+    for chat_id, _ in reversed(hot):
+        recent = db.scalars(
+            select(Message)
+            .where(Message.chat_id == chat_id)
+            .order_by(Message.id.desc())
+            .limit(cache_private.CHAT_WARM_SIZE + 1)
+        ).all()
+        complete = len(recent) <= cache_private.CHAT_WARM_SIZE
+        cache_private.warm_chat(
+            chat_id, list(reversed(recent[: cache_private.CHAT_WARM_SIZE])), complete
+        )
+
+    chat_ids = [chat_id for chat_id, _ in hot]
+    if chat_ids:
+        for chat in db.scalars(select(Chat).where(Chat.id.in_(chat_ids))):
+            remember_chat(chat.id, chat.user1_id, chat.user2_id)
+
+
+def _write_block(out, chat_id: int, complete: bool, messages):
+    out.append(_BLOCK.pack(chat_id, complete, len(messages)))
+    for m in messages:
+        out.append(_MESSAGE.pack(m.id, len(m.wire)))
+        out.append(m.wire)
+
+
+def save_snapshot(db: Session, path: str = CACHE_SNAPSHOT_PATH):
+    if not path:
+        return
+    chats = cache_private.warm_chats()
+    out = [MAGIC, _HEADER.pack(_max_message_id(db), len(chats) + 1)]
+    _write_block(out, GLOBAL_BLOCK, False, cache_global.cached_messages())
+    for chat_id, complete, messages in chats:
+        _write_block(out, chat_id, complete, messages)
+
+    # pisemo u privremeni fajl pa ga preimenujemo, da pad usred pisanja ne ostavi pola snapshota
+    # pid u imenu: sa vise workera svaki pise svoj snapshot pri gasenju
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(out))
+    os.replace(tmp_path, path)
+
+
+# vraca True ako je cache napunjen iz snapshota
+def load_snapshot(db: Session, path: str = CACHE_SNAPSHOT_PATH):
+    if not path or not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        return False
+    offset = len(MAGIC)
+    max_id, blocks = _HEADER.unpack_from(data, offset)
+    offset += _HEADER.size
+    if max_id != _max_message_id(db):
+        print("Snapshot cachea je zastario, cache se puni iz baze")
+        return False
+
+    chat_ids = []
+    for _ in range(blocks):
+        chat_id, complete, count = _BLOCK.unpack_from(data, offset)
+        offset += _BLOCK.size
+        messages = []
+        for _ in range(count):
+            msg_id, size = _MESSAGE.unpack_from(data, offset)
+            offset += _MESSAGE.size
+            messages.append(
+                CachedMessage.from_wire(msg_id, bytes(data[offset : offset + size]))
+            )
+            offset += size
+        if chat_id == GLOBAL_BLOCK:
+            if not cache_global.message_cache:
+                cache_global.restore_messages(messages)
+        else:
+            cache_private.restore_chat(chat_id, messages, bool(complete))
+            chat_ids.append(chat_id)
+
+    if chat_ids:
+        for chat in db.scalars(select(Chat).where(Chat.id.in_(chat_ids))):
+            remember_chat(chat.id, chat.user1_id, chat.user2_id)
+    return True
+
+
+def warm_caches(db: Session):
+    started = time.perf_counter()
+    # dijeljeni (mmap) cache moze biti od baze koja vise ne postoji
+    cache_global.drop_stale_cache(_max_message_id(db))
+    source = "snapshot"
+    if not load_snapshot(db):
+        source = "baza"
+        warm_from_db(db)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(
+        f"Cache napunjen ({source}): {len(cache_global.message_cache)} globalnih poruka, "
+        f"{len(cache_private.message_cache)} chatova, {elapsed:.1f} ms"
+    )
@@ -1,16 +1,68 @@
-from datetime import datetime, timezone, timedelta
-from sqlalchemy.orm import Session
+import asyncio
+from datetime import datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.message import Message, MessageType
 from models.user import User
-from schemas.message import MessageIn, MessageOut
+from schemas.message import MessageIn
 
 from cache.cache_global import (
     message_cache,
     message_cache_lock,
-    last_seen_msg,
+    cursor_store,
     add_message_to_cache,
+    wait_for_new_message,
+    latest_seq,
 )
-from helper import serialize_message, deserialize_message
+from helper import (
+    encode_message,
+    keyset_select,
+    keyset_page,
+    MAX_PAGE_SIZE,
+)
+from cache.cache_presence import (
+    heartbeat,
+    touch,
+    list_active,
+    take_outgoing,
+    apply_remote,
+    PRESENCE_FAN_OUT,
+)
+from cache.cache_users import (
+    remember_user,
+    get_username as get_cached_username,
+    get_user_id as get_cached_user_id,
+)
+from message_writer import message_writer
+from metrics import timed, increment
+from ws_manager import subscribe, publish
+
+PRESENCE_CHANNEL = "presence"
+PRESENCE_FAN_OUT_INTERVAL = 1  # s, kasnjenje je malo prema ACTIVE_WINDOW
+PRESENCE_FAN_OUT_BATCH = (
+    5000  # usera po poruci, da linija ostane daleko ispod MAX_LINE_SIZE
+)
+
+
+def _apply_presence(message: dict):
+    apply_remote(message["users"])
+
+
+# heartbeati propusteni dok je hub bio pao stizu sa iducim pollom tih usera
+subscribe(PRESENCE_CHANNEL, _apply_presence, lambda: None)
+
+
+# pokrece se u lifespanu, heartbeate ovog workera salje ostalima u intervalima
+async def fan_out_presence():
+    if not PRESENCE_FAN_OUT:
+        return
+    while True:
+        await asyncio.sleep(PRESENCE_FAN_OUT_INTERVAL)
+        users = take_outgoing()
+        for i in range(0, len(users), PRESENCE_FAN_OUT_BATCH):
+            await publish(
+                PRESENCE_CHANNEL, {"users": users[i : i + PRESENCE_FAN_OUT_BATCH]}
+            )
 
 
 def get_current_time():
@@ -26,127 +78,178 @@ def ensure_datetime(dt):
     return dt
 
 
-def create_user(db: Session, username: str) -> User:
+async def create_user(db: AsyncSession, username: str) -> User:
     user = User(username=username)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    remember_user(user.id, user.username)
     return user
 
 
-def create_system_join_message(db: Session, username: str):
+# id usera iz cachea identiteta, baza se pita samo za usera kojeg jos nismo vidjeli
+async def resolve_user_id(db: AsyncSession, username: str):
+    user_id = get_cached_user_id(username)
+    if user_id is None:
+        user = await db.scalar(select(User).where(User.username == username))
+        if user is None:
+            return None
+        remember_user(user.id, user.username)
+        user_id = user.id
+    return user_id
+
+
+async def resolve_username(db: AsyncSession, user_id: int):
+    if user_id is None:
+        return None
+    username = get_cached_username(user_id)
+    if username is None:
+        user = await db.get(User, user_id)
+        if user is None:
+            return None
+        remember_user(user.id, user.username)
+        username = user.username
+    return username
+
+
+# user_id i username iz poruke moraju pripadati istom useru
+async def is_valid_sender(db: AsyncSession, user_id: int, username: str):
+    return await resolve_username(db, user_id) == username
+
+
+# upis kroz writer + cache (+ kursor posiljaoca); poziva se ispod asyncio.shield jer je poruka
+# commitovana cim je writer upise, pa otkazan request (klijent prekinuo vezu) ne smije
+# ostaviti poruku u bazi a bez cachea
+async def _store_global_message(msg: Message, sender_id: int = None) -> Message:
+    msg = await message_writer.submit(msg)
+    seq = add_message_to_cache(msg)
+    if sender_id is None:
+        return msg
+
+    # posiljaocu se ova poruka oznacava kao procitana instantno
+    with message_cache_lock:
+        last_seen_msg_id, last_seen_seq = cursor_store.get(sender_id) or (0, 0)
+        if msg.id > last_seen_msg_id:
+            last_seen_msg_id = msg.id
+        # seq pomjeramo samo ako je korisnik prije ove poruke vidio sve upise
+        if last_seen_seq == seq - 1:
+            last_seen_seq = seq
+        cursor_store.set(sender_id, last_seen_msg_id, last_seen_seq)
+    return msg
+
+
+async def create_system_join_message(db: AsyncSession, username: str):
     system_msg = Message(
         content=f"{username} se pridružio chatu!",
         type=MessageType.SYSTEM,
         created_at=get_current_time(),
     )
-    db.add(system_msg)
-    db.commit()
-    db.refresh(system_msg)
-    add_message_to_cache(system_msg)
-    return system_msg
+    # otpustamo konekciju dok cekamo group commit (inace pool ostane bez konekcija)
+    await db.commit()
+    return await asyncio.shield(_store_global_message(system_msg))
 
 
-def mark_user_active(db: Session, user_id: int):
-    user = db.query(User).filter(User.id == user_id).first()
-    if user:
-        user.last_active = get_current_time()
-        db.commit()
+# heartbeat ide u memoriju (cache_presence), baza se azurira periodicno u batchu
+# username za usera kojeg presence jos ne zna dolazi iz cachea identiteta
+async def mark_user_active(db: AsyncSession, user_id: int):
+    if touch(user_id):
+        return
+    username = await resolve_username(db, user_id)
+    if username is not None:
+        heartbeat(user_id, username)
 
 
 # samo aktivni useri, odnosno aktivnost do 11s (jer polling radi svakih 5s-10s)
-def list_active_users(db: Session):
-    active_users = (
-        db.query(User)
-        .filter(User.last_active > (datetime.utcnow() - timedelta(seconds=11)))
-        .order_by(User.last_active.desc())
-        .all()
-    )
-
-    result = []
-    for u in active_users:
-        result.append({"id": u.id, "username": u.username})
-    return result
+def list_active_users():
+    return list_active()
 
 
-# cita iz globalnog cachea
-def poll_new_messages(db: Session, user_id: int):
+# cita iz globalnog cachea, poruke vraca kao vec enkodirane JSON bajtove
+@timed("poll_new_messages")
+async def poll_new_messages(db: AsyncSession, user_id: int):
     with message_cache_lock:
-        # ukoliko user nije u ovoj mapi, znaci da nije vidio nista poruka do sad
+        # ukoliko user nema kursor, znaci da nije vidio nista poruka do sad
         # (dobavljanje se vrsi od pocetka - indeksa 0)
-        last_seen_msg_id, last_active = last_seen_msg.get(
-            user_id, (0, get_current_time())
+        last_seen_msg_id, last_seen_seq = cursor_store.get(user_id) or (0, 0)
+
+        # binarna pretraga do prve neprocitane poruke, kopiramo samo rep
+        # + poruke upisane u cache nakon korisnikovog zadnjeg polla, a sa manjim id-om
+        new_cached = message_cache.unseen(last_seen_msg_id, last_seen_seq)
+        from_cache = new_cached is not None
+        if from_cache:
+            seq = message_cache.seq
+            if new_cached:
+                last_seen_msg_id = max(last_seen_msg_id, new_cached[-1].id)
+            result = [m.wire for m in new_cached]
+
+    increment("global_poll.cache_hit" if from_cache else "global_poll.db_fallback")
+    if not from_cache:
+        # ukoliko korisnik ima neprocitanih poruka koje nisu vise u cacheu...
+        # (lock ne drzimo dok cekamo bazu)
+        seq = latest_seq()
+        db_msgs = await db.scalars(
+            select(Message)
+            .where(Message.chat_id.is_(None), Message.id > last_seen_msg_id)
+            .order_by(Message.id.asc())
         )
+        result = []
+        for m in db_msgs:
+            result.append(encode_message(m))
+            last_seen_msg_id = max(last_seen_msg_id, m.id)
 
-        if message_cache:
-            first_cache_id = message_cache[0]["id"]  # prva poruka u cacheu
-        else:
-            # prazan cache
-            first_cache_id = -1
-
-        new_serialized = []
-
-        if message_cache and last_seen_msg_id >= first_cache_id:
-            # vracamo samo neprocitane poruke
-            # ok za relativno mal cache, npr. do 1000 poruke, efikasnost O(n)
-            # MessageType.SYSTEM moguce da imaju manji ID od last_seen_msg_id a da korisnik nije stigao procitati
-            for m in message_cache:
-                created_at = ensure_datetime(m["created_at"])
-                if (
-                    m["type"] == MessageType.SYSTEM
-                    and created_at > last_seen_msg[user_id][1]
-                ):
-                    new_serialized.append(m)
-                elif m["id"] > last_seen_msg_id:
-                    new_serialized.append(m)
-        else:
-            # ukoliko korisnik ima neprocitanih poruka koje nisu vise u cacheu...
-            db_msgs = (
-                db.query(Message)
-                .filter(Message.id > last_seen_msg_id)
-                .order_by(Message.id.asc())
-                .all()
-            )
-            for m in db_msgs:
-                serialized = serialize_message(m)
-                new_serialized.append(serialized)
+    with message_cache_lock:
+        cursor_store.set(user_id, last_seen_msg_id, seq)
 
-        if new_serialized:
-            last_seen_msg_id = max(m["id"] for m in new_serialized)
+    return result
 
-        last_seen_msg[user_id] = (last_seen_msg_id, get_current_time())
 
-    result: list[MessageOut] = []
-    for m in new_serialized:
-        msg_des = deserialize_message(m)
-        result.append(msg_des)
+# najvise `limit` globalnih poruka nakon after_id, za GET /messages i nastavak nakon reconnecta
+# (ne mijenja kursor usera), vraca (JSON bajtovi poruka, next_cursor), npr. "after_id=123"
+async def list_messages_after(
+    db: AsyncSession, after_id: int, limit: int = MAX_PAGE_SIZE
+):
+    with message_cache_lock:
+        if message_cache and after_id >= message_cache.first_id():
+            cached = message_cache.messages_after(after_id)
+            if cached is not None:
+                page = cached[:limit]
+                has_more = len(cached) > limit
+                return [m.wire for m in page], (
+                    f"after_id={page[-1].id}" if has_more else None
+                )
+
+    stmt = keyset_select(
+        select(Message).where(Message.chat_id.is_(None)), after_id=after_id, limit=limit
+    )
+    rows, next_cursor = keyset_page(await db.scalars(stmt), after_id, limit)
+    return [encode_message(m) for m in rows], next_cursor
 
-    return result
 
+# gornja granica za long-poll, da klijent ne moze drzati konekciju beskonacno
+LONG_POLL_MAX_TIMEOUT = 30
+
+
+# ceka dok u cacheu ne bude poruka novijih od korisnikovog kursora (ili dok ne istekne timeout)
+# ne uzima message_cache_lock, cursor_store ima svoj lock
+async def wait_for_unread_messages(user_id: int, timeout: float):
+    seen = cursor_store.get(user_id)
+    if seen is None:
+        # user jos nije pollao, sve mu je neprocitano
+        return True
+    timeout = min(timeout, LONG_POLL_MAX_TIMEOUT)
+    return await wait_for_new_message(seen[1], timeout)
 
-def send_user_message(db: Session, msg: MessageIn):
-    db_user = db.query(User).filter(User.username == msg.username).first()
-    if not db_user:
-        return None
 
+@timed("send_user_message")
+# user_id je posiljalac kojeg je ruta vec odredila (resolve_user_id)
+async def send_user_message(db: AsyncSession, msg: MessageIn, user_id: int):
     db_msg = Message(
         content=msg.content,
-        user_id=db_user.id,
-        username=db_user.username,
+        user_id=user_id,
+        username=msg.username,
         type=MessageType.USER_MESSAGE,
+        created_at=get_current_time(),
     )
-    db.add(db_msg)
-    db.commit()
-    db.refresh(db_msg)
-    add_message_to_cache(db_msg)
-
-    # posiljaocu se ova poruka oznacava kao procitana instantno
-    with message_cache_lock:
-        last_seen_msg_id, last_active = last_seen_msg.get(
-            db_user.id, (0, get_current_time())
-        )
-        if db_msg.id > last_seen_msg_id:
-            last_seen_msg_id = db_msg.id
-        last_seen_msg[db_user.id] = (last_seen_msg_id, get_current_time())
-
-    return db_msg
+    # otpustamo konekciju dok cekamo group commit (inace pool ostane bez konekcija)
+    await db.commit()
+    return await asyncio.shield(_store_global_message(db_msg, sender_id=user_id))
@@ -1,64 +1,194 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+from sqlalchemy import func, case, or_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from models.notification import Notification, NotificationType
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.notification import Notification, NotificationType, UnreadCounter
 from models.chat import Chat
+from helper import content_version
 
+"""
+neprocitane poruke brojimo u unread_counters, jedan red po (primalac, chat)
+slanje poruke radi upsert (unread_count + 1), citanje chata resetuje brojac
+badge mapa po useru se cuva u memoriji i oznacava zastarjelom pri svakoj promjeni njegovih brojaca
+(TTL je tu samo za slucaj vise workera, gdje promjenu moze napraviti drugi proces)
+svaka mapa ima verziju (hash sadrzaja, za ETag) koja se mijenja samo kad se mapa stvarno promijeni
+"""
 
-def create_new_chat_notification(db: Session, recipient_id: int, chat_id: int):
-    notif = Notification(
-        recipient_id=recipient_id,
-        chat_id=chat_id,
-        type=NotificationType.NEW_CHAT,
-        is_read=False,
+BADGE_CACHE_TTL = 5  # s
+MAX_BADGE_CACHE_USERS = (
+    10000  # max broj usera u cacheu, najdavnije koristeni se izbacuju (LRU)
+)
+# user_id -> ({other_user_id: True}, monotonic vrijeme racunanja ili None ako je zastarjela,
+#             verzija, monotonic vrijeme zadnje promjene)
+_badge_cache = OrderedDict()
+_badge_cache_lock = Lock()
+
+
+def invalidate_badges(user_id: int):
+    with _badge_cache_lock:
+        cached = _badge_cache.get(user_id)
+        if cached is not None:
+            _badge_cache[user_id] = (cached[0], None, cached[2], cached[3])
+
+
+# (verzija, vrijeme zadnje promjene) badge mape, ili None ako mapa nije u cacheu ili je zastarjela
+def badge_version(user_id: int):
+    with _badge_cache_lock:
+        cached = _badge_cache.get(user_id)
+    if cached is None or cached[1] is None:
+        return None
+    if time.monotonic() - cached[1] >= BADGE_CACHE_TTL:
+        return None
+    return cached[2], cached[3]
+
+
+# INSERT ... ON CONFLICT DO UPDATE, jedan statement bez prethodnog SELECT-a
+def _upsert_counter_stmt(recipient_id: int, chat_id: int, values, changes):
+    stmt = insert(UnreadCounter).values(
+        recipient_id=recipient_id, chat_id=chat_id, **values
     )
-    db.add(notif)
-    db.commit()
-    db.refresh(notif)
-    return notif
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UnreadCounter.recipient_id, UnreadCounter.chat_id],
+        set_=changes,
+    )
+    return stmt
 
 
-def create_new_message_notification(db: Session, recipient_id: int, chat_id: int):
-    notif = Notification(
-        recipient_id=recipient_id,
-        chat_id=chat_id,
-        type=NotificationType.NEW_MESSAGE,
-        is_read=False,
+async def create_new_chat_notification(
+    db: AsyncSession, recipient_id: int, chat_id: int
+):
+    stmt = _upsert_counter_stmt(
+        recipient_id,
+        chat_id,
+        values={"unread_count": 0, "new_chat": True},
+        changes={"new_chat": True},
     )
-    db.add(notif)
-    db.commit()
-    db.refresh(notif)
-    return notif
+    await db.execute(stmt)
+    await db.commit()
+    invalidate_badges(recipient_id)
 
 
-def mark_notifications_read(db: Session, user_id: int, chat_id: int):
-    q = db.query(Notification).filter(
-        Notification.recipient_id == user_id,
-        Notification.chat_id == chat_id,
-        Notification.is_read == False,
+# brojac za `count` novih poruka u chatu, izvrsava ga message_writer u istoj transakciji kao i poruke
+def new_messages_counter_stmt(
+    recipient_id: int, chat_id: int, count: int, last_message_id: int
+):
+    return _upsert_counter_stmt(
+        recipient_id,
+        chat_id,
+        values={
+            "unread_count": count,
+            "last_message_id": last_message_id,
+            "new_chat": False,
+        },
+        changes={
+            "unread_count": UnreadCounter.unread_count + count,
+            "last_message_id": last_message_id,
+        },
     )
-    updated = q.update({"is_read": True}, synchronize_session=False)
-    db.commit()
+
+
+# resetuje brojac jednim UPDATE-om (bez citanja pa pisanja, da se ne izgubi inkrement
+# koji message_writer upise izmedju) i vraca broj azuriranih redova (0 ili 1)
+async def mark_notifications_read(db: AsyncSession, user_id: int, chat_id: int):
+    result = await db.execute(
+        update(UnreadCounter)
+        .where(
+            UnreadCounter.recipient_id == user_id,
+            UnreadCounter.chat_id == chat_id,
+            or_(UnreadCounter.unread_count > 0, UnreadCounter.new_chat.is_(True)),
+        )
+        .values(unread_count=0, new_chat=False)
+        .returning(UnreadCounter.chat_id)
+    )
+    updated = len(result.all())
+    await db.commit()
+    if updated:
+        invalidate_badges(user_id)
     return updated
 
 
 # trazi sve chatove koji imaju barem jednu neprocitanu poruku
-def unread_badges(db: Session, current_user_id: int):
-    chats = (
-        db.query(Chat)
-        .join(Notification, Chat.id == Notification.chat_id)
-        .filter(
-            Notification.recipient_id == current_user_id,
-            Notification.is_read.is_(False),
+# jedan red po chatu, pa je cijena O(broj chatova usera)
+async def unread_badges(db: AsyncSession, current_user_id: int):
+    with _badge_cache_lock:
+        cached = _badge_cache.get(current_user_id)
+        if cached is not None:
+            _badge_cache.move_to_end(current_user_id)
+    if (
+        cached is not None
+        and cached[1] is not None
+        and time.monotonic() - cached[1] < BADGE_CACHE_TTL
+    ):
+        return cached[0]
+
+    chats = await db.execute(
+        select(Chat.user1_id, Chat.user2_id)
+        .join(UnreadCounter, Chat.id == UnreadCounter.chat_id)
+        .where(
+            UnreadCounter.recipient_id == current_user_id,
+            or_(UnreadCounter.unread_count > 0, UnreadCounter.new_chat.is_(True)),
         )
-        .distinct()  # filter duplikate
-        .all()
     )
 
     badges = {}
-    for c in chats:
-        if c.user1_id == current_user_id:
-            other_id = c.user2_id
+    for user1_id, user2_id in chats:
+        if user1_id == current_user_id:
+            other_id = user2_id
         else:
-            other_id = c.user1_id
+            other_id = user1_id
         badges[other_id] = True
 
+    now = time.monotonic()
+    with _badge_cache_lock:
+        if cached is not None and cached[0] == badges:
+            # ista mapa, verzija ostaje pa klijent moze dobiti 304
+            _badge_cache[current_user_id] = (badges, now, cached[2], cached[3])
+        else:
+            _badge_cache[current_user_id] = (badges, now, content_version(badges), now)
+        _badge_cache.move_to_end(current_user_id)
+        if len(_badge_cache) > MAX_BADGE_CACHE_USERS:
+            _badge_cache.popitem(last=False)
     return badges
+
+
+# jednokratno prebacivanje starih neprocitanih Notification redova u brojace
+def migrate_notifications_to_counters(db: Session):
+    rows = (
+        db.query(
+            Notification.recipient_id,
+            Notification.chat_id,
+            func.sum(
+                case((Notification.type == NotificationType.NEW_MESSAGE, 1), else_=0)
+            ),
+            func.max(
+                case((Notification.type == NotificationType.NEW_CHAT, 1), else_=0)
+            ),
+        )
+        .filter(Notification.is_read.is_(False))
+        .group_by(Notification.recipient_id, Notification.chat_id)
+        .all()
+    )
+    if not rows:
+        return
+
+    for recipient_id, chat_id, unread, new_chat in rows:
+        changes = {"unread_count": UnreadCounter.unread_count + unread}
+        if new_chat:
+            changes["new_chat"] = True
+        db.execute(
+            _upsert_counter_stmt(
+                recipient_id,
+                chat_id,
+                values={"unread_count": unread, "new_chat": bool(new_chat)},
+                changes=changes,
+            )
+        )
+    db.query(Notification).filter(Notification.is_read.is_(False)).update(
+        {"is_read": True}, synchronize_session=False
+    )
+    db.commit()
+    print(f"Prebaceno {len(rows)} neprocitanih notifikacija u brojace")
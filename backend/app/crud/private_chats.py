@@ -1,39 +1,102 @@
+import asyncio
 from datetime import datetime, timezone
-from sqlalchemy.orm import Session
-from models.chat import Chat
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.chat import Chat, chat_pair_key
 from models.message import Message, MessageType
 from schemas.message import MessageIn
-from crud.notifications import create_new_message_notification
+from message_writer import message_writer
+from metrics import timed
+from cache.cache_private import (
+    CHAT_WARM_SIZE,
+    add_cached_message,
+    drop_all_chats,
+    warm_chat,
+    is_chat_warm,
+    get_messages_after,
+    get_messages_before,
+)
+from cache.cache_chats import (
+    remember_chat,
+    get_participants,
+    get_chat_id as get_cached_chat_id,
+)
+from helper import (
+    CachedMessage,
+    encode_message,
+    keyset_select,
+    keyset_page,
+    DEFAULT_PAGE_SIZE,
+)
+from ws_manager import subscribe, publish
+
+PRIVATE_CACHE_CHANNEL = "cache.private"
+
+
+def _apply_cache_update(message: dict):
+    add_cached_message(
+        message["chat_id"],
+        CachedMessage.from_wire(message["id"], message["wire"].encode()),
+    )
 
 
-def get_chat_between(db: Session, user_a_id: int, user_b_id: int):
-    return (
-        db.query(Chat)
-        .filter(
-            ((Chat.user1_id == user_a_id) & (Chat.user2_id == user_b_id))
-            | ((Chat.user1_id == user_b_id) & (Chat.user2_id == user_a_id))
-        )
-        .first()
+subscribe(PRIVATE_CACHE_CHANNEL, _apply_cache_update, drop_all_chats)
+
+# chat se vraca klijentu zajedno sa userima, ucitavamo ih u istom upitu
+_WITH_USERS = (joinedload(Chat.user1), joinedload(Chat.user2))
+
+
+async def get_chat_between(db: AsyncSession, user_a_id: int, user_b_id: int):
+    return await db.scalar(
+        select(Chat)
+        .where(Chat.pair_key == chat_pair_key(user_a_id, user_b_id))
+        .options(*_WITH_USERS)
     )
 
 
-def create_chat(db: Session, user1_id: int, user2_id: int):
-    chat = Chat(user1_id=user1_id, user2_id=user2_id)
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
-    return chat
+# ako je chat za isti par upravo kreiran u drugom requestu, insert se preskace
+# (unique pair_key) i vracamo taj chat, tako da duplikat ne moze nastati
+async def create_chat(db: AsyncSession, user1_id: int, user2_id: int):
+    await db.execute(
+        insert(Chat)
+        .values(
+            user1_id=user1_id,
+            user2_id=user2_id,
+            pair_key=chat_pair_key(user1_id, user2_id),
+        )
+        .on_conflict_do_nothing(index_elements=[Chat.pair_key])
+    )
+    await db.commit()
+    return await get_chat_between(db, user1_id, user2_id)
 
 
-def get_or_create_chat(db: Session, creator_id: int, other_user_id: int):
-    chat = get_chat_between(db, creator_id, other_user_id)
+async def get_or_create_chat(db: AsyncSession, creator_id: int, other_user_id: int):
+    chat_id = get_cached_chat_id(creator_id, other_user_id)
+    if chat_id is not None:
+        return await db.get(Chat, chat_id, options=_WITH_USERS)
+    chat = await get_chat_between(db, creator_id, other_user_id)
     if chat is None:
-        chat = create_chat(db, creator_id, other_user_id)
+        chat = await create_chat(db, creator_id, other_user_id)
+    remember_chat(chat.id, chat.user1_id, chat.user2_id)
     return chat
 
 
-def get_chat_by_id(db: Session, chat_id: int):
-    return db.query(Chat).filter(Chat.id == chat_id).first()
+async def get_chat_by_id(db: AsyncSession, chat_id: int):
+    return await db.get(Chat, chat_id)
+
+
+# (user1_id, user2_id) iz imenika chatova, baza se pita samo za chat koji jos nije ucitan
+async def get_chat_participants(db: AsyncSession, chat_id: int):
+    participants = get_participants(chat_id)
+    if participants is None:
+        chat = await get_chat_by_id(db, chat_id)
+        if chat is None:
+            return None
+        remember_chat(chat.id, chat.user1_id, chat.user2_id)
+        participants = (chat.user1_id, chat.user2_id)
+    return participants
 
 
 def get_other_user_id(chat: Chat, user_id: int) -> int:
@@ -42,16 +105,79 @@ def get_other_user_id(chat: Chat, user_id: int) -> int:
     return chat.user1_id
 
 
-def list_messages_for_chat(db: Session, chat_id: int):
-    return (
-        db.query(Message)
-        .filter(Message.chat_id == chat_id)
-        .order_by(Message.created_at.asc())
-        .all()
+# ucitava zadnjih CHAT_WARM_SIZE poruka chata iz baze u cache
+async def _warm_chat_cache(db: AsyncSession, chat_id: int):
+    recent = (
+        await db.scalars(
+            select(Message)
+            .where(Message.chat_id == chat_id)
+            .order_by(Message.id.desc())
+            .limit(CHAT_WARM_SIZE + 1)
+        )
+    ).all()
+    complete = len(recent) <= CHAT_WARM_SIZE
+    warm_chat(chat_id, list(reversed(recent[:CHAT_WARM_SIZE])), complete)
+
+
+# stranica iz cachea kao (poruke, kursor), ili None ako cache ne pokriva trazeni raspon
+def _cached_page(chat_id: int, before_id, after_id, limit: int):
+    if after_id is not None:
+        cached = get_messages_after(chat_id, after_id)
+        if cached is None:
+            return None
+        has_more = len(cached) > limit
+        page = cached[:limit]
+        return page, f"after_id={page[-1].id}" if has_more else None
+
+    cached = get_messages_before(chat_id, before_id, limit)
+    if cached is None:
+        return None
+    page, has_more = cached
+    return page, f"before_id={page[0].id}" if has_more else None
+
+
+# stranica historije chata (poruke kao JSON bajtovi) + kursor za iducu stranicu
+# nove poruke dolaze iz cachea, baza se pita samo za raspon stariji od cachea
+async def list_messages_for_chat(
+    db: AsyncSession,
+    chat_id: int,
+    before_id: int = None,
+    after_id: int = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    page = _cached_page(chat_id, before_id, after_id, limit)
+    if page is None and not is_chat_warm(chat_id):
+        await _warm_chat_cache(db, chat_id)
+        page = _cached_page(chat_id, before_id, after_id, limit)
+    if page is not None:
+        cached, next_cursor = page
+        return [m.wire for m in cached], next_cursor
+
+    # trazeni raspon je stariji od cachea
+    stmt = select(Message).where(Message.chat_id == chat_id)
+    rows = await db.scalars(keyset_select(stmt, before_id, after_id, limit))
+    page, next_cursor = keyset_page(rows, after_id, limit)
+    return [encode_message(m) for m in page], next_cursor
+
+
+# upis kroz writer + cache + objava ostalim workerima; poziva se ispod asyncio.shield jer je
+# poruka commitovana cim je writer upise, pa otkazan request ne smije preskociti cache
+async def _store_chat_message(chat_id: int, msg: Message, recipient_id: int = None):
+    msg = await message_writer.submit(msg, recipient_id)
+    cached = CachedMessage(msg)
+    add_cached_message(chat_id, cached)
+    # ostali workeri dodaju poruku u svoj cache, inace bi im warm chat ostao bez nje
+    await publish(
+        PRIVATE_CACHE_CHANNEL,
+        {"chat_id": chat_id, "id": msg.id, "wire": cached.wire.decode()},
     )
+    return msg
 
 
-def create_message_in_chat(db: Session, chat_id: int, msg_in: MessageIn):
+# poruka (i brojac neprocitanih za recipient_id) se upisuje kroz group commit
+async def create_message_in_chat(
+    db: AsyncSession, chat_id: int, msg_in: MessageIn, recipient_id: int = None
+):
     msg = Message(
         content=msg_in.content,
         username=msg_in.username,
@@ -60,23 +186,23 @@ def create_message_in_chat(db: Session, chat_id: int, msg_in: MessageIn):
         type=MessageType.USER_MESSAGE,
         created_at=datetime.now(timezone.utc),
     )
-    db.add(msg)
-    db.commit()
-    db.refresh(msg)
-    return msg
+    # otpustamo konekciju dok cekamo group commit (inace pool ostane bez konekcija)
+    await db.commit()
+    return await asyncio.shield(_store_chat_message(chat_id, msg, recipient_id))
 
 
-def create_message_and_notify(db: Session, chat_id: int, msg_in: MessageIn):
-    chat = get_chat_by_id(db, chat_id)
-    if chat is None:
+@timed("create_message_and_notify")
+async def create_message_and_notify(db: AsyncSession, chat_id: int, msg_in: MessageIn):
+    participants = await get_chat_participants(db, chat_id)
+    # posiljalac mora biti ucesnik chata
+    if participants is None or msg_in.user_id not in participants:
         return None
-    msg = create_message_in_chat(db, chat_id, msg_in)
-    recipient_id = get_other_user_id(chat, msg_in.user_id)
-
-    create_new_message_notification(db, recipient_id=recipient_id, chat_id=chat.id)
+    user1_id, user2_id = participants
+    recipient_id = user2_id if user1_id == msg_in.user_id else user1_id
+    # poruka i brojac za primaoca idu u istu transakciju
+    msg = await create_message_in_chat(db, chat_id, msg_in, recipient_id)
 
     return {
         "message": msg,
         "recipient_id": recipient_id,
-        "chat": chat,
     }
@@ -0,0 +1,97 @@
+import re
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.message import Message
+from helper import encode_message, DEFAULT_PAGE_SIZE
+from search_index import GLOBAL_FTS, PRIVATE_FTS
+
+"""
+pretraga poruka preko FTS5 indexa (search_index.py)
+- order="recent": najnovije prvo, iduca stranica preko before_id kursora
+  (FTS5 cita pogotke po rowid-u unazad i staje nakon limit, pa je brz i za ceste rijeci)
+- order="rank": najrelevantnije prvo (bm25), iduca stranica preko offset kursora
+  rangira se samo RANK_WINDOW najnovijih pogodaka: bm25 za sve pogotke ceste rijeci
+  u milionima poruka traje stotine ms, a u chatu su ionako bitnije skorije poruke
+
+upit korisnika se ne prosljedjuje kao FTS sintaksa: svaka rijec postaje fraza pod navodnicima,
+rijeci moraju sve biti u poruci, a "rijec*" trazi po prefiksu
+"""
+
+ORDER_RANK = "rank"
+ORDER_RECENT = "recent"
+SEARCH_ORDER_PATTERN = f"^({ORDER_RANK}|{ORDER_RECENT})$"
+SEARCH_QUERY_MAX_LENGTH = 200
+MAX_QUERY_TERMS = 16
+RANK_WINDOW = 5000
+
+_TERM = re.compile(r"\S+")
+
+
+# (tabela, MATCH izraz), izraz je None ako u upitu nema rijeci
+# "zdravo sv*" u chatu 5 -> chat : "c5" AND content : ("zdravo" "sv"*)
+def build_match(query: str, chat_id=None):
+    terms = []
+    for term in _TERM.findall(query)[:MAX_QUERY_TERMS]:
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if not term:
+            continue
+        phrase = '"' + term.replace('"', '""') + '"'
+        terms.append(phrase + "*" if prefix else phrase)
+    if not terms:
+        return None
+    terms = " ".join(terms)
+    if chat_id is None:
+        return GLOBAL_FTS, terms
+    return PRIVATE_FTS, f'chat : "c{chat_id}" AND content : ({terms})'
+
+
+# (JSON bajtovi poruka, next_cursor)
+async def search_messages(
+    db: AsyncSession,
+    query: str,
+    chat_id=None,
+    order: str = ORDER_RANK,
+    offset: int = 0,
+    before_id=None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    match = build_match(query, chat_id)
+    if match is None:
+        return [], None
+    table, match = match
+
+    params = {"match": match, "limit": limit + 1}
+    if order == ORDER_RECENT:
+        where = "rowid < :before_id AND " if before_id is not None else ""
+        params["before_id"] = before_id
+        sql = (
+            f"SELECT rowid FROM {table} WHERE {where}{table} MATCH :match "
+            "ORDER BY rowid DESC LIMIT :limit"
+        )
+    else:
+        params["offset"] = offset
+        params["window"] = RANK_WINDOW
+        sql = (
+            f"SELECT rowid FROM (SELECT rowid, rank FROM {table} "
+            f"WHERE {table} MATCH :match ORDER BY rowid DESC LIMIT :window) "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"
+        )
+    ids = list(await db.scalars(text(sql), params))
+
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = (
+            f"before_id={ids[-1]}"
+            if order == ORDER_RECENT
+            else f"offset={offset + limit}"
+        )
+
+    if not ids:
+        return [], next_cursor
+    rows = await db.scalars(select(Message).where(Message.id.in_(ids)))
+    by_id = {m.id: m for m in rows}
+    # redoslijed iz indexa (rang ili id), ne iz baze
+    return [encode_message(by_id[i]) for i in ids if i in by_id], next_cursor
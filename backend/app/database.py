@@ -1,19 +1,54 @@
+import fcntl
+import os
+from contextlib import contextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./chat.db"
+# ista baza preko aiosqlite drivera, za rute i websocket handlere (ne blokira event loop)
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./chat.db"
 
+# sync engine ostaje za kreiranje tabela, seed i pozadinske niti
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+
+# expire_on_commit=False: nakon commita atributi ostaju ucitani (nema lazy load-a van awaita)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
 
+# sa vise workera svaki pokrece lifespan; create_all, migracije i seed nad praznom bazom
+# nisu sigurni ako ih dva procesa rade istovremeno, pa startup rade jedan po jedan
+STARTUP_LOCK_PATH = os.environ.get("STARTUP_LOCK_PATH", "./chat.db.startup.lock")
+
+
+# flock se oslobadja i ako proces padne usred startupa
+@contextmanager
+def startup_lock():
+    with open(STARTUP_LOCK_PATH, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
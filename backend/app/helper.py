@@ -1,7 +1,19 @@
 from models.message import Message
 from schemas.message import MessageOut, MessageType
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
+from uuid import uuid4
+from fastapi import Request, Response
+import orjson
+import time
+import zlib
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+POLL_INTERVAL_MIN = 2  # s, preporuka klijentu kad se nesto desava
+POLL_INTERVAL_MAX = 30  # s, preporuka za sobu u kojoj dugo nema promjena
+
 
 def serialize_message(msg: Message):
     result = {
@@ -16,6 +28,55 @@ def serialize_message(msg: Message):
         result["user_id"] = msg.user_id
     return result
 
+
+# datetime iz baze je naive (UTC), a iz aplikacije aware, oba se salju kao "...Z"
+_WIRE_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+
+# poruka kao JSON bajtovi, isti oblik kao MessageOut
+def encode_message(msg: Message) -> bytes:
+    data = serialize_message(msg)
+    data["created_at"] = msg.created_at
+    wire = orjson.dumps(data, option=_WIRE_OPTIONS)
+    # orjson vraca bajtove u baferu od ~1KB, bajtovi idu u cache pa ih kopiramo na tacnu velicinu
+    return memoryview(wire).tobytes()
+
+
+# poruka kao dict za websocket, sa istim created_at ("...Z") kao poll i stranice historije
+def message_to_dict(msg: Message) -> dict:
+    return orjson.loads(encode_message(msg))
+
+
+# poruka u cacheu: samo id i JSON bajtovi (enkodirani jednom pri upisu)
+# bez __dict__-a i bez dict-a sa 6 kljuceva, dict za websocket se pravi iz bajtova kad zatreba
+class CachedMessage:
+    __slots__ = ("id", "wire")
+
+    def __init__(self, msg: Message):
+        self.id = msg.id
+        self.wire = encode_message(msg)
+
+    # poruka koja je vec enkodirana (npr. procitana iz snapshota)
+    @classmethod
+    def from_wire(cls, msg_id: int, wire: bytes):
+        cached = cls.__new__(cls)
+        cached.id = msg_id
+        cached.wire = wire
+        return cached
+
+    def to_dict(self):
+        return orjson.loads(self.wire)
+
+
+# JSON lista od vec enkodiranih poruka, bez pydantic validacije i ponovnog enkodiranja
+def json_list_response(fragments: List[bytes], headers: Dict = None):
+    return Response(
+        content=b"[" + b",".join(fragments) + b"]",
+        media_type="application/json",
+        headers=headers,
+    )
+
+
 def deserialize_message(data: Dict):
     created_at = data["created_at"]
     if isinstance(created_at, str):
@@ -33,3 +94,94 @@ def deserialize_message(data: Dict):
         created_at=created_at,
         user_id=user_id,
     )
+
+
+"""
+keyset paginacija po Message.id: umjesto OFFSET-a trazimo od zadnjeg id-a (indeks seek),
+pa je svaka stranica jednako skupa bez obzira koliko je historija duga
+- bez kursora: zadnjih `limit` poruka
+- before_id: `limit` poruka prije before_id (starije)
+- after_id: `limit` poruka nakon after_id (novije)
+stranica je uvijek sortirana uzlazno po id, next_cursor je npr. "before_id=123" ili None
+"""
+
+
+def keyset_select(stmt, before_id=None, after_id=None, limit=DEFAULT_PAGE_SIZE):
+    if after_id is not None:
+        stmt = stmt.where(Message.id > after_id).order_by(Message.id.asc())
+    else:
+        if before_id is not None:
+            stmt = stmt.where(Message.id < before_id)
+        stmt = stmt.order_by(Message.id.desc())
+    # jedan red vise da znamo ima li iduca stranica
+    return stmt.limit(limit + 1)
+
+
+# rezultat keyset_select upita -> (stranica sortirana uzlazno, next_cursor)
+def keyset_page(rows, after_id=None, limit=DEFAULT_PAGE_SIZE):
+    rows = list(rows)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is not None:
+        return rows, f"after_id={rows[-1].id}" if has_more else None
+    rows.reverse()
+    return rows, f"before_id={rows[0].id}" if has_more else None
+
+
+"""
+conditional GET za endpointe koji se pollaju
+verzija je hash sadrzaja (content_version), pa isti sadrzaj ima isti ETag u svakom workeru
+prefiks je slucajan po procesu, a sa dijeljenim cacheom (GLOBAL_CACHE=mmap) ga svi workeri
+citaju iz zaglavlja zajednickog fajla (set_etag_prefix), pa ETag vazi i na drugom workeru
+"""
+_ETAG_PREFIX = uuid4().hex[:8]
+
+
+def set_etag_prefix(prefix: str):
+    global _ETAG_PREFIX
+    _ETAG_PREFIX = prefix
+
+
+def content_version(data) -> str:
+    raw = orjson.dumps(data, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return format(zlib.crc32(raw), "08x")
+
+
+def make_etag(kind: str, version) -> str:
+    return f'"{_ETAG_PREFIX}-{kind}-{version}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return etag in (tag.strip() for tag in header.split(","))
+
+
+# sto duze nema promjena, to rjedje klijent treba pitati (pola vremena mirovanja, u granicama)
+def suggest_poll_interval(changed_at: float, max_interval: float = POLL_INTERVAL_MAX):
+    idle = time.monotonic() - changed_at
+    return int(max(POLL_INTERVAL_MIN, min(idle / 2, max_interval)))
+
+
+# no-cache: browser smije cuvati odgovor, ali ga uvijek provjerava sa If-None-Match
+# samo za endpointe koji vracaju cijelo stanje (ponovljen odgovor je i dalje tacan)
+def poll_headers(etag: str, interval: int):
+    return {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "X-Poll-Interval": str(interval),
+    }
+
+
+# endpointi koji vracaju samo novo od zadnjeg polla: bez ETag-a i bez cuvanja u browseru,
+# inace bi browser na 304 vratio stari odgovor i klijent bi iste poruke dodao jos jednom
+def delta_headers(interval: int):
+    return {
+        "Cache-Control": "no-store",
+        "X-Poll-Interval": str(interval),
+    }
+
+
+def not_modified(headers: Dict):
+    return Response(status_code=304, headers=headers)
@@ -1,29 +1,68 @@
-from fastapi import FastAPI, Depends
+import asyncio
+from typing import Optional
+from fastapi import FastAPI, Depends, Query, Response, HTTPException, status
 from seed import generate_history_data
-from database import SessionLocal, engine, Base, get_db
+from database import SessionLocal, engine, Base, get_db, startup_lock
 from contextlib import asynccontextmanager
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from models.user import User
 from models.message import Message, MessageType
 from datetime import datetime, timezone, timedelta
 from fastapi.middleware.cors import CORSMiddleware
 from routers import private_chats, notifications, global_chat
-from cache.cache_global import add_message_to_cache
+from cache.cache_global import add_message_to_cache, cursor_store
+from cache import cache_global, cache_private
+from cache.cache_presence import flush_to_db as flush_presence
+from cache.cache_warmup import warm_caches, save_snapshot
+from crud.notifications import migrate_notifications_to_counters
+from crud.global_chat import fan_out_presence
 from schemas.message import MessageOut
+from ws_manager import manager, global_manager, broker
+from message_writer import message_writer
+from migrations import migrate_schema
+from archive import archive_global_history
+from rate_limit import send_limiter
+from metrics import RouteTimingMiddleware, snapshot as metrics_snapshot
+from helper import keyset_select, keyset_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 
 # pokrece se prije aplikacije (setup) i nakon zatvaranja (ciscenje)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # kreira tabele iz modela
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-    generate_history_data(db)
-    db.close()
+    # ostali workeri cekaju dok ovaj ne zavrsi (worker jos ne prima zahtjeve, pa blokiranje ne smeta)
+    with startup_lock():
+        # kreira tabele iz modela
+        Base.metadata.create_all(bind=engine)
+        # indexi i kolone koje create_all ne dodaje u postojecu bazu
+        migrate_schema(engine)
+        db = SessionLocal()
+        generate_history_data(db)
+        migrate_notifications_to_counters(db)
+        # globalna historija starija od GLOBAL_RETENTION_DAYS ide u arhivu (dalje periodicno)
+        archive_global_history(db)
+        # veza sa ostalim workerima (websocket poruke i upisi u cache), prije punjenja cachea
+        # da upisi drugih workera za vrijeme punjenja ne budu propusteni
+        await broker.start()
+        # cache iz snapshota ili baze, da prvi zahtjevi ne idu u bazu
+        warm_caches(db)
+        db.close()
+    # heartbeati ovog workera ostalim workerima (samo sa WS_BROKER=unix)
+    presence_task = asyncio.create_task(fan_out_presence())
 
     yield  # app se ovdje pokrece
 
-    pass
+    presence_task.cancel()
+
+    # poruke koje jos cekaju group commit
+    await message_writer.drain()
+    # snapshot cachea za sljedeci start (ako je CACHE_SNAPSHOT_PATH postavljen)
+    db = SessionLocal()
+    save_snapshot(db)
+    db.close()
+    await broker.stop()
+    # zadnji heartbeati koji jos nisu upisani u bazu
+    flush_presence()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -34,8 +73,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Poll-Interval"],
 )
 
+# latencija po ruti za /metrics
+app.add_middleware(RouteTimingMiddleware)
+
 app.include_router(private_chats.router)
 app.include_router(notifications.router)
 app.include_router(global_chat.router)
@@ -43,12 +86,28 @@ app.include_router(global_chat.router)
 # ZA TESTIRANJE
 
 
+def _check_cursor(before_id, after_id):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before_id or after_id",
+        )
+
+
 @app.get("/", tags=["test"])
-def read_root(db: Session = Depends(get_db)):
+def read_root(
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
+    _check_cursor(before_id, after_id)
     users_db = db.query(User).all()
-    messages_db = db.query(Message).order_by(Message.created_at).all()
+    rows = db.scalars(keyset_select(select(Message), before_id, after_id, limit))
+    messages_db, next_cursor = keyset_page(rows, after_id, limit)
 
     return {
+        "next_cursor": next_cursor,
         "users": [{"id": u.id, "username": u.username} for u in users_db],
         "messages": [
             {
@@ -89,7 +148,51 @@ def get_active_users(current_user_id: int, db: Session = Depends(get_db)):
     return result
 
 
+# paginirano kao /chats/{chat_id}/messages, kursor u X-Next-Cursor headeru
 @app.get("/messages/all", response_model=list[MessageOut], tags=["test"])
-def get_messages(db: Session = Depends(get_db)):
-    query = db.query(Message).order_by(Message.created_at).all()
-    return query
+def get_messages(
+    response: Response,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
+    _check_cursor(before_id, after_id)
+    rows = db.scalars(keyset_select(select(Message), before_id, after_id, limit))
+    page, next_cursor = keyset_page(rows, after_id, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return page
+
+
+# broj poruka koje cekaju na slanje po websocket konekciji
+@app.get("/ws/queues", tags=["test"])
+def get_ws_queues():
+    return {
+        "private": manager.queue_depths(),
+        "global": global_manager.queue_depths(),
+    }
+
+
+# velicina i broj izbacenih kursora globalnog chata
+@app.get("/cursors/stats", tags=["test"])
+def get_cursor_stats():
+    return cursor_store.stats()
+
+
+# histogrami latencije, cache hit/miss, velicine cacheova i broj websocketa (ovog workera)
+@app.get("/metrics", tags=["metrics"])
+def get_metrics():
+    return {
+        **metrics_snapshot(),
+        "caches": {
+            "global_messages": len(cache_global.message_cache),
+            "private_chats": len(cache_private.message_cache),
+            "cursors": cursor_store.stats(),
+        },
+        "websockets": {
+            "private": len(manager.active_connections),
+            "global": len(global_manager.active_connections),
+        },
+        "rate_limits": send_limiter.stats(),
+    }
@@ -0,0 +1,101 @@
+import asyncio
+from database import AsyncSessionLocal
+from models.message import Message
+from crud.notifications import new_messages_counter_stmt, invalidate_badges
+
+"""
+group commit: umjesto da svaki request radi svoj add/commit/refresh (jedan fsync po commitu),
+poruke i njihove notifikacije se skupljaju u red i upisuju jednom transakcijom
+batch se commituje nakon FLUSH_WINDOW sekundi ili cim se skupi MAX_BATCH_SIZE poruka,
+a svaki pozivalac dobija svoju poruku sa dodijeljenim id-om
+"""
+
+FLUSH_WINDOW = 0.005  # s
+MAX_BATCH_SIZE = 200
+
+
+class MessageWriter:
+    def __init__(self):
+        self._pending = []  # (poruka, recipient_id ili None, future)
+        self._batch_full = None  # asyncio.Event, pravi se sa taskom (u njegovom loopu)
+        self._task = None
+
+    # upisuje poruku (i brojac neprocitanih za recipient_id), vraca poruku sa id-om
+    async def submit(self, msg: Message, recipient_id: int = None) -> Message:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((msg, recipient_id, fut))
+        if self._task is None or self._task.done():
+            self._batch_full = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        if len(self._pending) >= MAX_BATCH_SIZE:
+            self._batch_full.set()
+        return await fut
+
+    async def _run(self):
+        while self._pending:
+            if len(self._pending) < MAX_BATCH_SIZE:
+                # cekamo jos poruka za isti commit
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), FLUSH_WINDOW)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_full.clear()
+            batch = self._pending[:MAX_BATCH_SIZE]
+            del self._pending[:MAX_BATCH_SIZE]
+            try:
+                await self._commit(batch)
+            except Exception:
+                # jedna losa poruka ne smije oboriti cijeli batch, upisujemo pojedinacno
+                for item in batch:
+                    item[0].id = None  # id iz propalog flush-a
+                    try:
+                        await self._commit([item])
+                    except Exception as e:
+                        self._resolve(item[2], exception=e)
+                    else:
+                        self._resolve(item[2], item[0])
+                continue
+            for msg, _, fut in batch:
+                self._resolve(fut, msg)
+
+    # pozivalac je mozda vec odustao (otkazan request), tada se rezultat samo odbacuje
+    @staticmethod
+    def _resolve(fut, msg=None, exception=None):
+        if fut.done():
+            return
+        if exception is not None:
+            fut.set_exception(exception)
+        else:
+            fut.set_result(msg)
+
+    async def _commit(self, batch):
+        async with AsyncSessionLocal() as db:
+            db.add_all([msg for msg, _, _ in batch])
+            await db.flush()  # dodjeljuje id-ove
+
+            # vise poruka istom primaocu u istom chatu -> jedan upsert
+            counters = {}  # (recipient_id, chat_id) -> (broj, zadnji id)
+            for msg, recipient_id, _ in batch:
+                if recipient_id is None:
+                    continue
+                key = (recipient_id, msg.chat_id)
+                count, _ = counters.get(key, (0, None))
+                counters[key] = (count + 1, msg.id)
+            for (recipient_id, chat_id), (count, last_id) in counters.items():
+                await db.execute(
+                    new_messages_counter_stmt(recipient_id, chat_id, count, last_id)
+                )
+
+            await db.commit()
+
+        for recipient_id, _ in counters:
+            invalidate_badges(recipient_id)
+
+    # ceka da se upisu sve poruke iz reda (gasenje aplikacije)
+    async def drain(self):
+        if self._task is not None and not self._task.done():
+            await self._task
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,198 @@
+import functools
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+"""
+metrike vrucih putanja u memoriji procesa, citaju se preko GET /metrics (JSON)
+- histogrami latencije: funkcije oznacene sa @timed, rute (RouteTimingMiddleware),
+  cekanje i drzanje lockova napravljenih sa TimedLock
+- brojaci: npr. poll iz cachea ili iz baze
+
+mjerenje je jedan perf_counter() prije i poslije + upis u fiksne buckete (bez alokacija),
+svaki worker ima svoje metrike
+"""
+
+# gornje granice bucketa u sekundama, zadnji bucket je sve iznad
+BUCKET_BOUNDS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+class Histogram:
+    def __init__(self):
+        self._counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds: float):
+        i = bisect_left(BUCKET_BOUNDS, seconds)
+        with self._lock:
+            self._counts[i] += 1
+            self._count += 1
+            self._sum += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    # gornja granica bucketa u kojem je percentil (procjena), ne veca od najveceg mjerenja
+    def _percentile(self, counts, count, max_seen, p: float):
+        rank = p / 100 * count
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                return (
+                    min(BUCKET_BOUNDS[i], max_seen)
+                    if i < len(BUCKET_BOUNDS)
+                    else max_seen
+                )
+        return max_seen
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            count, total, max_seen = self._count, self._sum, self._max
+        if not count:
+            return {"count": 0}
+        return {
+            "count": count,
+            "mean_ms": _ms(total / count),
+            "p50_ms": _ms(self._percentile(counts, count, max_seen, 50)),
+            "p95_ms": _ms(self._percentile(counts, count, max_seen, 95)),
+            "p99_ms": _ms(self._percentile(counts, count, max_seen, 99)),
+            "max_ms": _ms(max_seen),
+            # kumulativno, kao prometheus: broj mjerenja <= granice
+            "buckets_ms": {
+                str(_ms(bound)): n
+                for bound, n in zip(BUCKET_BOUNDS, _cumulative(counts))
+                if n
+            },
+        }
+
+
+def _ms(seconds: float):
+    return round(seconds * 1000, 3)
+
+
+def _cumulative(counts):
+    total = 0
+    for c in counts:
+        total += c
+        yield total
+
+
+_histograms = defaultdict(Histogram)  # ime -> Histogram
+_counters = defaultdict(int)  # ime -> broj
+_registry_lock = Lock()
+
+
+def histogram(name: str):
+    h = _histograms.get(name)
+    if h is None:
+        with _registry_lock:
+            h = _histograms[name]
+    return h
+
+
+def observe(name: str, seconds: float):
+    histogram(name).observe(seconds)
+
+
+def increment(name: str, amount: int = 1):
+    with _registry_lock:
+        _counters[name] += amount
+
+
+# mjeri trajanje async funkcije (ukljucujuci cekanje na bazu i group commit)
+def timed(name: str):
+    h = histogram(name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                h.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+"""
+threading.Lock koji mjeri koliko se ceka na lock i koliko dugo se drzi
+koristi se samo kroz "with", kao i obican Lock
+"""
+
+
+class TimedLock:
+    # lock: bilo sta sa acquire/release (npr. FileLock za cache dijeljen izmedju procesa)
+    def __init__(self, name: str, lock=None):
+        self._lock = lock if lock is not None else Lock()
+        self._wait = histogram(f"lock.{name}.wait")
+        self._hold = histogram(f"lock.{name}.hold")
+        self._acquired_at = 0.0  # pise ga samo nit koja drzi lock
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self._wait.observe(self._acquired_at - started)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        self._hold.observe(held)
+        return False
+
+
+# latencija po ruti ("GET /messages/unread"), ruta je sablon putanje, ne stvarni url
+class RouteTimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            observe(f"route.{scope['method']} {path}", time.perf_counter() - started)
+
+
+def snapshot():
+    with _registry_lock:
+        histograms = dict(_histograms)
+        counters = dict(_counters)
+    return {
+        "histograms": {name: h.snapshot() for name, h in sorted(histograms.items())},
+        "counters": counters,
+    }
@@ -0,0 +1,96 @@
+from sqlalchemy import inspect, text, select, update, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from models.chat import Chat
+from models.message import Message
+from models.notification import Notification, UnreadCounter
+from search_index import create_search_index
+
+"""
+create_all pravi samo tabele koje ne postoje, pa postojecu bazu dovodimo do modela ovdje
+- chats.pair_key: kolona se dodaje i puni iz user1_id/user2_id
+- duplikati chata za isti par (nastali u race-u prije unique kljuca) se spajaju u najstariji chat
+- indexi iz modela se kreiraju ako ne postoje
+- FTS index za pretragu poruka (search_index.py)
+sve je idempotentno i pokrece se na svakom startu
+"""
+
+
+def _add_pair_key(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("chats")}
+    if "pair_key" not in columns:
+        # sqlite ne dozvoljava NOT NULL kolonu bez defaulta u ALTER TABLE
+        conn.execute(text("ALTER TABLE chats ADD COLUMN pair_key VARCHAR"))
+    conn.execute(
+        text(
+            "UPDATE chats SET pair_key = "
+            "min(user1_id, user2_id) || ':' || max(user1_id, user2_id) "
+            "WHERE pair_key IS NULL"
+        )
+    )
+
+
+def _merge_counter(conn, counter, keep_id: int):
+    stmt = insert(UnreadCounter).values(
+        recipient_id=counter.recipient_id,
+        chat_id=keep_id,
+        unread_count=counter.unread_count,
+        last_message_id=counter.last_message_id,
+        new_chat=counter.new_chat,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UnreadCounter.recipient_id, UnreadCounter.chat_id],
+        set_={
+            "unread_count": UnreadCounter.unread_count + stmt.excluded.unread_count,
+            "last_message_id": func.max(
+                func.coalesce(UnreadCounter.last_message_id, 0),
+                func.coalesce(stmt.excluded.last_message_id, 0),
+            ),
+            "new_chat": UnreadCounter.new_chat | stmt.excluded.new_chat,
+        },
+    )
+    conn.execute(stmt)
+
+
+def _merge_duplicate_chats(conn):
+    keep = {}  # pair_key -> id najstarijeg chata
+    merged = 0
+    for chat_id, pair_key in conn.execute(
+        select(Chat.id, Chat.pair_key).order_by(Chat.id)
+    ):
+        if pair_key not in keep:
+            keep[pair_key] = chat_id
+            continue
+        keep_id = keep[pair_key]
+        conn.execute(
+            update(Message).where(Message.chat_id == chat_id).values(chat_id=keep_id)
+        )
+        conn.execute(
+            update(Notification)
+            .where(Notification.chat_id == chat_id)
+            .values(chat_id=keep_id)
+        )
+        counters = conn.execute(
+            select(UnreadCounter).where(UnreadCounter.chat_id == chat_id)
+        ).all()
+        for counter in counters:
+            _merge_counter(conn, counter, keep_id)
+        conn.execute(delete(UnreadCounter).where(UnreadCounter.chat_id == chat_id))
+        conn.execute(delete(Chat).where(Chat.id == chat_id))
+        merged += 1
+    if merged:
+        print(f"Spojeno {merged} dupliranih chatova")
+
+
+def migrate_schema(engine):
+    with engine.begin() as conn:
+        _add_pair_key(conn)
+        _merge_duplicate_chats(conn)
+        for table in (
+            Chat.__table__,
+            Message.__table__,
+            Notification.__table__,
+            UnreadCounter.__table__,
+        ):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        create_search_index(conn)
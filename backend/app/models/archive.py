@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from datetime import datetime, timezone
+from database import Base
+
+
+# jedan mjesec globalnog chata prebacen iz baze u arhivski fajl (vidi archive.py)
+class GlobalArchive(Base):
+    __tablename__ = "global_archives"
+
+    month = Column(String, primary_key=True)  # "2025-01"
+    file_name = Column(String, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            "month": self.month,
+            "first_id": self.first_id,
+            "last_id": self.last_id,
+            "message_count": self.message_count,
+        }
@@ -1,16 +1,26 @@
 from sqlalchemy import (
     Column,
     Integer,
+    String,
     ForeignKey,
     DateTime,
+    Index,
 )
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
 from database import Base
 
 
+# isti kljuc bez obzira koji je user user1 a koji user2
+def chat_pair_key(user_a_id: int, user_b_id: int) -> str:
+    low, high = sorted((user_a_id, user_b_id))
+    return f"{low}:{high}"
+
+
 class Chat(Base):
     __tablename__ = "chats"
+    # jedan chat po paru usera, trazenje chata izmedju dva usera je jedan lookup po indexu
+    __table_args__ = (Index("ix_chats_pair_key", "pair_key", unique=True),)
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
 
     user1_id = Column(
@@ -19,6 +29,7 @@ class Chat(Base):
     user2_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
     )
+    pair_key = Column(String, nullable=False)  # chat_pair_key(user1_id, user2_id)
 
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
 
@@ -5,6 +5,7 @@ from sqlalchemy import (
     Text,
     ForeignKey,
     DateTime,
+    Index,
     Enum as SQLAlchemyEnum,
 )
 from enum import Enum
@@ -12,6 +13,7 @@ from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
 from database import Base
 
+
 class MessageType(str, Enum):
     SYSTEM = "system"
     USER_MESSAGE = "user_message"
@@ -19,6 +21,8 @@ class MessageType(str, Enum):
 
 class Message(Base):
     __tablename__ = "messages"
+    # historija chata (chat_id = X) i globalni chat (chat_id IS NULL) se citaju po id-u
+    __table_args__ = (Index("ix_messages_chat_id_id", "chat_id", "id"),)
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     content = Column(Text)
     # kada se user izbrise njegove poruke ostaju
@@ -34,6 +38,6 @@ class Message(Base):
     )
 
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=True)
-    
+
     user = relationship("User", back_populates="messages")
-    chat = relationship("Chat", back_populates="messages")
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
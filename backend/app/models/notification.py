@@ -3,6 +3,7 @@ from sqlalchemy import (
     Integer,
     ForeignKey,
     Boolean,
+    Index,
     Enum as SQLAlchemyEnum,
 )
 from enum import Enum
@@ -15,6 +16,10 @@ class NotificationType(str, Enum):
 
 class Notification(Base):
     __tablename__ = "notifications"
+    # neprocitane notifikacije usera, grupisane po chatu
+    __table_args__ = (
+        Index("ix_notifications_recipient_unread", "recipient_id", "is_read", "chat_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     recipient_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
@@ -23,4 +28,22 @@ class Notification(Base):
     is_read = Column(Boolean, nullable=False, default=False)
 
     recipient = relationship("User")
-    chat = relationship("Chat")
\ No newline at end of file
+    chat = relationship("Chat")
+
+
+# jedan red po (primalac, chat) umjesto jednog Notification reda po poruci
+# badge postoji ako je unread_count > 0 ili je chat nov (new_chat)
+class UnreadCounter(Base):
+    __tablename__ = "unread_counters"
+
+    recipient_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    chat_id = Column(
+        Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True
+    )
+    unread_count = Column(Integer, nullable=False, default=0)
+    last_message_id = Column(Integer, nullable=True)
+    new_chat = Column(Boolean, nullable=False, default=False)
+
+    chat = relationship("Chat")
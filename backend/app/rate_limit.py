@@ -0,0 +1,142 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from fastapi import HTTPException, status
+
+"""
+ogranicavanje slanja poruka (token bucket), da jedan klijent ne zauzme group commit za sve
+- svaki user ima svoj bucket: SEND_RATE_PER_USER poruka u sekundi, najvise SEND_BURST_PER_USER odjednom
+- svi zajedno dijele globalni bucket (SEND_RATE_GLOBAL / SEND_BURST_GLOBAL), granica koju writer podnosi
+poruka prolazi samo ako ima tokena u oba bucketa, odbijena ne trosi nista
+rate 0 iskljucuje taj bucket
+
+vrijedi za POST /messages, POST /chats/{chat_id}/messages i private websocket,
+bucket je vezan za posiljaoca tek nakon provjere identiteta (nevazeci zahtjev ne trosi tokene),
+odbijen HTTP zahtjev dobija 429 (Retry-After), a websocket poruku {"type": "error", ...}
+buckete pamtimo za najvise MAX_TRACKED_USERS usera, najdavnije aktivni se izbacuju
+(izbacen bucket bi se ionako u medjuvremenu napunio)
+"""
+
+SEND_RATE_PER_USER = float(os.environ.get("SEND_RATE_PER_USER", "5"))
+SEND_BURST_PER_USER = float(os.environ.get("SEND_BURST_PER_USER", "10"))
+SEND_RATE_GLOBAL = float(os.environ.get("SEND_RATE_GLOBAL", "200"))
+SEND_BURST_GLOBAL = float(os.environ.get("SEND_BURST_GLOBAL", "400"))
+MAX_TRACKED_USERS = 100000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # sekundi do iduceg tokena, 0 ako token ima
+    def wait_time(self, now: float):
+        if self.rate <= 0:
+            return 0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, user_rate, user_burst, global_rate, global_burst):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._users = OrderedDict()  # user -> TokenBucket
+        self._lock = Lock()
+        self.allowed = 0
+        self.rejected_user = 0
+        self.rejected_global = 0
+
+    def _user_bucket(self, user, now: float):
+        bucket = self._users.get(user)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst, now)
+            self._users[user] = bucket
+            if len(self._users) > MAX_TRACKED_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user)
+        return bucket
+
+    # 0 ako poruka smije proci (token je potrosen), inace sekundi do iduceg pokusaja
+    def acquire(self, user):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._user_bucket(user, now)
+            wait = bucket.wait_time(now)
+            if wait:
+                self.rejected_user += 1
+                return wait
+            wait = self._global.wait_time(now)
+            if wait:
+                self.rejected_global += 1
+                return wait
+            bucket.take()
+            self._global.take()
+            self.allowed += 1
+            return 0
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._global.wait_time(now)  # osvjezava broj tokena
+            return {
+                "per_user": {"rate": self.user_rate, "burst": self.user_burst},
+                "global": {
+                    "rate": self._global.rate,
+                    "burst": self._global.burst,
+                    "tokens": round(self._global.tokens, 2),
+                },
+                "tracked_users": len(self._users),
+                "allowed": self.allowed,
+                "rejected_user": self.rejected_user,
+                "rejected_global": self.rejected_global,
+            }
+
+
+send_limiter = RateLimiter(
+    SEND_RATE_PER_USER, SEND_BURST_PER_USER, SEND_RATE_GLOBAL, SEND_BURST_GLOBAL
+)
+
+
+# za HTTP rute: 429 ako user ili server trenutno ne smiju slati
+def check_send_rate(user):
+    wait = send_limiter.acquire(user)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many messages",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+# za websocket: None ako poruka smije proci, inace poruka o gresci za klijenta
+def send_rate_error(user):
+    wait = send_limiter.acquire(user)
+    if not wait:
+        return None
+    return {
+        "type": "error",
+        "data": {
+            "code": status.HTTP_429_TOO_MANY_REQUESTS,
+            "detail": "Too many messages",
+            "retry_after": round(wait, 3),
+        },
+    }
@@ -1,10 +1,51 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Optional
+from fastapi import (
+    APIRouter,
+    Depends,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+    HTTPException,
+    Path,
+    Query,
+    status,
+)
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import orjson
 import random_username.generate as rug
-from database import get_db
+from database import AsyncSessionLocal, get_async_db, get_db
 from schemas.message import MessageOut, MessageIn
 from schemas.user import UserOut, UserIn
+from ws_manager import global_manager
+from helper import (
+    message_to_dict,
+    json_list_response,
+    make_etag,
+    etag_matches,
+    suggest_poll_interval,
+    poll_headers,
+    delta_headers,
+    not_modified,
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+)
+from models.archive import GlobalArchive
+from archive import load_archive, archive_page
+from rate_limit import check_send_rate
+from crud.search import (
+    search_messages,
+    ORDER_RANK,
+    SEARCH_ORDER_PATTERN,
+    SEARCH_QUERY_MAX_LENGTH,
+)
+from cache.cache_global import (
+    messages_after as message_cache_after,
+    last_message_at,
+)
+from cache.cache_presence import ACTIVE_WINDOW, active_version
 from crud.global_chat import (
     create_user,
     create_system_join_message,
@@ -12,6 +53,10 @@ from crud.global_chat import (
     list_active_users,
     poll_new_messages,
     send_user_message,
+    resolve_user_id,
+    wait_for_unread_messages,
+    list_messages_after,
+    resolve_username,
 )
 
 router = APIRouter()
@@ -23,30 +68,193 @@ def generate_username():
     return {"username": result}
 
 
+async def push_global_message(msg):
+    await global_manager.broadcast_all(
+        {"type": "global_message", "data": message_to_dict(msg)}
+    )
+
+
 @router.post("/join", response_model=UserOut)
-def join(usernameReq: UserIn, db: Session = Depends(get_db)):
-    user = create_user(db, usernameReq.username)
-    create_system_join_message(db, usernameReq.username)
+async def join(usernameReq: UserIn, db: AsyncSession = Depends(get_async_db)):
+    user = await create_user(db, usernameReq.username)
+    system_msg = await create_system_join_message(db, usernameReq.username)
+    await push_global_message(system_msg)
     return user
 
 
+# poll je ujedno i heartbeat, pa preporuceni interval mora biti kraci od ACTIVE_WINDOW
 @router.get("/users/active")
-def get_active_users(current_user_id: int, db: Session = Depends(get_db)):
-    mark_user_active(db, current_user_id)
-    return list_active_users(db)
+async def get_active_users(
+    request: Request,
+    response: Response,
+    current_user_id: int,
+    db: AsyncSession = Depends(get_async_db),
+):
+    await mark_user_active(db, current_user_id)
+    version, changed_at = active_version()
+    interval = suggest_poll_interval(changed_at, max_interval=ACTIVE_WINDOW // 2)
+    headers = poll_headers(make_etag("a", version), interval)
+    if etag_matches(request, headers["ETag"]):
+        return not_modified(headers)
+    response.headers.update(headers)
+    return list_active_users()
 
 
+# wait > 0 ukljucuje long-poll: request ceka (najvise wait sekundi) dok ne stigne nova poruka
+# dok ceka ne drzi nit iz threadpoola niti konekciju na bazu
 @router.get("/messages/unread", response_model=List[MessageOut])
-def get_unread_messages(user_id: int, db: Session = Depends(get_db)):
-    return poll_new_messages(db, user_id)
+async def get_unread_messages(
+    user_id: int = Query(gt=0),  # 0 je prazno mjesto u dijeljenoj tabeli kursora
+    wait: float = 0,
+    db: AsyncSession = Depends(get_async_db),
+):
+    if wait > 0:
+        await wait_for_unread_messages(user_id, wait)
+    # odgovor su samo nove poruke (delta), pa nema ETag-a ni 304
+    headers = delta_headers(suggest_poll_interval(last_message_at()))
+    # response_model ostaje zbog dokumentacije, odgovor je vec enkodiran
+    return json_list_response(await poll_new_messages(db, user_id), headers)
 
 
 @router.post("/messages", response_model=MessageOut)
-def post_message(msg: MessageIn, db: Session = Depends(get_db)):
-    saved = send_user_message(db, msg)
-    if saved is None:
+async def post_message(msg: MessageIn, db: AsyncSession = Depends(get_async_db)):
+    # posiljaoca odredjujemo iz cachea identiteta prije rate limita: bucket je vezan za
+    # stvarnog usera, a zahtjev sa nepoznatim ili tudjim user_id ne trosi nicije tokene
+    user_id = await resolve_user_id(db, msg.username)
+    if user_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found",
         )
+    if msg.user_id is not None and msg.user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid sender"
+        )
+    check_send_rate(user_id)
+    saved = await send_user_message(db, msg, user_id)
+    # poruka je commitovana, odmah je guramo svim pretplatnicima
+    await push_global_message(saved)
     return saved
+
+
+# stranica globalnog chata nakon after_id (bez poruka iz privatnih chatova),
+# kursor za iducu stranicu je u X-Next-Cursor ("after_id=N")
+@router.get("/messages", response_model=List[MessageOut])
+async def get_messages_after(
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    page, next_cursor = await list_messages_after(db, after_id, limit)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return json_list_response(page, headers)
+
+
+# pretraga globalnog chata, kursor za iducu stranicu je u X-Next-Cursor
+# ("offset=N" za order=rank, "before_id=N" za order=recent)
+@router.get("/messages/search", response_model=List[MessageOut])
+async def search_global_messages(
+    q: str = Query(min_length=1, max_length=SEARCH_QUERY_MAX_LENGTH),
+    order: str = Query(ORDER_RANK, pattern=SEARCH_ORDER_PATTERN),
+    offset: int = Query(0, ge=0),
+    before_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    page, next_cursor = await search_messages(
+        db, q, order=order, offset=offset, before_id=before_id, limit=limit
+    )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return json_list_response(page, headers)
+
+
+# arhivirani mjeseci globalnog chata (starije od GLOBAL_RETENTION_DAYS, vidi archive.py)
+@router.get("/messages/archive")
+def get_archives(db: Session = Depends(get_db)):
+    archives = db.scalars(select(GlobalArchive).order_by(GlobalArchive.month))
+    return [a.to_dict() for a in archives]
+
+
+# poruke jednog arhiviranog mjeseca, paginirano kao /chats/{chat_id}/messages
+# sync ruta: citanje i dekompresija fajla idu u threadpool, ne blokiraju event loop
+@router.get("/messages/archive/{month}", response_model=List[MessageOut])
+def get_archived_messages(
+    month: str = Path(pattern=r"^\d{4}-\d{2}$"),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before_id or after_id",
+        )
+    archive = load_archive(month)
+    if archive is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Archive not found",
+        )
+    page, next_cursor = archive_page(*archive, before_id, after_id, limit)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return json_list_response(page, headers)
+
+
+"""
+globalni chat preko websocketa, alternativa pollanju /messages/unread
+prva poruka: {"type": "connect", "user_id": 1, "last_seen_id": 123}
+ako je last_seen_id poslan, prvo dobija poruke nakon njega (nastavak nakon reconnecta),
+a zatim svaku novu poruku kao {"type": "global_message", "data": {...}}
+poruka iz backloga i push mogu se preklopiti, klijent preskace id-ove koje je vec primio
+backlog ima najvise MAX_PAGE_SIZE poruka; ako ih je bilo vise, klijent dobija
+{"type": "backlog_truncated", "next_cursor": "after_id=N"} i ostatak cita sa GET /messages?after_id=N
+(poruke starije od GLOBAL_RETENTION_DAYS su u /messages/archive)
+"""
+
+
+@router.websocket("/messages/ws")
+async def global_chat_ws(websocket: WebSocket):
+    await websocket.accept()
+    user_id = None
+    try:
+        data = await websocket.receive_json()
+        if data.get("type") != "connect":
+            await websocket.close(code=403)
+            return
+
+        last_seen_id = data.get("last_seen_id")
+        backlog, next_cursor = [], None
+        async with AsyncSessionLocal() as db:
+            # nepoznat user ne moze otvoriti vezu
+            if await resolve_username(db, data.get("user_id")) is None:
+                await websocket.close(code=403)
+                return
+            if last_seen_id is not None:
+                backlog, next_cursor = await list_messages_after(db, last_seen_id)
+        user_id = data["user_id"]
+
+        # backlog saljemo direktno, prije nego socket dobije svoj red i writer
+        for wire in backlog:
+            m = orjson.loads(wire)
+            await websocket.send_json({"type": "global_message", "data": m})
+            last_seen_id = m["id"]
+
+        if next_cursor is not None:
+            # ostatak klijent stranicama cita preko HTTP-a, ovdje dobija samo nove poruke
+            await websocket.send_json(
+                {"type": "backlog_truncated", "next_cursor": next_cursor}
+            )
+
+        await global_manager.connect(user_id, websocket)
+        if last_seen_id is not None and next_cursor is None:
+            # poruke pristigle dok smo slali backlog (iz cachea, bez awaita izmedju)
+            for m in message_cache_after(last_seen_id):
+                global_manager.deliver([user_id], {"type": "global_message", "data": m})
+
+        # slanje ide preko POST /messages, ovdje samo cekamo da se veza prekine
+        while True:
+            await websocket.receive_json()
+
+    except WebSocketDisconnect:
+        if user_id is not None:
+            global_manager.disconnect(user_id, websocket)
@@ -1,9 +1,17 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from database import get_db
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from crud.notifications import (
     mark_notifications_read,
     unread_badges,
+    badge_version,
+)
+from helper import (
+    make_etag,
+    etag_matches,
+    suggest_poll_interval,
+    poll_headers,
+    not_modified,
 )
 from schemas.notification import NotificationMarkRead
 
@@ -17,12 +25,36 @@ npr. return {
 """
 
 
+# ETag je verzija badge mape usera, None dok mapa nije u cacheu (ili je zastarjela)
+def _badge_headers(user_id: int):
+    cached = badge_version(user_id)
+    if cached is None:
+        return None
+    version, changed_at = cached
+    return poll_headers(
+        make_etag(f"b{user_id}", version), suggest_poll_interval(changed_at)
+    )
+
+
 @router.get("/unread")
-def get_unread_badges(
+async def get_unread_badges(
+    request: Request,
+    response: Response,
     current_user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    return unread_badges(db, current_user_id=current_user_id)
+    headers = _badge_headers(current_user_id)
+    if headers is not None and etag_matches(request, headers["ETag"]):
+        return not_modified(headers)
+
+    # mapa je ponovo izracunata, ali ako se nije promijenila i dalje ne saljemo tijelo
+    badges = await unread_badges(db, current_user_id=current_user_id)
+    headers = _badge_headers(current_user_id)
+    if headers is not None:
+        if etag_matches(request, headers["ETag"]):
+            return not_modified(headers)
+        response.headers.update(headers)
+    return badges
 
 
 """
@@ -39,10 +71,12 @@ def post_mark_read(
 
 # oznacava sve neprocitane notifikacije kao procitane i vraca broj azuriranih redova
 @router.patch("/{chat_id}/read")
-def mark_notifications_as_read(
+async def mark_notifications_as_read(
     chat_id: int,
     payload: NotificationMarkRead,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    updated = mark_notifications_read(db, user_id=payload.user_id, chat_id=chat_id)
+    updated = await mark_notifications_read(
+        db, user_id=payload.user_id, chat_id=chat_id
+    )
     return {"updated": updated}
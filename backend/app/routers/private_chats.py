@@ -1,23 +1,39 @@
-from typing import List
+from typing import List, Optional
 from fastapi import (
     APIRouter,
     Depends,
+    Query,
     WebSocket,
     WebSocketDisconnect,
     HTTPException,
     status,
 )
-from sqlalchemy.orm import Session
-from database import SessionLocal, get_db
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, get_async_db
 from schemas.chat import ChatOut, ChatCreate
 from schemas.message import MessageOut, MessageIn
 from ws_manager import manager
+from helper import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    json_list_response,
+    message_to_dict,
+)
 from crud.private_chats import (
     get_or_create_chat as crud_get_or_create_chat,
     list_messages_for_chat,
     get_other_user_id,
     create_message_and_notify,
 )
+from crud.global_chat import resolve_username, is_valid_sender
+from rate_limit import check_send_rate, send_rate_error
+from crud.search import (
+    search_messages,
+    ORDER_RANK,
+    SEARCH_ORDER_PATTERN,
+    SEARCH_QUERY_MAX_LENGTH,
+)
 from crud.notifications import (
     create_new_chat_notification,
 )
@@ -26,11 +42,13 @@ router = APIRouter(prefix="/chats", tags=["private chats"])
 
 
 @router.post("", response_model=ChatOut)
-async def create_or_get_chat(payload: ChatCreate, db: Session = Depends(get_db)):
-    chat = crud_get_or_create_chat(db, payload.user1_id, payload.user2_id)
+async def create_or_get_chat(
+    payload: ChatCreate, db: AsyncSession = Depends(get_async_db)
+):
+    chat = await crud_get_or_create_chat(db, payload.user1_id, payload.user2_id)
     recipient_id = get_other_user_id(chat, payload.user1_id)
 
-    create_new_chat_notification(db, recipient_id=recipient_id, chat_id=chat.id)
+    await create_new_chat_notification(db, recipient_id=recipient_id, chat_id=chat.id)
 
     await manager.send_personal_message(
         recipient_id,
@@ -43,7 +61,16 @@ async def create_or_get_chat(payload: ChatCreate, db: Session = Depends(get_db))
             },
         },
     )
-    return chat
+    # user1/user2 su ucitani zajedno sa chatom (u async sesiji nema lazy load-a)
+    # historija poruka se ne vraca ovdje, ide preko paginiranog /chats/{chat_id}/messages
+    return {
+        "id": chat.id,
+        "user1_id": chat.user1_id,
+        "user2_id": chat.user2_id,
+        "created_at": chat.created_at,
+        "user1": chat.user1,
+        "user2": chat.user2,
+    }
 
 
 """
@@ -72,14 +99,64 @@ async def get_or_create_chat(
 """
 
 
+# bez parametara vraca zadnjih `limit` poruka
+# before_id: starije poruke (skrolanje unazad), after_id: novije (npr. nakon reconnecta)
+# kursor za iducu stranicu je u X-Next-Cursor headeru, npr. "before_id=123"
 @router.get("/{chat_id}/messages", response_model=List[MessageOut])
-def get_chat_messages(chat_id: int, db: Session = Depends(get_db)):
-    return list_messages_for_chat(db, chat_id)
+async def get_chat_messages(
+    chat_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before_id or after_id",
+        )
+    page, next_cursor = await list_messages_for_chat(
+        db, chat_id, before_id=before_id, after_id=after_id, limit=limit
+    )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return json_list_response(page, headers)
+
+
+# pretraga jednog chata, kursor kao kod /messages/search
+@router.get("/{chat_id}/search", response_model=List[MessageOut])
+async def search_chat_messages(
+    chat_id: int,
+    q: str = Query(min_length=1, max_length=SEARCH_QUERY_MAX_LENGTH),
+    order: str = Query(ORDER_RANK, pattern=SEARCH_ORDER_PATTERN),
+    offset: int = Query(0, ge=0),
+    before_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    page, next_cursor = await search_messages(
+        db,
+        q,
+        chat_id=chat_id,
+        order=order,
+        offset=offset,
+        before_id=before_id,
+        limit=limit,
+    )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return json_list_response(page, headers)
 
 
 @router.post("/{chat_id}/messages", response_model=MessageOut)
-def send_chat_message(chat_id: int, msg_in: MessageIn, db: Session = Depends(get_db)):
-    result = create_message_and_notify(db, chat_id, msg_in)
+async def send_chat_message(
+    chat_id: int, msg_in: MessageIn, db: AsyncSession = Depends(get_async_db)
+):
+    # prvo provjera posiljaoca (cache identiteta): izmisljen user_id ne smije trositi tudji bucket
+    if not await is_valid_sender(db, msg_in.user_id, msg_in.username):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid sender"
+        )
+    check_send_rate(msg_in.user_id)
+    result = await create_message_and_notify(db, chat_id, msg_in)
     if result is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found"
@@ -87,6 +164,16 @@ def send_chat_message(chat_id: int, msg_in: MessageIn, db: Session = Depends(get
     return result["message"]
 
 
+# poruka koja ne prolazi MessageIn (npr. predugacak content), kao greska za socket
+INVALID_MESSAGE_ERROR = {
+    "type": "error",
+    "data": {
+        "code": status.HTTP_422_UNPROCESSABLE_ENTITY,
+        "detail": "Invalid message",
+    },
+}
+
+
 @router.websocket("/ws")
 async def private_chat_ws(websocket: WebSocket):
     await websocket.accept()
@@ -98,6 +185,13 @@ async def private_chat_ws(websocket: WebSocket):
             await websocket.close(code=403)
             return
 
+        # nepoznat user ne moze otvoriti vezu
+        async with AsyncSessionLocal() as db:
+            username = await resolve_username(db, data.get("user_id"))
+        if username is None:
+            await websocket.close(code=403)
+            return
+
         user_id = data["user_id"]
         await manager.connect(user_id, websocket)
 
@@ -107,36 +201,38 @@ async def private_chat_ws(websocket: WebSocket):
             if data.get("type") == "new_message":
                 payload = data.get("data", {})
                 chat_id = payload.get("chat_id")
-
-                db = SessionLocal()
+                # poruku moze poslati samo user kojem pripada veza
+                if payload.get("sender_id") != user_id:
+                    continue
                 try:
                     msg_in = MessageIn(
                         content=payload.get("content"),
-                        username=payload.get("username"),
+                        username=username,  # iz cachea identiteta, ne iz poruke
                         user_id=payload.get("sender_id"),
                     )
-                    result = create_message_and_notify(db, chat_id, msg_in)
+                except ValidationError:
+                    manager.deliver([user_id], INVALID_MESSAGE_ERROR)
+                    continue
+                # odbijena poruka se ne upisuje, klijent dobija gresku na istom socketu
+                error = send_rate_error(user_id)
+                if error is not None:
+                    manager.deliver([user_id], error)
+                    continue
+
+                async with AsyncSessionLocal() as db:
+                    result = await create_message_and_notify(db, chat_id, msg_in)
                     if result is None:
                         continue
 
                     msg = result["message"]
                     recipient_id = result["recipient_id"]
 
-                    # poruka
+                    # poruka, u istom obliku kao u historiji chata (+ chat_id i sender_id)
+                    data = message_to_dict(msg)
+                    data["chat_id"] = chat_id
+                    data["sender_id"] = msg_in.user_id
                     await manager.send_personal_message(
-                        recipient_id,
-                        {
-                            "type": "new_message",
-                            "data": {
-                                "id": msg.id,
-                                "chat_id": chat_id,
-                                "sender_id": msg_in.user_id,
-                                "username": msg_in.username,
-                                "content": msg_in.content,
-                                "created_at": msg.created_at.isoformat(),
-                                "type": "user_message",
-                            },
-                        },
+                        recipient_id, {"type": "new_message", "data": data}
                     )
 
                     # notifikacija
@@ -152,9 +248,6 @@ async def private_chat_ws(websocket: WebSocket):
                         },
                     )
 
-                finally:
-                    db.close()
-
     except WebSocketDisconnect:
         if user_id is not None:
-            manager.disconnect(user_id)
+            manager.disconnect(user_id, websocket)
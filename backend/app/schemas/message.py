@@ -1,5 +1,5 @@
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
 from enum import Enum
 
@@ -16,8 +16,12 @@ class MessageBase(BaseModel):
     user_id: Optional[int] = None
 
 
+# gornja granica za novu poruku, da jedna poruka ne moze napuniti cache ili liniju brokera
+MAX_MESSAGE_LENGTH = 4000
+
+
 class MessageIn(MessageBase):
-    pass
+    content: str = Field(max_length=MAX_MESSAGE_LENGTH)
 
 
 class MessageOut(MessageBase):
@@ -0,0 +1,122 @@
+import argparse
+import time
+from sqlalchemy import inspect, text
+from database import engine
+
+"""
+FTS5 indexi nad messages.content za pretragu poruka (vidi crud/search.py)
+- messages_fts_global: globalni chat (chat_id IS NULL)
+- messages_fts_private: privatni chatovi, uz content se indexira i token chata "c<chat_id>",
+  pa pretraga jednog chata sijece liste u indexu umjesto da filtrira sve pogotke iz baze
+globalni chat ima svoj index da upit ne mora citati listu svih globalnih poruka
+
+oba su "external content" tabele: cuvaju samo index, tekst poruke se cita iz messages
+prefix='2 3': "ab*" i "abc*" citaju jednu listu umjesto svih rijeci sa tim prefiksom
+
+indexe odrzavaju triggeri na messages, u istoj transakciji kao i upis:
+- insert: svaki upis poruke (group commit u message_writer, seed...)
+- delete: arhiviranje globalne historije, brisanje chata
+- update: spajanje dupliranih chatova mijenja chat_id
+
+za bazu kreiranu prije indexa (ili ako se index osteti), rebuild iz backend/app:
+    python -m search_index --rebuild
+"""
+
+GLOBAL_FTS = "messages_fts_global"
+PRIVATE_FTS = "messages_fts_private"
+_FTS_OPTIONS = (
+    "content_rowid='id', prefix='2 3', "
+    # remove_diacritics: "pridruzio" nalazi i "pridružio"
+    "tokenize='unicode61 remove_diacritics 2'"
+)
+
+
+def _index_row(row: str):
+    return f"""
+        INSERT INTO {GLOBAL_FTS}(rowid, content)
+        SELECT {row}.id, {row}.content WHERE {row}.chat_id IS NULL;
+        INSERT INTO {PRIVATE_FTS}(rowid, content, chat)
+        SELECT {row}.id, {row}.content, 'c' || {row}.chat_id
+        WHERE {row}.chat_id IS NOT NULL;"""
+
+
+# external content index se brise sa istim vrijednostima sa kojima je upisan
+def _unindex_row(row: str):
+    return f"""
+        INSERT INTO {GLOBAL_FTS}({GLOBAL_FTS}, rowid, content)
+        SELECT 'delete', {row}.id, {row}.content WHERE {row}.chat_id IS NULL;
+        INSERT INTO {PRIVATE_FTS}({PRIVATE_FTS}, rowid, content, chat)
+        SELECT 'delete', {row}.id, {row}.content, 'c' || {row}.chat_id
+        WHERE {row}.chat_id IS NOT NULL;"""
+
+
+_DDL = [
+    f"""CREATE VIEW IF NOT EXISTS {GLOBAL_FTS}_source AS
+    SELECT id, content FROM messages WHERE chat_id IS NULL""",
+    f"""CREATE VIEW IF NOT EXISTS {PRIVATE_FTS}_source AS
+    SELECT id, content, 'c' || chat_id AS chat FROM messages WHERE chat_id IS NOT NULL""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {GLOBAL_FTS} USING fts5(
+        content, content='{GLOBAL_FTS}_source', {_FTS_OPTIONS}
+    )""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {PRIVATE_FTS} USING fts5(
+        content, chat, content='{PRIVATE_FTS}_source', {_FTS_OPTIONS}
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        {_index_row("new")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        {_unindex_row("old")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update
+    AFTER UPDATE OF content, chat_id ON messages BEGIN
+        {_unindex_row("old")}
+        {_index_row("new")}
+    END""",
+]
+
+
+def _rebuild(conn):
+    for table in (GLOBAL_FTS, PRIVATE_FTS):
+        conn.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+    # rang racuna samo content, token chata sluzi za filtriranje
+    conn.execute(
+        text(
+            f"INSERT INTO {PRIVATE_FTS}({PRIVATE_FTS}, rank) "
+            "VALUES ('rank', 'bm25(1.0, 0.0)')"
+        )
+    )
+
+
+# poziva se iz migrate_schema, index se puni kad je tabela tek kreirana (ili uz rebuild=True)
+def create_search_index(conn, rebuild: bool = False):
+    inspector = inspect(conn)
+    exists = inspector.has_table(GLOBAL_FTS) and inspector.has_table(PRIVATE_FTS)
+    for statement in _DDL:
+        conn.execute(text(statement))
+    if rebuild or not exists:
+        _rebuild(conn)
+
+
+def rebuild_search_index():
+    with engine.begin() as conn:
+        create_search_index(conn, rebuild=True)
+        # spaja segmente indexa, upiti nakon toga citaju manje stranica
+        for table in (GLOBAL_FTS, PRIVATE_FTS):
+            conn.execute(text(f"INSERT INTO {table}({table}) VALUES ('optimize')"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true", help="ponovo napravi index")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.print_help()
+        return
+
+    started = time.perf_counter()
+    rebuild_search_index()
+    print(f"Index pretrage napravljen za {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
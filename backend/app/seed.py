@@ -12,7 +12,8 @@ fake = Faker()
 
 def generate_history_data(db: Session, n_users=50, n_messages=500):
 
-    # ukoliko vec postoje podaci
+    # ukoliko vec postoje podaci (useri i poruke se upisuju jednim commitom,
+    # a startup_lock osigurava da seed ne radi vise workera odjednom)
     if db.query(User).count() > 0:
         return
 
@@ -27,7 +28,7 @@ def generate_history_data(db: Session, n_users=50, n_messages=500):
         )
 
     db.add_all(users)
-    db.commit()
+    db.flush()  # id-ovi usera za poruke
 
     # oduzimamo 30 dana od trenutnog vremena
     start_time = datetime.now(timezone.utc) - timedelta(days=30)
@@ -0,0 +1,27 @@
+import os
+import sys
+import time
+import pytest
+
+# app se pokrece iz backend/app i importuje module bez paketa (from database import ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# rucno pomjeran monotonic sat, za TTL-ove i token buckete bez spavanja
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def monotonic_ns(self):
+        return int(self.now * 1e9)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(time, "monotonic_ns", clock.monotonic_ns)
+    return clock
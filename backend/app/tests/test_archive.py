@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import orjson
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from database import Base
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from models.archive import GlobalArchive
+import archive
+from archive import archive_global_history, archive_month, load_archive, archive_page
+
+# create_all pravi tabele svih ucitanih modela, a Message ima relacije prema User i Chat
+_MODELS = (User, Chat)
+
+JANUARY = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(archive, "_archive_cache", OrderedDict())
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def _add(db, content, created_at, chat_id=None):
+    msg = Message(
+        content=content,
+        username="alice",
+        chat_id=chat_id,
+        type=MessageType.USER_MESSAGE,
+        created_at=created_at,
+    )
+    db.add(msg)
+    db.commit()
+    return msg.id
+
+
+def test_old_global_months_move_to_archive(db):
+    old_ids = [_add(db, f"jan {i}", JANUARY + timedelta(days=i)) for i in range(3)]
+    private_id = _add(db, "privatna", JANUARY, chat_id=1)
+    recent_id = _add(db, "nova", datetime.now(timezone.utc).replace(tzinfo=None))
+
+    assert archive_global_history(db) == {"2020-01": 3}
+    assert set(db.scalars(select(Message.id))) == {private_id, recent_id}
+    record = db.get(GlobalArchive, "2020-01")
+    assert (record.first_id, record.last_id, record.message_count) == (
+        old_ids[0],
+        old_ids[-1],
+        3,
+    )
+
+    ids, lines = load_archive("2020-01")
+    assert ids == old_ids
+    assert [orjson.loads(line)["content"] for line in lines] == [
+        "jan 0",
+        "jan 1",
+        "jan 2",
+    ]
+    page, next_cursor = archive_page(ids, lines, limit=2)
+    assert [orjson.loads(line)["id"] for line in page] == old_ids[1:]
+    assert next_cursor == f"before_id={old_ids[1]}"
+    assert load_archive("2019-12") is None
+
+
+def test_rearchiving_merges_with_existing_file(db):
+    first = _add(db, "prva", JANUARY)
+    # zivi dio historije cuva najveci id, pa sqlite ne dodjeljuje ponovo arhivirane id-ove
+    _add(db, "nova", datetime.now(timezone.utc).replace(tzinfo=None))
+    assert archive_month(db, JANUARY) == 1
+    assert load_archive("2020-01")[0] == [first]
+
+    # red koji je ostao u bazi (pad izmedju fajla i brisanja) ili je dodan naknadno
+    second = _add(db, "druga", JANUARY + timedelta(days=1))
+    assert archive_month(db, JANUARY) == 1
+    assert load_archive("2020-01")[0] == [first, second]
+    assert db.get(GlobalArchive, "2020-01").message_count == 2
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
+from database import Base, get_async_db
+from models.user import User
+from models.chat import Chat
+from models.notification import UnreadCounter
+import cache.cache_presence as cache_presence
+import crud.notifications as notifications
+from routers import global_chat, notifications as notifications_router
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, clock):
+    path = tmp_path / "chat.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add_all([User(id=1, username="alice"), User(id=2, username="bob")])
+        db.add(Chat(id=1, user1_id=1, user2_id=2, pair_key="1:2"))
+        db.add(UnreadCounter(recipient_id=1, chat_id=1, unread_count=1))
+        db.commit()
+    engine.dispose()
+
+    # svaki test pocinje bez badge mapa i bez prisutnosti iz drugih testova
+    monkeypatch.setattr(notifications, "_badge_cache", OrderedDict())
+    monkeypatch.setattr(cache_presence, "_presence", {})
+    monkeypatch.setattr(cache_presence, "_active_list_at", None)
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def get_test_db():
+        async with session_factory() as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(global_chat.router)
+    app.include_router(notifications_router.router)
+    app.dependency_overrides[get_async_db] = get_test_db
+    with TestClient(app) as client:
+        yield client
+
+
+def _get(client, url, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get(url, headers=headers)
+
+
+def test_unread_badges_304_until_map_changes(client):
+    url = "/notifications/unread?current_user_id=1"
+    first = _get(client, url)
+    assert first.status_code == 200
+    assert first.json() == {"2": True}
+    etag = first.headers["ETag"]
+
+    assert _get(client, url, etag).status_code == 304
+
+    client.patch("/notifications/1/read", json={"user_id": 1})
+    changed = _get(client, url, etag)
+    assert changed.status_code == 200
+    assert changed.json() == {}
+    assert changed.headers["ETag"] != etag
+    assert _get(client, url, changed.headers["ETag"]).status_code == 304
+
+
+def test_active_users_304_until_list_changes(client, clock):
+    first = _get(client, "/users/active?current_user_id=1")
+    assert first.status_code == 200
+    assert [u["id"] for u in first.json()] == [1]
+    etag = first.headers["ETag"]
+
+    clock.now += cache_presence.ACTIVE_LIST_TTL
+    assert _get(client, "/users/active?current_user_id=1", etag).status_code == 304
+
+    clock.now += cache_presence.ACTIVE_LIST_TTL
+    changed = _get(client, "/users/active?current_user_id=2", etag)
+    assert changed.status_code == 200
+    assert [u["id"] for u in changed.json()] == [2, 1]
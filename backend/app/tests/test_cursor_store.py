@@ -0,0 +1,89 @@
+import random
+import pytest
+import cache.cache_global as cache_global
+from cache.cache_global import CursorStore
+from cache.cache_shared import SharedCursorStore, EMPTY
+
+
+@pytest.fixture(params=["memory", "mmap"])
+def make_store(request, tmp_path):
+    def make(max_size, ttl):
+        if request.param == "mmap":
+            return SharedCursorStore(str(tmp_path / "cursors"), max_size, ttl, 0)
+        return CursorStore(max_size, ttl)
+
+    return make
+
+
+def test_cursor_expires_after_ttl(clock, make_store):
+    store = make_store(10, ttl=5)
+    store.set(1, 10, 1)
+    store.set(2, 20, 2)
+    clock.now += 3
+    store.set(2, 21, 3)  # poll produzava TTL
+    clock.now += 3
+    store.expire()
+    assert store.get(1) is None
+    assert store.get(2) == (21, 3)
+    assert store.stats()["expired"] == 1
+    assert len(store) == 1
+
+
+def test_full_store_evicts_instead_of_growing(clock, make_store):
+    store = make_store(4, ttl=60)
+    for user_id in range(1, 11):
+        clock.now += 1
+        store.set(user_id, user_id, user_id)
+    assert len(store) == 4
+    assert store.stats()["evicted"] == 6
+    assert store.get(10) == (10, 10)
+
+
+def test_heap_evicts_earliest_expiring(clock):
+    store = CursorStore(3, ttl=60)
+    for user_id in (1, 2, 3):
+        clock.now += 1
+        store.set(user_id, 0, 0)
+    clock.now += 1
+    store.set(1, 0, 0)  # user 1 je sad najsvjeziji
+    store.set(4, 0, 0)
+    assert store.get(2) is None
+    assert all(store.get(user_id) is not None for user_id in (1, 3, 4))
+
+
+def test_heap_is_compacted_for_repeated_polls(clock):
+    store = CursorStore(100, ttl=60)
+    for i in range(10000):
+        clock.now += 0.001
+        store.set(i % 5, i, i)
+    stats = store.stats()
+    assert stats["size"] == 5
+    assert stats["heap_size"] <= cache_global.HEAP_COMPACT_RATIO * 5 + 64
+
+
+# brisanje pomjera kursore unazad, svaki preostali mora i dalje biti na putu probanja
+def test_shared_store_deletes_keep_cursors_reachable(clock, tmp_path):
+    store = SharedCursorStore(str(tmp_path / "cursors"), 200, 1, 0)
+    rnd = random.Random(3)
+    model = {}
+    for step in range(20000):
+        clock.now += 0.001
+        user_id = rnd.randrange(1, 1000)
+        store.set(user_id, step, step)
+        model[user_id] = (step, step)
+        if step % 500 == 0:
+            store.expire()
+    users = store._users.tolist()
+    live = [i for i, user_id in enumerate(users) if user_id != EMPTY]
+    assert len(live) == len(store) <= 200
+    for i in live:
+        assert store._find(users[i])[0] == i
+        assert store.get(users[i]) == model[users[i]]
+
+
+def test_shared_store_rejects_empty_key(tmp_path):
+    store = SharedCursorStore(str(tmp_path / "cursors"), 10, 60, 0)
+    with pytest.raises(ValueError):
+        store.set(0, 1, 1)
+    assert store.get(0) is None
+    assert len(store) == 0
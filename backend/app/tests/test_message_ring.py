@@ -0,0 +1,124 @@
+import random
+import pytest
+import cache.cache_global as cache_global
+from cache.cache_global import MessageRing
+from cache.cache_shared import SharedMessageRing
+from helper import CachedMessage
+
+
+def _message(msg_id):
+    return CachedMessage.from_wire(msg_id, b'{"id":%d}' % msg_id)
+
+
+@pytest.fixture(params=["memory", "mmap"])
+def make_ring(request, monkeypatch, tmp_path):
+    def make(capacity, late_size=100):
+        if request.param == "mmap":
+            path = str(tmp_path / f"ring-{capacity}")
+            return SharedMessageRing(path, capacity, 1024 * capacity, late_size)
+        monkeypatch.setattr(cache_global, "LATE_BUFFER_SIZE", late_size)
+        return MessageRing(capacity)
+
+    return make
+
+
+def _ids(messages):
+    return [m.id for m in messages]
+
+
+def test_unseen_is_tail_after_cursor(make_ring):
+    ring = make_ring(10)
+    for i in range(1, 6):
+        ring.append(_message(i))
+    assert _ids(ring.unseen(3, 3)) == [4, 5]
+    assert ring.unseen(5, ring.seq) == []
+
+
+def test_late_message_reaches_cursor_past_its_id(make_ring):
+    ring = make_ring(10)
+    for i in (1, 2, 4):
+        ring.append(_message(i))
+    seq = ring.seq
+    # id 3 je commitovan nakon 4, korisnik je vec vidio 4
+    ring.append(_message(3))
+    ring.append(_message(5))
+    assert _ids(ring) == [1, 2, 3, 4, 5]
+    assert _ids(ring.unseen(4, seq)) == [3, 5]
+    assert _ids(ring.unseen(5, ring.seq)) == []
+
+
+def test_late_buffer_overflow_scans_by_seq(make_ring):
+    ring = make_ring(10, late_size=1)
+    for i in (1, 5, 6):
+        ring.append(_message(i))
+    seq = ring.seq
+    # dvije zakasnjele poruke, a late buffer pamti samo jednu
+    ring.append(_message(3))
+    ring.append(_message(2))
+    assert ring.late_dropped_seq > seq
+    assert _ids(ring.unseen(6, seq)) == [2, 3]
+
+
+def test_cursor_behind_eviction_falls_back_to_db(make_ring):
+    ring = make_ring(3)
+    for i in range(1, 4):
+        ring.append(_message(i))
+    seq = ring.seq
+    ring.append(_message(4))
+    # kursor ispred izbacene poruke i dalje je pokriven
+    assert _ids(ring.unseen(3, seq)) == [4]
+    # id 1 je izbacen, a korisnik ga nije vidio
+    assert ring.unseen(0, 0) is None
+    assert ring.evicted_seq == 1
+
+
+def test_unseen_matches_ground_truth(make_ring):
+    rnd = random.Random(7)
+    ring = make_ring(50, late_size=5)
+    seqs = {}  # id -> seq upisa
+    pending = []
+    next_id = 1
+    cursor = (0, 0)
+    for _ in range(3000):
+        if rnd.random() < 0.5:
+            pending.append(next_id)
+            next_id += 1
+        if pending and rnd.random() < 0.6:
+            # ponekad se commituje poruka koja nije najstarija dodijeljena (zakasnjeli upis)
+            k = rnd.randrange(len(pending)) if rnd.random() < 0.3 else 0
+            msg_id = pending.pop(k)
+            seqs[msg_id] = ring.append(_message(msg_id))
+        if rnd.random() < 0.2:
+            last_id, last_seq = cursor
+            unseen = ring.unseen(last_id, last_seq)
+            if unseen is None:
+                # poll ide u bazu
+                ids = [i for i in sorted(seqs) if i > last_id]
+            else:
+                ids = _ids(unseen)
+                expected = {i for i, s in seqs.items() if s > last_seq or i > last_id}
+                assert set(ids) == expected
+            cursor = (max([last_id] + ids), ring.seq)
+
+
+def test_shared_ring_evicts_slots_whose_data_is_overwritten(tmp_path):
+    ring = SharedMessageRing(str(tmp_path / "ring"), 100, 64, 10)
+    for i in range(1, 6):
+        ring.append(_message(i))
+    seq = ring.seq
+    # u 64 bajta ne stanu JSON-i svih 11 poruka, pa najstarije ispadaju prije capacity
+    for i in range(6, 12):
+        ring.append(_message(i))
+    assert len(ring) < 11
+    assert ring.unseen(0, 0) is None
+    assert _ids(ring.unseen(5, seq)) == list(range(6, 12))
+
+
+def test_shared_ring_is_visible_through_second_mapping(tmp_path):
+    path = str(tmp_path / "ring")
+    writer = SharedMessageRing(path, 10, 1024, 10)
+    reader = SharedMessageRing(path, 10, 1024, 10)
+    writer.append(_message(1))
+    writer.append(_message(2))
+    assert _ids(reader.unseen(1, 1)) == [2]
+    assert reader.seq == 2
@@ -0,0 +1,52 @@
+import asyncio
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from database import Base
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from models.notification import Notification, UnreadCounter
+from models.archive import GlobalArchive
+import message_writer
+from message_writer import MessageWriter
+
+# create_all pravi tabele svih ucitanih modela, a Message ima relacije prema User i Chat
+_MODELS = (User, Chat, Notification, UnreadCounter, GlobalArchive)
+
+
+def _message(content):
+    return Message(content=content, username="alice", type=MessageType.USER_MESSAGE)
+
+
+def test_failed_batch_resolves_every_caller(tmp_path, monkeypatch):
+    path = tmp_path / "chat.db"
+    Base.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    monkeypatch.setattr(
+        message_writer,
+        "AsyncSessionLocal",
+        async_sessionmaker(async_engine, expire_on_commit=False),
+    )
+
+    async def run():
+        writer = MessageWriter()
+        try:
+            # sqlite ne zna upisati object(), pa losa poruka obara zajednicki commit
+            results = await asyncio.wait_for(
+                asyncio.gather(
+                    writer.submit(_message("ok")),
+                    writer.submit(_message(object())),
+                    return_exceptions=True,
+                ),
+                timeout=5,
+            )
+            async with message_writer.AsyncSessionLocal() as db:
+                stored = await db.scalar(select(func.count()).select_from(Message))
+            return results, stored
+        finally:
+            await async_engine.dispose()
+
+    (good, bad), stored = asyncio.run(run())
+    assert isinstance(good, Message) and good.id is not None
+    assert isinstance(bad, Exception)
+    assert stored == 1
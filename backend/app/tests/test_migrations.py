@@ -0,0 +1,114 @@
+import pytest
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.exc import IntegrityError
+from database import Base
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from models.notification import Notification, NotificationType, UnreadCounter
+from migrations import migrate_schema
+
+
+# baza iz vremena prije pair_key: chats bez kolone i bez unique indexa
+@pytest.fixture
+def legacy_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    tables = [t for t in Base.metadata.sorted_tables if t is not Chat.__table__]
+    Base.metadata.create_all(engine, tables=tables)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE chats (id INTEGER PRIMARY KEY, user1_id INTEGER, "
+                "user2_id INTEGER, created_at DATETIME)"
+            )
+        )
+        conn.execute(
+            insert(User), [{"id": i, "username": f"user{i}"} for i in (1, 2, 3)]
+        )
+        # chatovi 2 i 4 su duplikati chata 1 (isti par, nastali u race-u)
+        conn.execute(
+            text("INSERT INTO chats (id, user1_id, user2_id) VALUES (:id, :a, :b)"),
+            [
+                {"id": 1, "a": 1, "b": 2},
+                {"id": 2, "a": 2, "b": 1},
+                {"id": 3, "a": 1, "b": 3},
+                {"id": 4, "a": 1, "b": 2},
+            ],
+        )
+        conn.execute(
+            insert(Message),
+            [
+                {
+                    "id": msg_id,
+                    "content": "hi",
+                    "username": "user2",
+                    "user_id": 2,
+                    "chat_id": chat_id,
+                    "type": MessageType.USER_MESSAGE,
+                }
+                for msg_id, chat_id in ((10, 1), (15, 2), (20, 4), (30, 3))
+            ],
+        )
+        conn.execute(
+            insert(UnreadCounter),
+            [
+                {
+                    "recipient_id": 1,
+                    "chat_id": 1,
+                    "unread_count": 2,
+                    "last_message_id": 10,
+                    "new_chat": False,
+                },
+                {
+                    "recipient_id": 1,
+                    "chat_id": 2,
+                    "unread_count": 3,
+                    "last_message_id": 15,
+                    "new_chat": False,
+                },
+                {
+                    "recipient_id": 2,
+                    "chat_id": 4,
+                    "unread_count": 0,
+                    "last_message_id": None,
+                    "new_chat": True,
+                },
+            ],
+        )
+        conn.execute(
+            insert(Notification),
+            [{"recipient_id": 2, "chat_id": 4, "type": NotificationType.NEW_CHAT}],
+        )
+    yield engine
+    engine.dispose()
+
+
+def test_duplicate_chats_are_merged_into_oldest(legacy_engine):
+    migrate_schema(legacy_engine)
+    migrate_schema(legacy_engine)  # pokrece se na svakom startu
+
+    with legacy_engine.connect() as conn:
+        chats = conn.execute(select(Chat.id, Chat.pair_key).order_by(Chat.id)).all()
+        messages = dict(conn.execute(select(Message.id, Message.chat_id)).all())
+        counters = conn.execute(
+            select(
+                UnreadCounter.recipient_id,
+                UnreadCounter.chat_id,
+                UnreadCounter.unread_count,
+                UnreadCounter.last_message_id,
+                UnreadCounter.new_chat,
+            ).order_by(UnreadCounter.recipient_id)
+        ).all()
+        notification_chats = conn.scalars(select(Notification.chat_id)).all()
+
+    assert [tuple(c) for c in chats] == [(1, "1:2"), (3, "1:3")]
+    assert messages == {10: 1, 15: 1, 20: 1, 30: 3}
+    assert [tuple(c) for c in counters] == [(1, 1, 5, 15, False), (2, 1, 0, None, True)]
+    assert notification_chats == [1]
+
+
+def test_pair_key_is_unique_after_migration(legacy_engine):
+    migrate_schema(legacy_engine)
+    with pytest.raises(IntegrityError):
+        with legacy_engine.begin() as conn:
+            conn.execute(insert(Chat).values(user1_id=2, user2_id=1, pair_key="1:2"))
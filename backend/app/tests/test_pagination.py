@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from database import Base
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from helper import keyset_select, keyset_page
+
+# create_all pravi tabele svih ucitanih modela, a Message ima relacije prema User i Chat
+_MODELS = (User, Chat)
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            Message(content=str(i), username="alice", type=MessageType.USER_MESSAGE)
+            for i in range(1, 11)
+        )
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def _page(db, before_id=None, after_id=None, limit=3):
+    stmt = keyset_select(select(Message), before_id, after_id, limit)
+    rows, next_cursor = keyset_page(db.scalars(stmt), after_id, limit)
+    return [m.id for m in rows], next_cursor
+
+
+def test_latest_page_then_scroll_back(db):
+    assert _page(db) == ([8, 9, 10], "before_id=8")
+    assert _page(db, before_id=8) == ([5, 6, 7], "before_id=5")
+    assert _page(db, before_id=2) == ([1], None)
+
+
+def test_pages_after_cursor(db):
+    assert _page(db, after_id=3) == ([4, 5, 6], "after_id=6")
+    # tacno limit preostalih poruka: nema iduce stranice
+    assert _page(db, after_id=7) == ([8, 9, 10], None)
+    assert _page(db, after_id=10) == ([], None)
@@ -0,0 +1,37 @@
+from rate_limit import RateLimiter
+
+
+def test_user_bucket_allows_burst_then_refills(clock):
+    limiter = RateLimiter(2, 3, 0, 0)
+    assert [limiter.acquire(1) for _ in range(3)] == [0, 0, 0]
+    wait = limiter.acquire(1)
+    assert wait == 0.5  # jedan token za 1/rate sekundi
+    clock.now += 0.5
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(1) > 0
+
+
+def test_users_do_not_share_buckets(clock):
+    limiter = RateLimiter(1, 1, 0, 0)
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(1) > 0
+    assert limiter.acquire(2) == 0
+
+
+def test_global_bucket_limits_all_users(clock):
+    limiter = RateLimiter(10, 10, 1, 2)
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(2) == 0
+    assert limiter.acquire(3) > 0
+    stats = limiter.stats()
+    assert stats["allowed"] == 2
+    assert stats["rejected_global"] == 1
+
+
+def test_rejected_message_spends_no_tokens(clock):
+    limiter = RateLimiter(1, 1, 1, 2)
+    assert limiter.acquire(1) == 0
+    # user 1 je odbijen na svom bucketu, pa drugi globalni token ostaje za user 2
+    assert limiter.acquire(1) > 0
+    assert limiter.acquire(2) == 0
+    assert limiter.acquire(3) > 0
@@ -0,0 +1,66 @@
+import pytest
+from sqlalchemy import create_engine, delete, text, update
+from sqlalchemy.orm import Session
+from database import Base
+from models.message import Message, MessageType
+from models.user import User
+from models.chat import Chat
+from migrations import migrate_schema
+from crud.search import build_match
+
+# create_all pravi tabele svih ucitanih modela, a Message ima relacije prema User i Chat
+_MODELS = (User, Chat)
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    Base.metadata.create_all(engine)
+    migrate_schema(engine)
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def _add(db, content, chat_id=None):
+    msg = Message(
+        content=content,
+        username="alice",
+        chat_id=chat_id,
+        type=MessageType.USER_MESSAGE,
+    )
+    db.add(msg)
+    db.commit()
+    return msg.id
+
+
+def _search(db, query, chat_id=None):
+    table, match = build_match(query, chat_id)
+    sql = f"SELECT rowid FROM {table} WHERE {table} MATCH :match ORDER BY rowid"
+    return list(db.scalars(text(sql), {"match": match}))
+
+
+def test_insert_trigger_indexes_global_and_private_separately(db):
+    global_id = _add(db, "zdravo svima")
+    chat1_id = _add(db, "zdravo iz chata", chat_id=1)
+    _add(db, "zdravo iz drugog chata", chat_id=2)
+    assert _search(db, "zdravo") == [global_id]
+    assert _search(db, "zdravo", chat_id=1) == [chat1_id]
+    assert _search(db, "zdr*", chat_id=1) == [chat1_id]
+
+
+def test_diacritics_are_ignored(db):
+    msg_id = _add(db, "alice se pridružio chatu!")
+    assert _search(db, "pridruzio") == [msg_id]
+
+
+def test_delete_and_update_triggers_keep_index_in_sync(db):
+    archived = _add(db, "stara poruka")
+    moved = _add(db, "poruka u duplikatu", chat_id=2)
+    db.execute(delete(Message).where(Message.id == archived))
+    # spajanje dupliranih chatova mijenja chat_id
+    db.execute(update(Message).where(Message.id == moved).values(chat_id=1))
+    db.commit()
+    assert _search(db, "stara") == []
+    assert _search(db, "poruka", chat_id=2) == []
+    assert _search(db, "poruka", chat_id=1) == [moved]
@@ -0,0 +1,186 @@
+import asyncio
+import fcntl
+from abc import ABC, abstractmethod
+import json
+import os
+
+"""
+broker prenosi websocket poruke izmedju uvicorn workera
+ConnectionManager ne salje direktno na socket nego objavljuje poruku preko brokera,
+a svaki worker dobija sve objavljene poruke i isporucuje ih samo svojim socketima
+
+- InProcessBroker: jedan proces, poruka se odmah isporucuje lokalno
+- UnixSocketBroker: vise procesa na istoj masini, jedan od workera drzi hub na unix socketu
+  i prosljedjuje svaku liniju (json) svim workerima, ukljucujuci i posiljaoca
+
+osim websocket kanala, broker nosi i upise u lokalne cacheove (vidi ws_manager.subscribe)
+"""
+
+WS_BROKER = os.environ.get("WS_BROKER", "inprocess")  # "inprocess" ili "unix"
+WS_BROKER_PATH = os.environ.get("WS_BROKER_PATH", "/tmp/chat-ws-broker.sock")
+RECONNECT_DELAY = 0.5  # s
+CONNECT_TIMEOUT = 5  # s
+# readline baca ValueError za dulju liniju (ostatak linije je i dalje u socketu),
+# pa takvu vezu prekidamo; publish dulje poruke ni ne salje hubu
+MAX_LINE_SIZE = 1024 * 1024
+# worker koji ne cita (npr. blokiran event loop) ne smije rasti hubu memoriju,
+# pa mu hub prekida vezu kad mu neposlano preraste ovo; spaja se ponovo uz resync
+MAX_CLIENT_BUFFER = 8 * MAX_LINE_SIZE
+
+
+class Broker(ABC):
+    def __init__(self, on_message, on_resync=None):
+        # on_message(envelope) isporucuje poruku lokalnim socketima
+        self.on_message = on_message
+        # on_resync() se zove kad su poruke drugih workera mozda propustene (pad huba)
+        self.on_resync = on_resync or (lambda: None)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, envelope: dict):
+        pass
+
+
+class InProcessBroker(Broker):
+    async def publish(self, envelope: dict):
+        self.on_message(envelope)
+
+
+class UnixSocketBroker(Broker):
+    def __init__(self, on_message, on_resync=None, path: str = WS_BROKER_PATH):
+        super().__init__(on_message, on_resync)
+        self.path = path
+        self._connected = None  # asyncio.Event, prva veza sa hubom
+        self._started = False
+        self._lock_file = None  # drzimo flock dok smo hub
+        self._server = None
+        self._hub_clients = set()
+        self._writer = None
+        self._reader_task = None
+
+    # hub je onaj worker koji uspije zakljucati lock fajl, lock se oslobadja kad proces umre
+    def _try_become_hub(self):
+        if self._lock_file is not None:
+            return True
+        f = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    async def _start_hub(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # ostao od procesa koji je pao
+        self._server = await asyncio.start_unix_server(
+            self._serve_client, path=self.path, limit=MAX_LINE_SIZE
+        )
+
+    async def _serve_client(self, reader, writer):
+        self._hub_clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client in list(self._hub_clients):
+                    client.write(line)
+                    if client.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                        self._hub_clients.discard(client)
+                        client.close()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # worker se ponovo spaja (i radi resync)
+        finally:
+            self._hub_clients.discard(writer)
+            writer.close()
+
+    async def _connect(self):
+        while True:
+            if self._server is None and self._try_become_hub():
+                await self._start_hub()
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.path, limit=MAX_LINE_SIZE
+                )
+                return reader, writer
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _read_loop(self):
+        while True:
+            reader, self._writer = await self._connect()
+            if self._started:
+                # dok nismo bili spojeni, poruke drugih workera su isle samo njihovim socketima
+                self.on_resync()
+            self._connected.set()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    envelope = json.loads(line)
+                    try:
+                        self.on_message(envelope)
+                    except Exception as e:
+                        # greska u isporuci jedne poruke ne smije zaustaviti citanje
+                        print("Greska pri isporuci poruke brokera:", e)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except ValueError:
+                # predugacka ili neispravna linija, ne znamo gdje pocinje iduca poruka
+                self._writer.close()
+            # hub je pao, biramo novi i spajamo se ponovo
+            self._writer = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # ceka prvu vezu sa hubom (najvise CONNECT_TIMEOUT), da cache punjen nakon start()
+    # dobija sve upise drugih workera
+    async def start(self):
+        self._connected = asyncio.Event()
+        self._reader_task = asyncio.create_task(self._read_loop())
+        try:
+            await asyncio.wait_for(self._connected.wait(), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass  # spajanje ide dalje u pozadini, uz resync kad uspije
+        self._started = True
+
+    async def stop(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._server is not None:
+            self._server.close()
+            for client in list(self._hub_clients):
+                client.close()
+            os.unlink(self.path)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def publish(self, envelope: dict):
+        writer = self._writer
+        if writer is None:
+            # nema veze sa hubom, isporucujemo bar lokalnim socketima
+            self.on_message(envelope)
+            return
+        line = json.dumps(envelope).encode() + b"\n"
+        if len(line) > MAX_LINE_SIZE:
+            # hub bi prekinuo vezu, poruka ide samo lokalnim socketima
+            self.on_message(envelope)
+            return
+        writer.write(line)
+        await writer.drain()
+
+
+def create_broker(on_message, on_resync=None):
+    if WS_BROKER == "unix":
+        return UnixSocketBroker(on_message, on_resync)
+    return InProcessBroker(on_message, on_resync)
@@ -1,26 +1,175 @@
+import asyncio
+import os
+from collections import deque
 from fastapi import WebSocket
+from ws_broker import create_broker
+
+"""
+svaka konekcija ima svoj ograniceni red poruka (outbox) i svoju writer korutinu koja ga prazni
+send_personal_message/broadcast samo ubacuju poruku u red i odmah se vracaju,
+pa spor ili polumrtav socket ne zaustavlja isporuku ostalima niti receive petlju posiljaoca
+
+kada je red pun primjenjuje se OVERFLOW_POLICY:
+- "drop_oldest": izbacujemo najstariju poruku iz reda
+- "coalesce": ako ista poruka vec ceka u redu, novu preskacemo, inace kao drop_oldest
+- "disconnect": zatvaramo konekciju, klijent se mora ponovo spojiti
+"""
+
+OUTBOX_SIZE = 256  # max broj poruka koje cekaju na slanje po konekciji
+SEND_TIMEOUT = 10  # s, socket koji ne primi poruku u ovom roku smatramo mrtvim
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICY = OVERFLOW_COALESCE
+
+
+class Connection:
+    def __init__(self, manager, user_id: int, websocket: WebSocket):
+        self.manager = manager
+        self.user_id = user_id
+        self.websocket = websocket
+        self.outbox = deque()
+        self.dropped = 0  # broj poruka izbacenih zbog punog reda
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def queue_depth(self):
+        return len(self.outbox)
+
+    # vraca False ako konekciju treba zatvoriti
+    def enqueue(self, message: dict):
+        if len(self.outbox) >= OUTBOX_SIZE:
+            if OVERFLOW_POLICY == OVERFLOW_DISCONNECT:
+                return False
+            self.dropped += 1
+            if OVERFLOW_POLICY == OVERFLOW_COALESCE and message in self.outbox:
+                return True
+            self.outbox.popleft()
+        self.outbox.append(message)
+        self._ready.set()
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.outbox:
+                    self._ready.clear()
+                    await self._ready.wait()
+                message = self.outbox.popleft()
+                await asyncio.wait_for(self.websocket.send_json(message), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # socket je zatvoren ili ne odgovara
+            self.manager.disconnect(self.user_id, self.websocket)
+
+    async def close(self):
+        self._writer.cancel()
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass  # vec zatvoren
 
 
 class ConnectionManager:
-    def __init__(self):
-        # user_id -> ws objekat
+    def __init__(self, channel: str):
+        # user_id -> Connection, samo socketi spojeni na ovaj proces
         self.active_connections = {}
+        self.channel = channel
+        _managers[channel] = self
 
     async def connect(self, user_id: int, websocket: WebSocket):
         # await websocket.accept()
-        self.active_connections[user_id] = websocket
+        old = self.active_connections.get(user_id)
+        self.active_connections[user_id] = Connection(self, user_id, websocket)
+        if old is not None:
+            # user se ponovo spojio, stari socket vise ne koristimo
+            asyncio.create_task(old.close())
 
-    def disconnect(self, user_id: int):
-        self.active_connections.pop(user_id, None)
+    # websocket se prosljedjuje da reconnect ne bi uklonio novu konekciju istog usera
+    def disconnect(self, user_id: int, websocket: WebSocket = None):
+        conn = self.active_connections.get(user_id)
+        if conn is None:
+            return
+        if websocket is not None and conn.websocket is not websocket:
+            return
+        del self.active_connections[user_id]
+        conn._writer.cancel()
+
+    def _enqueue(self, user_id: int, message: dict):
+        conn = self.active_connections.get(user_id)
+        if conn and not conn.enqueue(message):
+            self.disconnect(user_id)
+            asyncio.create_task(conn.close())
+
+    # poziva broker, za poruke objavljene sa bilo kojeg workera
+    # jedan prolaz ubacivanja u redove, slanje rade writer korutine konkurentno
+    def deliver(self, user_ids, message: dict):
+        if user_ids is None:
+            user_ids = list(self.active_connections)
+        for uid in user_ids:
+            self._enqueue(uid, message)
 
     async def send_personal_message(self, user_id: int, message: dict):
-        ws = self.active_connections.get(user_id)
-        if ws:
-            await ws.send_json(message)
+        await self.broadcast([user_id], message)
 
     async def broadcast(self, user_ids: list[int], message: dict):
-        for uid in user_ids:
-            await self.send_personal_message(uid, message)
+        await broker.publish(
+            {"channel": self.channel, "user_ids": user_ids, "message": message}
+        )
+
+    # salje svim konektovanim userima (globalni chat), na svim workerima
+    async def broadcast_all(self, message: dict):
+        await broker.publish(
+            {"channel": self.channel, "user_ids": None, "message": message}
+        )
+
+    # user_id -> (broj poruka u redu, broj izbacenih poruka)
+    def queue_depths(self):
+        return {
+            uid: {"queued": conn.queue_depth(), "dropped": conn.dropped}
+            for uid, conn in self.active_connections.items()
+        }
+
+
+_managers = {}  # channel -> ConnectionManager
+
+"""
+kanali koji ne idu na sockete nego u lokalno stanje workera (npr. cache privatnih chatova)
+publish salje poruku svim ostalim workerima, posiljalac je svoju promjenu vec primijenio
+resync handler se zove kad je veza sa hubom bila prekinuta, pa su poruke mozda propustene
+"""
+_ORIGIN = os.getpid()
+_handlers = {}  # channel -> (handler(poruka), resync())
+
+
+def subscribe(channel: str, handler, resync):
+    _handlers[channel] = (handler, resync)
+
+
+async def publish(channel: str, message: dict):
+    await broker.publish(
+        {"channel": channel, "user_ids": None, "message": message, "origin": _ORIGIN}
+    )
+
+
+def _dispatch(envelope: dict):
+    mgr = _managers.get(envelope["channel"])
+    if mgr is not None:
+        mgr.deliver(envelope["user_ids"], envelope["message"])
+        return
+    handler = _handlers.get(envelope["channel"])
+    if handler is not None and envelope.get("origin") != _ORIGIN:
+        handler[0](envelope["message"])
+
+
+def _resync():
+    for _, resync in _handlers.values():
+        resync()
+
 
+broker = create_broker(_dispatch, _resync)
 
-manager = ConnectionManager()
+manager = ConnectionManager("private")
+# pretplatnici na globalni chat, odvojeno od privatnih chatova
+global_manager = ConnectionManager("global")